@@ -0,0 +1,328 @@
+"""Load-test harness for the TalkTutor API.
+
+Runs the FastAPI app in-process against a fake LlmChat with configurable
+latency and a local MongoDB (or an in-memory stand-in), drives the main
+endpoints at fixed concurrency levels and writes the results as JSON so runs
+can be compared between commits.
+
+    python benchmark.py --concurrency 1,8,32 --requests 200 --output bench.json
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+from io import BytesIO
+
+SCENARIOS = ["analyze-text", "analyze-image", "history", "auth-me"]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the TalkTutor API")
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario and concurrency level")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma-separated scenarios to run")
+    parser.add_argument("--mongo", choices=["local", "memory"], default="local",
+                        help="local uses MONGO_URL with a throwaway database; memory needs mongomock-motor")
+    parser.add_argument("--llm-latency-ms", type=float, default=800, help="Median fake LLM latency")
+    parser.add_argument("--llm-jitter-ms", type=float, default=200, help="Spread of the fake LLM latency")
+    parser.add_argument("--llm-distribution", choices=["fixed", "uniform", "lognormal"], default="lognormal")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="Fraction of fake LLM calls that fail")
+    parser.add_argument("--image-size", default="1170x2532", help="Synthetic screenshot size, WIDTHxHEIGHT")
+    parser.add_argument("--history-size", type=int, default=500, help="Analyses seeded for the history user")
+    parser.add_argument("--repeat-inputs", action="store_true",
+                        help="Reuse identical inputs so caches and request coalescing take effect")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for latency and inputs")
+    parser.add_argument("--output", default=None, help="Write results JSON to this path")
+    return parser.parse_args()
+
+# Fake LLM
+class LatencyModel:
+    def __init__(self, distribution: str, median_ms: float, jitter_ms: float, rng: random.Random):
+        self.distribution = distribution
+        self.median = median_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.rng = rng
+
+    def sample(self) -> float:
+        if self.distribution == "fixed":
+            return self.median
+        if self.distribution == "uniform":
+            return max(0.0, self.rng.uniform(self.median - self.jitter, self.median + self.jitter))
+        # Lognormal with the given median; jitter sets the spread
+        sigma = self.jitter / self.median if self.median else 0.0
+        return self.median * self.rng.lognormvariate(0, sigma)
+
+def canned_response(image: bool) -> str:
+    lines = []
+    if image:
+        lines.append("IMAGE CONTEXT: A text conversation about weekend plans.")
+    lines.append("ANALYSIS: The other person is friendly and open to meeting up. Keep the momentum going.")
+    for n in range(1, 6):
+        lines.append(f"SUGGESTION {n}: Sounds great, how about Saturday at {n}pm? - Specific and easy to accept")
+    return "\n".join(lines)
+
+def make_fake_llm(latency: LatencyModel, error_rate: float, rng: random.Random):
+    class FakeLlmChat:
+        calls = 0
+
+        def __init__(self, api_key, session_id, system_message):
+            self.system_message = system_message
+
+        def with_model(self, provider, model):
+            return self
+
+        async def send_message(self, message):
+            FakeLlmChat.calls += 1
+            await asyncio.sleep(latency.sample())
+            if rng.random() < error_rate:
+                raise RuntimeError("Injected fake LLM failure")
+            return canned_response("IMAGE CONTEXT" in self.system_message)
+
+    return FakeLlmChat
+
+# Inputs
+def make_screenshot(size: str, rng: random.Random) -> str:
+    from PIL import Image, ImageDraw
+
+    width, height = (int(v) for v in size.lower().split("x"))
+    img = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(img)
+    for y in range(40, height - 80, 120):
+        left = rng.randint(20, width // 3)
+        right = rng.randint(width // 2, width - 20)
+        draw.rounded_rectangle([left, y, right, y + 80], radius=30, fill=(rng.randint(180, 230), 220, 250))
+    out = BytesIO()
+    img.save(out, format="PNG")
+    return base64.b64encode(out.getvalue()).decode("ascii")
+
+def conversation_text(rng: random.Random, unique: bool) -> str:
+    text = "Them: Hey! Are you free this weekend?\nMe: I might be, what did you have in mind?\nThem: Maybe dinner?"
+    return f"{text}\nThem: ({uuid.UUID(int=rng.getrandbits(128))})" if unique else text
+
+# Measurement
+class LoopLagMonitor:
+    """Measures how late a 10ms sleep wakes up; a blocked event loop shows up as lag"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - expected))
+
+    def start(self):
+        self.samples = []
+        self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self) -> dict:
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        return summarize(self.samples)
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def summarize(values: list) -> dict:
+    ordered = sorted(values)
+    return {
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(ordered, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 2),
+        "max_ms": round((ordered[-1] if ordered else 0.0) * 1000, 2),
+        "mean_ms": round((statistics.fmean(ordered) if ordered else 0.0) * 1000, 2)
+    }
+
+# Setup
+def use_memory_mongo(server):
+    try:
+        import mongomock_motor
+    except ImportError:
+        sys.exit("--mongo memory needs mongomock-motor (pip install mongomock-motor)")
+    memory_client = mongomock_motor.AsyncMongoMockClient()
+    server.client = memory_client
+    server.db = memory_client[server.DB_NAME]
+    for name in dir(server):
+        if name.endswith("_collection"):
+            setattr(server, name, server.db[name[:-len("_collection")]])
+
+async def create_user(http, server) -> dict:
+    response = await http.post("/api/dev/create-test-user")
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['session_token']}"}
+
+async def seed_history(server, headers: dict, count: int):
+    me = (await server.get_current_user(headers["Authorization"])).user_id
+    now = datetime.utcnow()
+    docs = [
+        {
+            "user_id": me,
+            "conversation_text": f"Seeded conversation {n}\n" * 20,
+            "tone": "friendly",
+            "goal": "date",
+            "analysis": "Seeded analysis",
+            "suggestions": ["One", "Two", "Three"],
+            "raw_response": "ANALYSIS: Seeded analysis\n" * 50,
+            "created_at": now.replace(microsecond=0) - timedelta(seconds=n),
+            "type": "text",
+            "plan": "pro"
+        }
+        for n in range(count)
+    ]
+    for start in range(0, len(docs), 1000):
+        await server.analyses_collection.insert_many(docs[start:start + 1000])
+
+def build_request(scenario: str, args, rng: random.Random, screenshot: str) -> tuple:
+    unique = not args.repeat_inputs
+    if scenario == "analyze-text":
+        return "POST", "/api/analyze-text", {
+            "conversation_text": conversation_text(rng, unique),
+            "tone": "friendly",
+            "goal": "date"
+        }
+    if scenario == "analyze-image":
+        return "POST", "/api/analyze-image", {
+            "image_base64": make_screenshot(args.image_size, rng) if unique else screenshot,
+            "tone": "friendly",
+            "goal": "date"
+        }
+    if scenario == "history":
+        return "GET", "/api/history", None
+    return "GET", "/api/auth/me", None
+
+async def run_level(http, scenario: str, concurrency: int, args, headers: dict, rng: random.Random, screenshot: str) -> dict:
+    # Inputs are built up front so payload generation is not part of the measurement
+    requests = [build_request(scenario, args, rng, screenshot) for _ in range(args.requests)]
+    latencies = []
+    statuses = {}
+    next_index = 0
+
+    async def worker():
+        nonlocal next_index
+        while next_index < len(requests):
+            method, path, body = requests[next_index]
+            next_index += 1
+            started = time.perf_counter()
+            try:
+                response = await http.request(method, path, json=body, headers=headers)
+                status = str(response.status_code)
+            except Exception as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    monitor = LoopLagMonitor()
+    monitor.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    loop_lag = await monitor.stop()
+
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency": summarize(latencies),
+        "event_loop_lag": loop_lag,
+        "statuses": statuses
+    }
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return "unknown"
+
+async def main(args):
+    import httpx
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    rng = random.Random(args.seed)
+    if args.mongo == "local":
+        os.environ["DB_NAME"] = f"talktutor_bench_{uuid.uuid4().hex[:8]}"
+    else:
+        os.environ["IMAGE_STORE_BACKEND"] = "filesystem"
+        os.environ["IMAGE_STORE_DIR"] = tempfile.mkdtemp(prefix="talktutor_bench_images_")
+    os.environ["ANALYSIS_SPOOL_PATH"] = os.path.join(tempfile.mkdtemp(prefix="talktutor_bench_"), "spool.jsonl")
+    # Every request comes from one test user, so per-user limits would throttle the load
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+
+    import server
+
+    if args.mongo == "memory":
+        use_memory_mongo(server)
+        if "history" in scenarios:
+            # mongomock does not implement the $substrCP used by the history projection
+            print("Skipping history: it needs a real MongoDB")
+            scenarios.remove("history")
+
+    latency = LatencyModel(args.llm_distribution, args.llm_latency_ms, args.llm_jitter_ms, rng)
+    fake_llm = make_fake_llm(latency, args.llm_error_rate, rng)
+    server.LlmChat = fake_llm
+
+    await server.app.router.startup()
+    results = []
+    try:
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as http:
+            headers = await create_user(http, server)
+            if "history" in scenarios:
+                await seed_history(server, headers, args.history_size)
+            screenshot = make_screenshot(args.image_size, rng)
+
+            for scenario in scenarios:
+                for concurrency in levels:
+                    calls_before = fake_llm.calls
+                    result = await run_level(http, scenario, concurrency, args, headers, rng, screenshot)
+                    result["llm_calls"] = fake_llm.calls - calls_before
+                    results.append(result)
+                    print(
+                        f"{scenario:14} c={concurrency:<4} {result['throughput_rps']:>8} req/s  "
+                        f"p50={result['latency']['p50_ms']}ms p95={result['latency']['p95_ms']}ms "
+                        f"p99={result['latency']['p99_ms']}ms  loop lag p99={result['event_loop_lag']['p99_ms']}ms  "
+                        f"{result['statuses']}"
+                    )
+    finally:
+        await server.app.router.shutdown()
+        if args.mongo == "local":
+            await server.client.drop_database(server.DB_NAME)
+
+    report = {
+        "commit": git_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "config": vars(args),
+        "results": results
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    return report
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -1,20 +1,39 @@
-from fastapi import FastAPI, HTTPException, Request, Depends, Header
+from fastapi import FastAPI, HTTPException, Request, Depends, Header, UploadFile, File, Form, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response, PlainTextResponse
+from starlette.routing import Match
 from pydantic import BaseModel, EmailStr, validator
 from typing import Optional, List
 from datetime import datetime, timezone, timedelta
 import os
 from dotenv import load_dotenv
-from pymongo import MongoClient
-from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from gridfs.errors import NoFile, FileExists
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from bson import ObjectId, json_util
 import base64
 from io import BytesIO
-from PIL import Image
+from PIL import Image, ImageOps, ImageChops, ImageFilter, ImageStat
+from fontTools.ttLib import TTFont, TTLibError
+from fontTools.subset import Subsetter, Options as SubsetOptions
 import asyncio
 import httpx
+import litellm
 import uuid
+import time
+import hashlib
+import hmac
+import json
+import re
 import traceback
+import math
+import zlib
+import itertools
+import random
+import contextvars
+from bisect import bisect_left
+from collections import OrderedDict, deque
 
 # Load environment variables
 load_dotenv()
@@ -37,9 +56,43 @@ app.add_middleware(
 MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017")
 DB_NAME = os.getenv("DB_NAME", "test_database")
 EMERGENT_LLM_KEY = os.getenv("EMERGENT_LLM_KEY", "")
+VISION_MODEL = "gpt-5.2"
 AUTH_SESSION_API = "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data"
 
-client = MongoClient(MONGO_URL)
+# Streamed completions call litellm directly, since LlmChat only returns whole
+# responses; Emergent keys go through the same integration proxy LlmChat uses
+LLM_API_BASE = os.getenv("LLM_API_BASE") or (
+    os.getenv("INTEGRATION_PROXY_URL", "https://integrations.emergentagent.com") + "/llm"
+    if EMERGENT_LLM_KEY.startswith("sk-emergent-") else None
+)
+
+# One pooled client for AUTH_SESSION_API, kept open for the app's lifetime
+AUTH_HTTP_CONNECT_TIMEOUT_SECONDS = float(os.getenv("AUTH_HTTP_CONNECT_TIMEOUT_SECONDS", "3"))
+AUTH_HTTP_TIMEOUT_SECONDS = float(os.getenv("AUTH_HTTP_TIMEOUT_SECONDS", "10"))
+AUTH_HTTP_MAX_CONNECTIONS = int(os.getenv("AUTH_HTTP_MAX_CONNECTIONS", "100"))
+AUTH_HTTP_MAX_KEEPALIVE = int(os.getenv("AUTH_HTTP_MAX_KEEPALIVE", "20"))
+AUTH_HTTP_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("AUTH_HTTP_KEEPALIVE_EXPIRY_SECONDS", "60"))
+
+# HTTP/2 needs the optional h2 package (pip install httpx[http2])
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Async driver so database round trips never block the event loop
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "10"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "60000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+
+client = AsyncIOMotorClient(
+    MONGO_URL,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+    serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+)
 db = client[DB_NAME]
 
 # Collections
@@ -48,8 +101,129 @@ user_sessions_collection = db["user_sessions"]
 conversations_collection = db["conversations"]
 analyses_collection = db["analyses"]
 subscriptions_collection = db["subscriptions"]
+suggestion_cache_collection = db["suggestion_cache"]
+image_context_cache_collection = db["image_context_cache"]
+rate_limits_collection = db["rate_limits"]
+analysis_jobs_collection = db["analysis_jobs"]
+user_stats_collection = db["user_stats"]
+user_stats_daily_collection = db["user_stats_daily"]
+
+# Write-behind persistence for analyses documents
+ANALYSIS_WRITE_BEHIND = os.getenv("ANALYSIS_WRITE_BEHIND", "true") == "true"
+ANALYSIS_WRITE_QUEUE_SIZE = int(os.getenv("ANALYSIS_WRITE_QUEUE_SIZE", "1000"))
+ANALYSIS_WRITE_BATCH_SIZE = int(os.getenv("ANALYSIS_WRITE_BATCH_SIZE", "50"))
+ANALYSIS_WRITE_FLUSH_INTERVAL_MS = int(os.getenv("ANALYSIS_WRITE_FLUSH_INTERVAL_MS", "100"))
+ANALYSIS_SPOOL_PATH = os.getenv("ANALYSIS_SPOOL_PATH", "./analyses_spool.jsonl")
+
+# History list view
+HISTORY_PAGE_MAX = 100
+
+# History export: documents per cursor batch, and bytes buffered before each write
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "200"))
+EXPORT_CHUNK_BYTES = 64 * 1024
+# TrueType fonts for PDF export, tried in order for each character so later
+# entries act as fallbacks (e.g. a CJK font after a Latin/Cyrillic one)
+PDF_FONT_PATHS = [path.strip() for path in os.getenv(
+    "PDF_FONT_PATHS",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf,/usr/share/fonts/truetype/droid/DroidSansFallbackFull.ttf"
+).split(",") if path.strip()]
+HISTORY_PREVIEW_CHARS = 120
+HISTORY_DEFAULT_FIELDS = ["type", "tone", "goal", "created_at", "preview", "has_image"]
+HISTORY_ALLOWED_FIELDS = set(HISTORY_DEFAULT_FIELDS) | {"analysis", "suggestions", "plan", "image_ref"}
+
+# Build missing indexes at boot (also available as `python server.py ensure-indexes`)
+ENSURE_INDEXES_ON_STARTUP = os.getenv("ENSURE_INDEXES_ON_STARTUP", "true") == "true"
+
+# Upstream LLM concurrency
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "200"))
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", "3"))
+
+# Upstream LLM resilience: end-to-end deadline per call, retries on transient
+# errors, an optional hedged second request once the first is slower than the
+# given latency percentile (0, the default, disables it since it adds upstream
+# calls), and a circuit breaker per model. The deadline starts once the call
+# leaves our own queue, so a call can take up to LLM_QUEUE_TIMEOUT_SECONDS +
+# LLM_TIMEOUT_SECONDS; the two-step image pipeline makes two calls in sequence,
+# so twice that stays under the app's 30s HTTP timeout.
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "11"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BACKOFF_SECONDS = float(os.getenv("LLM_RETRY_BACKOFF_SECONDS", "0.5"))
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_BREAKER_ERROR_RATE = float(os.getenv("LLM_BREAKER_ERROR_RATE", "0.5"))
+LLM_BREAKER_MIN_CALLS = int(os.getenv("LLM_BREAKER_MIN_CALLS", "10"))
+LLM_BREAKER_WINDOW_SECONDS = float(os.getenv("LLM_BREAKER_WINDOW_SECONDS", "60"))
+LLM_BREAKER_OPEN_SECONDS = float(os.getenv("LLM_BREAKER_OPEN_SECONDS", "30"))
+
+# Background analysis jobs (?async=true): worker pool size, queue bound, how long a
+# running job may go without finishing before it is retried, how often leases are
+# checked, and long-poll cap
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_MAX_QUEUE = int(os.getenv("JOB_MAX_QUEUE", "500"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "300"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_LEASE_SWEEP_SECONDS = float(os.getenv("JOB_LEASE_SWEEP_SECONDS", "30"))
+JOB_RESULT_TTL_SECONDS = int(os.getenv("JOB_RESULT_TTL_SECONDS", str(24 * 3600)))
+JOB_POLL_MAX_WAIT_SECONDS = float(os.getenv("JOB_POLL_MAX_WAIT_SECONDS", "25"))
+
+# Batch text analysis (Pro): items per request and concurrent LLM calls per batch
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "50"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+
+# Per-user rate limits (limits live in PLANS); usage is synced to Mongo every RATE_LIMIT_SYNC_SECONDS
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true") == "true"
+RATE_LIMIT_SYNC_SECONDS = float(os.getenv("RATE_LIMIT_SYNC_SECONDS", "1"))
+
+# Prometheus metrics at /api/metrics. It and /api/cache/stats need
+# "Authorization: Bearer <METRICS_TOKEN>" and are disabled while it is unset
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true") == "true"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# Resolved-user cache for the auth path. Logout and plan changes only clear the
+# cache of the worker that served them; other workers keep the old entry for up
+# to USER_CACHE_TTL_SECONDS, so keep the TTL short when running several workers
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL_SECONDS = int(os.getenv("USER_CACHE_TTL_SECONDS", "5"))
+
+# Exact-match cache for generated suggestions
+SUGGESTION_CACHE_SIZE = int(os.getenv("SUGGESTION_CACHE_SIZE", "2000"))
+SUGGESTION_CACHE_TTL_SECONDS = int(os.getenv("SUGGESTION_CACHE_TTL_SECONDS", "86400"))
+
+# Perceptual-hash cache for extracted image context
+IMAGE_CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("IMAGE_CONTEXT_CACHE_TTL_SECONDS", "604800"))
+IMAGE_CONTEXT_HASH_MAX_DISTANCE = int(os.getenv("IMAGE_CONTEXT_HASH_MAX_DISTANCE", "6"))
+# A candidate only counts as the same picture if, once the two thumbnails are
+# aligned, no 8x8 block differs by more than this many grey levels on average.
+# Re-compressed, resized and slightly cropped copies stay within about 4; a
+# different conversation in the same bubble layout is 10 or more.
+IMAGE_CONTEXT_THUMBNAIL_MAX_DISTANCE = float(os.getenv("IMAGE_CONTEXT_THUMBNAIL_MAX_DISTANCE", "5"))
+IMAGE_CONTEXT_THUMBNAIL_WIDTH = 96
+IMAGE_CONTEXT_MAX_COMPARISONS = 3
+
+# Content-addressed image storage: "gridfs" or "filesystem"
+IMAGE_STORE_BACKEND = os.getenv("IMAGE_STORE_BACKEND", "gridfs")
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", "./image_store")
+
+# Image preprocessing before the vision call
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "1568"))
+IMAGE_OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "JPEG").upper()
+IMAGE_OUTPUT_QUALITY = int(os.getenv("IMAGE_OUTPUT_QUALITY", "85"))
+ALLOWED_IMAGE_FORMATS = {"JPEG", "PNG", "WEBP", "GIF", "BMP"}
+IMAGE_UPLOAD_MAX_BYTES = int(os.getenv("IMAGE_UPLOAD_MAX_BYTES", str(15 * 1024 * 1024)))
+# Room for the multipart boundaries and the tone/goal/context form fields
+IMAGE_UPLOAD_FORM_OVERHEAD_BYTES = 64 * 1024
+IMAGE_UPLOAD_PATHS = {"/api/analyze-image/upload"}
 
 # Subscription Plans
+# image_pipeline: "two_step" describes the image in one LLM call and writes
+# suggestions in a second; "single_call" sends the image with the
+# suggestions prompt and reads the description back from IMAGE CONTEXT:
+# llm_priority_weight: share of queued LLM work served per plan when upstream capacity is saturated
+# rate_limit: per-user analysis limits; a token bucket refilled at requests_per_minute
+# holding up to burst requests, plus per-minute and per-day totals shared across workers
+# prompt_token_budget: estimated tokens of conversation context sent with the suggestions prompt
+# conversation_threads: text analyses belong to a thread, so follow-ups only send the new messages
 PLANS = {
     "standard": {
         "name": "Standard",
@@ -57,7 +231,12 @@ PLANS = {
         "price_annual": 99.99,
         "ai_model": "gpt-5.2",
         "suggestions_count": 3,
-        "features": ["Unlimited analyses", "Standard AI model", "3 suggestions", "Full history"]
+        "image_pipeline": "two_step",
+        "llm_priority_weight": 1,
+        "rate_limit": {"requests_per_minute": 10, "burst": 5, "requests_per_day": 300},
+        "prompt_token_budget": 1000,
+        "conversation_threads": False,
+        "features": ["300 analyses per day", "Standard AI model", "3 suggestions", "Full history"]
     },
     "premium": {
         "name": "Premium",
@@ -65,6 +244,11 @@ PLANS = {
         "price_annual": 199.99,
         "ai_model": "gpt-5.2",
         "suggestions_count": 5,
+        "image_pipeline": "two_step",
+        "llm_priority_weight": 2,
+        "rate_limit": {"requests_per_minute": 20, "burst": 10, "requests_per_day": 1000},
+        "prompt_token_budget": 2000,
+        "conversation_threads": True,
         "features": ["Everything in Standard", "Advanced analysis", "5 suggestions", "Emotional tone analysis", "Follow-up suggestions", "Priority support"]
     },
     "pro": {
@@ -73,6 +257,11 @@ PLANS = {
         "price_annual": 299.99,
         "ai_model": "gpt-5.2",
         "suggestions_count": 5,
+        "image_pipeline": "two_step",
+        "llm_priority_weight": 4,
+        "rate_limit": {"requests_per_minute": 60, "burst": 20, "requests_per_day": 5000},
+        "prompt_token_budget": 4000,
+        "conversation_threads": True,
         "features": ["Everything in Premium", "Multi-language", "PDF exports", "Pattern analysis", "API access"]
     }
 }
@@ -94,10 +283,11 @@ class SessionDataResponse(BaseModel):
     picture: Optional[str]
     session_token: str
 
-class TextAnalysisRequest(BaseModel):
+class TextAnalysisItem(BaseModel):
     conversation_text: str
     tone: str
     goal: str
+    bypass_cache: bool = False
     
     @validator('conversation_text')
     def validate_text(cls, v):
@@ -107,21 +297,33 @@ class TextAnalysisRequest(BaseModel):
             raise ValueError('Conversation text is too long (max 10000 characters)')
         return v
 
+class TextAnalysisRequest(TextAnalysisItem):
+    # Thread returned by an earlier analysis of the same conversation
+    conversation_id: Optional[str] = None
+
+class BatchTextAnalysisRequest(BaseModel):
+    items: List[TextAnalysisItem]
+    
+    @validator('items')
+    def validate_items(cls, v):
+        if not v:
+            raise ValueError('Batch cannot be empty')
+        if len(v) > BATCH_MAX_ITEMS:
+            raise ValueError(f'Batch is too large (max {BATCH_MAX_ITEMS} items)')
+        return v
+
 class ImageAnalysisRequest(BaseModel):
     image_base64: str
     tone: str
     goal: str
     context: Optional[str] = None
+    bypass_cache: bool = False
     
     @validator('image_base64')
     def validate_image(cls, v):
+        # Decoding and format checks happen once, in prepare_image
         if not v:
             raise ValueError('Image data is required')
-        try:
-            # Validate base64 format
-            base64.b64decode(v)
-        except Exception:
-            raise ValueError('Invalid image format')
         return v
 
 class AnalysisResponse(BaseModel):
@@ -130,6 +332,7 @@ class AnalysisResponse(BaseModel):
     analysis_text: str
     tone_used: str
     goal_used: str
+    conversation_id: Optional[str] = None
 
 class ErrorResponse(BaseModel):
     error: str
@@ -145,7 +348,8 @@ async def http_exception_handler(request: Request, exc: HTTPException):
             error=exc.detail,
             message=str(exc.detail),
             details=None
-        ).dict()
+        ).dict(),
+        headers=getattr(exc, "headers", None)
     )
 
 @app.exception_handler(Exception)
@@ -165,20 +369,736 @@ async def general_exception_handler(request: Request, exc: Exception):
 def generate_session_id(user_id: str) -> str:
     return f"{user_id}_{datetime.utcnow().isoformat()}"
 
+# Metrics
+# Per-request labels, set once by the metrics middleware and check_subscription_and_limits
+metrics_endpoint = contextvars.ContextVar("metrics_endpoint", default="")
+metrics_plan = contextvars.ContextVar("metrics_plan", default="")
+# Response headers collected while handling a request (the dict is set by middleware, filled by handlers)
+response_headers = contextvars.ContextVar("response_headers", default=None)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+def escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(label_names, label_values, extra: str = "") -> str:
+    pairs = [
+        f'{name}="{escape_label_value(value)}"'
+        for name, value in zip(label_names, label_values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    def __init__(self, name: str, help_text: str, label_names: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        if METRICS_ENABLED:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_values, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {value}")
+        return lines
+
+class Gauge(Counter):
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, label_names: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        # label values -> [per-bucket counts (+Inf last), sum, count]
+        self.series = {}
+
+    def observe(self, value: float, *label_values):
+        if not METRICS_ENABLED:
+            return
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, (bucket_counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), bucket_counts):
+                cumulative += bucket_count
+                labels = format_labels(self.label_names, label_values, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+request_duration = Histogram(
+    "talktutor_request_duration_seconds",
+    "HTTP request latency",
+    ("endpoint", "method", "status")
+)
+stage_duration = Histogram(
+    "talktutor_stage_duration_seconds",
+    "Latency of each request pipeline stage",
+    ("stage", "endpoint", "plan", "model")
+)
+requests_in_flight = Gauge(
+    "talktutor_requests_in_flight",
+    "HTTP requests currently being served"
+)
+llm_errors = Counter(
+    "talktutor_llm_errors_total",
+    "Failed LLM calls",
+    ("stage", "model")
+)
+llm_retries = Counter(
+    "talktutor_llm_retries_total",
+    "LLM calls retried after a transient error",
+    ("stage", "model")
+)
+llm_hedges = Counter(
+    "talktutor_llm_hedged_total",
+    "Hedged second LLM requests, by which request won",
+    ("stage", "model", "winner")
+)
+llm_queue_wait = Histogram(
+    "talktutor_llm_queue_wait_seconds",
+    "Time spent waiting for an upstream LLM slot",
+    ("plan",)
+)
+cache_lookups = Counter(
+    "talktutor_cache_lookups_total",
+    "Cache lookups by cache, tier and result",
+    ("cache", "result")
+)
+
+def observe_stage(stage: str, seconds: float, model: str = ""):
+    stage_duration.observe(seconds, stage, metrics_endpoint.get(), metrics_plan.get(), model)
+
+class stage_timer:
+    """Context manager recording the duration of one pipeline stage"""
+    __slots__ = ("stage", "model", "started")
+
+    def __init__(self, stage: str, model: str = ""):
+        self.stage = stage
+        self.model = model
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe_stage(self.stage, time.perf_counter() - self.started, self.model)
+        return False
+
+def metrics_endpoint_label(scope: dict) -> str:
+    """Route template serving the request, so labels stay bounded whatever paths clients send.
+
+    Matched up front, as the router will, since stage timers need the label
+    while the handler runs.
+    """
+    partial = None
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path
+    return partial or "unmatched"
+
+def render_metrics() -> str:
+    lines = []
+    for metric in (request_duration, stage_duration, requests_in_flight, llm_errors, llm_retries, llm_hedges, cache_lookups):
+        lines.extend(metric.render())
+    # In-process caches keep their own counters; read them at scrape time
+    lines.append("# HELP talktutor_memory_cache_hits_total In-process cache hits")
+    lines.append("# TYPE talktutor_memory_cache_hits_total counter")
+    for name, cache in (("user", user_cache), ("suggestion", suggestion_cache)):
+        lines.append(f'talktutor_memory_cache_hits_total{{cache="{name}"}} {cache.hits}')
+    lines.append("# HELP talktutor_memory_cache_misses_total In-process cache misses")
+    lines.append("# TYPE talktutor_memory_cache_misses_total counter")
+    for name, cache in (("user", user_cache), ("suggestion", suggestion_cache)):
+        lines.append(f'talktutor_memory_cache_misses_total{{cache="{name}"}} {cache.misses}')
+    lines.append("# HELP talktutor_llm_coalesced_total LLM calls served by an identical in-flight call")
+    lines.append("# TYPE talktutor_llm_coalesced_total counter")
+    lines.append(f"talktutor_llm_coalesced_total {llm_flights.coalesced}")
+    lines.append("# HELP talktutor_llm_active Upstream LLM calls in progress")
+    lines.append("# TYPE talktutor_llm_active gauge")
+    lines.append(f"talktutor_llm_active {llm_scheduler.active}")
+    lines.append("# HELP talktutor_llm_queue_depth LLM calls waiting for a slot")
+    lines.append("# TYPE talktutor_llm_queue_depth gauge")
+    for plan, depth in llm_scheduler.stats()["queued"].items():
+        lines.append(f'talktutor_llm_queue_depth{{plan="{plan}"}} {depth}')
+    lines.append("# HELP talktutor_llm_rejected_total LLM calls refused with 503 (queue full or wait timeout)")
+    lines.append("# TYPE talktutor_llm_rejected_total counter")
+    lines.append(f"talktutor_llm_rejected_total {llm_scheduler.rejected + llm_scheduler.timed_out}")
+    lines.append("# HELP talktutor_llm_circuit_open Whether the circuit breaker is failing calls fast (1 open, 0.5 half open)")
+    lines.append("# TYPE talktutor_llm_circuit_open gauge")
+    for model, breaker in llm_breakers.items():
+        value = {"closed": 0, "half_open": 0.5, "open": 1}[breaker.state]
+        lines.append(f'talktutor_llm_circuit_open{{model="{escape_label_value(model)}"}} {value}')
+    lines.append("# HELP talktutor_rate_limited_total Requests refused with 429")
+    lines.append("# TYPE talktutor_rate_limited_total counter")
+    lines.append(f"talktutor_rate_limited_total {rate_limiter.limited}")
+    lines.append("# HELP talktutor_analysis_write_queue_depth Analyses waiting to be written")
+    lines.append("# TYPE talktutor_analysis_write_queue_depth gauge")
+    lines.append(f"talktutor_analysis_write_queue_depth {analysis_writer.stats()['queued']}")
+    return "\n".join(lines) + "\n"
+
+class UploadSizeLimitMiddleware:
+    """Refuses oversized image uploads before the multipart body is received and spooled.
+
+    A declared Content-Length over the cap is rejected without reading the
+    body; a chunked body is cut off with 413 as soon as it passes the cap.
+    """
+
+    def __init__(self, app, max_bytes: int, paths: set):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+        
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = await http_exception_handler(None, HTTPException(status_code=413, detail="Image is too large"))
+            response.headers["Connection"] = "close"
+            return await response(scope, receive, send)
+        
+        received = 0
+        
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise HTTPException(status_code=413, detail="Image is too large")
+            return message
+        
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(
+    UploadSizeLimitMiddleware,
+    max_bytes=IMAGE_UPLOAD_MAX_BYTES + IMAGE_UPLOAD_FORM_OVERHEAD_BYTES,
+    paths=IMAGE_UPLOAD_PATHS
+)
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    if not METRICS_ENABLED:
+        return await call_next(request)
+    endpoint = metrics_endpoint_label(request.scope)
+    metrics_endpoint.set(endpoint)
+    requests_in_flight.inc()
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        requests_in_flight.dec()
+        request_duration.observe(time.perf_counter() - started, endpoint, request.method, str(status))
+
+@app.middleware("http")
+async def add_response_headers(request: Request, call_next):
+    headers = {}
+    response_headers.set(headers)
+    response = await call_next(request)
+    response.headers.update(headers)
+    return response
+
+# Bounded TTL + LRU cache
+class TTLCache:
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        deadline, value = entry
+        if deadline <= time.time():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, expires_at: Optional[float] = None):
+        deadline = time.time() + self.ttl_seconds
+        if expires_at is not None:
+            deadline = min(deadline, expires_at)
+        self._entries[key] = (deadline, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def pop(self, key):
+        entry = self._entries.pop(key, None)
+        return entry[1] if entry else None
+
+    def remove_where(self, predicate) -> int:
+        stale = [key for key, (_, value) in self._entries.items() if predicate(value)]
+        for key in stale:
+            del self._entries[key]
+        return len(stale)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0
+        }
+
+# Session token -> User, capped at the session's own expiry
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL_SECONDS)
+
+# Suggestion cache key -> generate_suggestions result, backed by suggestion_cache_collection
+suggestion_cache = TTLCache(SUGGESTION_CACHE_SIZE, SUGGESTION_CACHE_TTL_SECONDS)
+
+def extract_session_token(authorization: str) -> str:
+    if authorization.startswith("Bearer "):
+        return authorization.replace("Bearer ", "")
+    return authorization
+
+def invalidate_user_cache(user_id: str):
+    user_cache.remove_where(lambda user: user.user_id == user_id)
+
+# Coalesces concurrent identical calls into one shared task
+class SingleFlight:
+    def __init__(self):
+        self.coalesced = 0
+        self._in_flight = {}
+
+    async def do(self, key, fn):
+        task = self._in_flight.get(key)
+        if task is None:
+            # The work runs in its own task so one caller disconnecting
+            # does not cancel it for the others still waiting on it
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._in_flight), "coalesced": self.coalesced}
+
+llm_flights = SingleFlight()
+
+# Caps concurrent upstream LLM calls; queued work is served by weighted round robin over plans
+class LlmScheduler:
+    def __init__(self, max_concurrent: int, max_queue: int, max_wait: float):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self.rejected = 0
+        self.timed_out = 0
+        # Rolling average of how long a call holds a slot, for Retry-After
+        self.avg_hold_seconds = 1.0
+        self._queues = {}
+        self._weights = {}
+        self._credit = {}
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def retry_after(self) -> int:
+        backlog = (self.queued + 1) / max(1, self.max_concurrent)
+        return max(1, math.ceil(backlog * self.avg_hold_seconds))
+
+    def overloaded(self) -> HTTPException:
+        return HTTPException(
+            status_code=503,
+            detail="AI service is busy, please retry shortly",
+            headers={"Retry-After": str(self.retry_after())}
+        )
+
+    async def acquire(self, plan: str, weight: int):
+        if self.active < self.max_concurrent and not self.queued:
+            self.active += 1
+            return
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            raise self.overloaded()
+        
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(plan, []).append(waiter)
+        self._weights[plan] = weight
+        self._credit.setdefault(plan, 0)
+        started = time.perf_counter()
+        # Not wait_for: on Python 3.11 it swallows a cancellation that lands as the slot is granted
+        timer = asyncio.get_running_loop().call_later(
+            self.max_wait,
+            lambda: waiter.done() or waiter.set_exception(asyncio.TimeoutError())
+        )
+        try:
+            await waiter
+        except asyncio.TimeoutError:
+            self.discard(plan, waiter)
+            self.timed_out += 1
+            raise self.overloaded()
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                # Granted a slot just as the caller went away
+                self.release()
+            else:
+                self.discard(plan, waiter)
+            raise
+        finally:
+            timer.cancel()
+            llm_queue_wait.observe(time.perf_counter() - started, plan)
+
+    def has_capacity(self) -> bool:
+        return self.active < self.max_concurrent and not self.queued
+
+    def discard(self, plan: str, waiter):
+        queue = self._queues.get(plan, [])
+        if waiter in queue:
+            queue.remove(waiter)
+
+    def release(self, held_seconds: Optional[float] = None):
+        if held_seconds is not None:
+            self.avg_hold_seconds = 0.9 * self.avg_hold_seconds + 0.1 * held_seconds
+        self.active -= 1
+        while self.active < self.max_concurrent:
+            plan = self.next_plan()
+            if plan is None:
+                return
+            waiter = self._queues[plan].pop(0)
+            if not waiter.done():
+                self.active += 1
+                waiter.set_result(None)
+
+    def next_plan(self) -> Optional[str]:
+        """Smooth weighted round robin over plans that have queued work"""
+        total = 0
+        best = None
+        for plan, queue in self._queues.items():
+            if not queue:
+                continue
+            self._credit[plan] += self._weights[plan]
+            total += self._weights[plan]
+            if best is None or self._credit[plan] > self._credit[best]:
+                best = plan
+        if best is not None:
+            self._credit[best] -= total
+        return best
+
+    def slot(self, plan_info: Optional[dict]):
+        return LlmSlot(self, plan_info or PLANS["standard"])
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "max_concurrent": self.max_concurrent,
+            "queued": {plan: len(queue) for plan, queue in self._queues.items()},
+            "max_queue": self.max_queue,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out
+        }
+
+class LlmSlot:
+    """async with llm_scheduler.slot(plan_info): one upstream LLM call"""
+
+    def __init__(self, scheduler: LlmScheduler, plan_info: dict):
+        self.scheduler = scheduler
+        self.plan = plan_info["name"].lower()
+        self.weight = plan_info.get("llm_priority_weight", 1)
+
+    async def __aenter__(self):
+        await self.scheduler.acquire(self.plan, self.weight)
+        self.started = time.perf_counter()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.scheduler.release(time.perf_counter() - self.started)
+        return False
+
+llm_scheduler = LlmScheduler(LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE, LLM_QUEUE_TIMEOUT_SECONDS)
+
+# Upstream LLM resilience
+class CircuitBreaker:
+    """Fails calls fast once the error rate over a rolling window crosses a threshold.
+
+    After open_seconds a single probe call is let through (half open); its
+    outcome closes the breaker or opens it again.
+    """
+
+    def __init__(self, error_rate: float, min_calls: int, window_seconds: float, open_seconds: float):
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+        self.outcomes = deque()
+        self.opened_at = None
+        self.probing = False
+        self.trips = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.open_seconds:
+            return "open"
+        return "half_open"
+
+    def check(self):
+        """Raise 503 unless a call may go upstream now"""
+        state = self.state
+        if state == "closed":
+            return
+        if state == "half_open" and not self.probing:
+            self.probing = True
+            return
+        self.rejected += 1
+        retry_after = max(1, math.ceil(self.opened_at + self.open_seconds - time.monotonic()))
+        raise HTTPException(
+            status_code=503,
+            detail="AI service is temporarily unavailable, please retry shortly",
+            headers={"Retry-After": str(retry_after)}
+        )
+
+    def record(self, ok: bool):
+        now = time.monotonic()
+        if self.opened_at is not None:
+            if self.probing:
+                self.probing = False
+                self.opened_at = None if ok else now
+                self.outcomes.clear()
+            return
+        
+        self.outcomes.append((now, ok))
+        while self.outcomes[0][0] < now - self.window_seconds:
+            self.outcomes.popleft()
+        failures = sum(1 for _, succeeded in self.outcomes if not succeeded)
+        if len(self.outcomes) >= self.min_calls and failures / len(self.outcomes) >= self.error_rate:
+            self.opened_at = now
+            self.trips += 1
+            print(f"LLM circuit breaker opened: {failures}/{len(self.outcomes)} calls failed")
+
+    def abandon(self):
+        """The call went away without an outcome; let another probe through"""
+        self.probing = False
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "window_calls": len(self.outcomes),
+            "window_failures": sum(1 for _, succeeded in self.outcomes if not succeeded),
+            "trips": self.trips,
+            "rejected": self.rejected
+        }
+
+llm_breakers = {}
+
+def llm_breaker(model: str) -> CircuitBreaker:
+    breaker = llm_breakers.get(model)
+    if breaker is None:
+        breaker = llm_breakers[model] = CircuitBreaker(
+            LLM_BREAKER_ERROR_RATE,
+            LLM_BREAKER_MIN_CALLS,
+            LLM_BREAKER_WINDOW_SECONDS,
+            LLM_BREAKER_OPEN_SECONDS
+        )
+    return breaker
+
+class LatencyWindow:
+    """Recent successful LLM call latencies per stage, for the hedge delay"""
+
+    def __init__(self, size: int = 200):
+        self.size = size
+        self.samples = {}
+
+    def add(self, stage: str, seconds: float):
+        samples = self.samples.get(stage)
+        if samples is None:
+            samples = self.samples[stage] = deque(maxlen=self.size)
+        samples.append(seconds)
+
+    def percentile(self, stage: str, pct: float) -> Optional[float]:
+        samples = self.samples.get(stage)
+        if not samples or len(samples) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+llm_latency = LatencyWindow()
+
+TRANSIENT_LLM_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+TRANSIENT_LLM_MESSAGE = re.compile(r"rate.?limit|timed? ?out|overloaded|temporarily|connection|\b(429|5\d\d)\b", re.IGNORECASE)
+
+def is_transient_llm_error(exc: Exception) -> bool:
+    if isinstance(exc, (asyncio.TimeoutError, ConnectionError, httpx.TransportError)):
+        return True
+    status = getattr(exc, "status_code", None) or getattr(getattr(exc, "response", None), "status_code", None)
+    if status in TRANSIENT_LLM_STATUS:
+        return True
+    return bool(TRANSIENT_LLM_MESSAGE.search(str(exc)))
+
+class LlmDeadline:
+    """End-to-end budget for one call_llm, retries included.
+
+    It starts when the scheduler first grants a slot: waiting in our own
+    queue is bounded by LLM_QUEUE_TIMEOUT_SECONDS and fails as overload
+    (503), so it never reads as a slow upstream.
+    """
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = None
+
+    def start(self) -> float:
+        if self.expires_at is None:
+            self.expires_at = asyncio.get_running_loop().time() + self.seconds
+        return self.expires_at
+
+    def remaining(self) -> float:
+        if self.expires_at is None:
+            return self.seconds
+        return self.expires_at - asyncio.get_running_loop().time()
+
+async def send_llm_request(stage: str, model: str, make_request) -> str:
+    """One upstream request; the caller holds a scheduler slot"""
+    chat, message = make_request()
+    started = time.perf_counter()
+    with stage_timer(stage, model):
+        response = await chat.send_message(message)
+    llm_latency.add(stage, time.perf_counter() - started)
+    return response
+
+async def send_slotted_llm_request(stage: str, model: str, plan_info: dict, make_request) -> str:
+    async with llm_scheduler.slot(plan_info):
+        return await send_llm_request(stage, model, make_request)
+
+async def send_hedged_llm_request(stage: str, model: str, plan_info: dict, make_request, deadline: LlmDeadline) -> str:
+    """First successful response wins; the slower request is cancelled"""
+    loop = asyncio.get_running_loop()
+    async with llm_scheduler.slot(plan_info):
+        expires_at = deadline.start()
+        if loop.time() >= expires_at:
+            # A retry that spent the rest of the budget in our queue never reached upstream
+            raise HTTPException(status_code=504, detail="AI service timed out")
+        primary = asyncio.ensure_future(send_llm_request(stage, model, make_request))
+        tasks = [primary]
+        hedged = False
+        error = None
+        try:
+            hedge_delay = llm_latency.percentile(stage, LLM_HEDGE_PERCENTILE) if LLM_HEDGE_PERCENTILE > 0 else None
+            if hedge_delay is not None and loop.time() + hedge_delay < expires_at:
+                done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+                # Only hedge into spare capacity; a hedge that has to queue just adds load
+                if not done and llm_scheduler.has_capacity():
+                    tasks.append(asyncio.ensure_future(send_slotted_llm_request(stage, model, plan_info, make_request)))
+                    hedged = True
+            
+            while tasks:
+                done, _ = await asyncio.wait(
+                    tasks,
+                    timeout=max(0, expires_at - loop.time()),
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    raise asyncio.TimeoutError()
+                for task in done:
+                    tasks.remove(task)
+                    if task.exception() is None:
+                        if hedged:
+                            llm_hedges.inc(stage, model, "primary" if task is primary else "hedge")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+async def call_llm(stage: str, model: str, plan_info: Optional[dict], make_request) -> str:
+    """Send one LLM request with a deadline, hedging, retries and the circuit breaker.
+
+    make_request() returns a fresh (chat, message) pair so that a hedge or a
+    retry never shares chat history with another attempt.
+    """
+    plan_info = plan_info or PLANS["standard"]
+    breaker = llm_breaker(model)
+    deadline = LlmDeadline(LLM_TIMEOUT_SECONDS)
+    attempt = 0
+    while True:
+        breaker.check()
+        try:
+            response = await send_hedged_llm_request(stage, model, plan_info, make_request, deadline)
+        except HTTPException:
+            # Our own overload signal (scheduler queue), not an upstream failure
+            breaker.abandon()
+            raise
+        except asyncio.CancelledError:
+            breaker.abandon()
+            raise
+        except Exception as e:
+            breaker.record(False)
+            llm_errors.inc(stage, model)
+            backoff = LLM_RETRY_BACKOFF_SECONDS * (2 ** attempt) * random.uniform(0.5, 1.5)
+            retryable = is_transient_llm_error(e) and backoff < deadline.remaining()
+            if attempt >= LLM_MAX_RETRIES or not retryable:
+                if isinstance(e, asyncio.TimeoutError):
+                    raise HTTPException(status_code=504, detail="AI service timed out")
+                raise
+            print(f"Retrying {stage} after transient error: {e}")
+            llm_retries.inc(stage, model)
+            attempt += 1
+            await asyncio.sleep(backoff)
+            continue
+        breaker.record(True)
+        return response
+
 # Authentication dependency
 async def get_current_user(authorization: Optional[str] = Header(None)) -> Optional[User]:
     if not authorization:
         raise HTTPException(status_code=401, detail="No authorization header provided")
     
-    # Extract token
-    if authorization.startswith("Bearer "):
-        session_token = authorization.replace("Bearer ", "")
-    else:
-        session_token = authorization
+    session_token = extract_session_token(authorization)
+    
+    cached_user = user_cache.get(session_token)
+    if cached_user is not None:
+        return cached_user
     
+    started = time.perf_counter()
     try:
         # Check session
-        session = user_sessions_collection.find_one(
+        session = await user_sessions_collection.find_one(
             {"session_token": session_token},
             {"_id": 0}
         )
@@ -195,7 +1115,7 @@ async def get_current_user(authorization: Optional[str] = Header(None)) -> Optio
             raise HTTPException(status_code=401, detail="Session expired")
         
         # Get user
-        user_doc = users_collection.find_one(
+        user_doc = await users_collection.find_one(
             {"user_id": session["user_id"]},
             {"_id": 0}
         )
@@ -203,15 +1123,189 @@ async def get_current_user(authorization: Optional[str] = Header(None)) -> Optio
         if not user_doc:
             raise HTTPException(status_code=404, detail="User not found")
         
-        return User(**user_doc)
+        user = User(**user_doc)
+        user_cache.set(session_token, user, expires_at=expires_at.timestamp())
+        return user
     except HTTPException:
         raise
     except Exception as e:
         print(f"Auth error: {e}")
         raise HTTPException(status_code=500, detail="Authentication error")
+    finally:
+        observe_stage("auth", time.perf_counter() - started)
+
+# Per-user rate limiting
+class UserUsage:
+    __slots__ = ("tokens", "refilled_at", "day", "minute", "day_count", "minute_count", "unsynced", "last_seen")
+
+    def __init__(self, burst: int):
+        self.tokens = float(burst)
+        self.refilled_at = time.monotonic()
+        self.day = ""
+        self.minute = ""
+        # Totals across all workers as of the last sync, plus this worker's usage since
+        self.day_count = 0
+        self.minute_count = 0
+        # (day, minute) -> usage not yet pushed to Mongo, so it lands under the minute it happened in
+        self.unsynced = {}
+        self.last_seen = 0.0
+
+class RateLimiter:
+    """Token bucket per user, with per-minute and per-day totals shared across workers.
+
+    Decisions are made from in-process state only. A background task pushes
+    each user's new usage to Mongo with one atomic $inc per sync interval and
+    reads back the totals from every worker, so limits hold across workers to
+    within RATE_LIMIT_SYNC_SECONDS.
+    """
+
+    def __init__(self, sync_interval: float):
+        self.sync_interval = sync_interval
+        self.users = {}
+        self.limited = 0
+        self._worker = None
+
+    def check(self, user_id: str, limits: dict, cost: int = 1) -> dict:
+        """Consume one request or raise 429; returns the rate-limit headers.
+
+        A batch request takes one token from the bucket but counts cost
+        analyses against the per-minute and per-day totals. The headers
+        describe whichever of the day, minute and bucket quotas has the least
+        left, so Limit, Remaining and Reset always belong to the same quota.
+        """
+        now = datetime.now(timezone.utc)
+        day = now.strftime("%Y-%m-%d")
+        minute = now.strftime("%H%M")
+        usage = self.users.get(user_id)
+        if usage is None:
+            usage = self.users[user_id] = UserUsage(limits["burst"])
+        if usage.day != day:
+            usage.day, usage.day_count = day, 0
+        if usage.minute != minute:
+            usage.minute, usage.minute_count = minute, 0
+        
+        per_minute = limits["requests_per_minute"]
+        monotonic_now = time.monotonic()
+        usage.tokens = min(
+            limits["burst"],
+            usage.tokens + (monotonic_now - usage.refilled_at) * per_minute / 60
+        )
+        usage.refilled_at = monotonic_now
+        usage.last_seen = monotonic_now
+        
+        seconds_to_minute = 60 - now.second
+        seconds_to_day = int((datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), timezone.utc) - now).total_seconds()) + 1
+        if usage.day_count + cost > limits["requests_per_day"]:
+            retry_after, limit, reset = seconds_to_day, limits["requests_per_day"], seconds_to_day
+        elif usage.minute_count + cost > per_minute:
+            retry_after, limit, reset = seconds_to_minute, per_minute, seconds_to_minute
+        elif usage.tokens < 1:
+            retry_after = math.ceil((1 - usage.tokens) * 60 / per_minute)
+            limit, reset = limits["burst"], retry_after
+        else:
+            usage.tokens -= 1
+            usage.day_count += cost
+            usage.minute_count += cost
+            usage.unsynced[(day, minute)] = usage.unsynced.get((day, minute), 0) + cost
+            # (remaining, limit, reset) per quota; the first with the least left wins ties
+            quotas = [
+                (limits["requests_per_day"] - usage.day_count, limits["requests_per_day"], seconds_to_day),
+                (per_minute - usage.minute_count, per_minute, seconds_to_minute),
+                (int(usage.tokens), limits["burst"], math.ceil((limits["burst"] - usage.tokens) * 60 / per_minute))
+            ]
+            remaining, limit, reset = min(quotas, key=lambda quota: quota[0])
+            return {
+                "X-RateLimit-Limit": str(limit),
+                "X-RateLimit-Remaining": str(max(0, remaining)),
+                "X-RateLimit-Reset": str(reset)
+            }
+        
+        self.limited += 1
+        raise HTTPException(
+            status_code=429,
+            detail="Rate limit exceeded, please slow down",
+            headers={
+                "Retry-After": str(retry_after),
+                "X-RateLimit-Limit": str(limit),
+                "X-RateLimit-Remaining": "0",
+                "X-RateLimit-Reset": str(reset)
+            }
+        )
+
+    def start(self):
+        self._worker = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        await self.sync()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.sync()
+            except Exception as e:
+                print(f"Rate limit sync error: {e}")
+
+    async def sync(self):
+        idle_before = time.monotonic() - 2 * 24 * 3600
+        for user_id, usage in list(self.users.items()):
+            if not usage.unsynced:
+                if usage.last_seen < idle_before:
+                    del self.users[user_id]
+                continue
+            pending, usage.unsynced = usage.unsynced, {}
+            by_day = {}
+            for (day, minute), amount in pending.items():
+                by_day.setdefault(day, {})[minute] = amount
+            for day, minutes in sorted(by_day.items()):
+                increments = {f"minutes.{minute}": amount for minute, amount in minutes.items()}
+                increments["count"] = sum(minutes.values())
+                try:
+                    counters = await rate_limits_collection.find_one_and_update(
+                        {"_id": f"{user_id}:{day}"},
+                        {
+                            "$inc": increments,
+                            "$setOnInsert": {"expires_at": datetime.now(timezone.utc) + timedelta(days=2)}
+                        },
+                        upsert=True,
+                        return_document=ReturnDocument.AFTER
+                    )
+                except Exception:
+                    # Keep this day's usage and any later day's for the next sync
+                    for (pending_day, minute), amount in pending.items():
+                        if pending_day >= day:
+                            key = (pending_day, minute)
+                            usage.unsynced[key] = usage.unsynced.get(key, 0) + amount
+                    raise
+                # Requests admitted while the update was in flight are still unsynced
+                if usage.day == day:
+                    usage.day_count = counters["count"] + sum(
+                        amount for (pending_day, _), amount in usage.unsynced.items() if pending_day == day
+                    )
+                    usage.minute_count = (
+                        counters.get("minutes", {}).get(usage.minute, 0)
+                        + usage.unsynced.get((day, usage.minute), 0)
+                    )
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self.users),
+            "unsynced": sum(sum(usage.unsynced.values()) for usage in self.users.values()),
+            "limited": self.limited
+        }
+
+rate_limiter = RateLimiter(RATE_LIMIT_SYNC_SECONDS)
 
 # Check subscription and plan limits
-def check_subscription_and_limits(user: User, required_plan: str = None) -> dict:
+def check_subscription_and_limits(user: User, required_plan: str = None, cost: int = 1) -> dict:
     if not user.subscription_plan:
         raise HTTPException(status_code=402, detail="Subscription required")
     
@@ -226,6 +1320,7 @@ def check_subscription_and_limits(user: User, required_plan: str = None) -> dict
     plan_info = PLANS.get(user.subscription_plan)
     if not plan_info:
         raise HTTPException(status_code=400, detail="Invalid subscription plan")
+    metrics_plan.set(user.subscription_plan)
     
     # Check if user has required plan level
     if required_plan:
@@ -239,22 +1334,77 @@ def check_subscription_and_limits(user: User, required_plan: str = None) -> dict
                 detail=f"This feature requires {PLANS[required_plan]['name']} plan or higher"
             )
     
+    # cost=0 for reads that make no LLM calls
+    if RATE_LIMIT_ENABLED and cost:
+        headers = rate_limiter.check(user.user_id, plan_info["rate_limit"], cost)
+        collected = response_headers.get()
+        if collected is not None:
+            collected.update(headers)
+    
     return plan_info
 
-# Helper function to create AI suggestions
-async def generate_suggestions(
-    conversation_context: str,
-    tone: str,
-    goal: str,
-    plan_info: dict,
-    is_image: bool = False
-) -> dict:
-    """Generate AI-powered response suggestions based on plan"""
+# Suggestion result cache
+def suggestion_cache_key(conversation_context: str, tone: str, goal: str, plan_info: dict) -> str:
+    """Hash of the normalized inputs that fully determine a suggestions prompt"""
+    normalized_context = "\n".join(
+        re.sub(r"\s+", " ", line).strip()
+        for line in conversation_context.strip().splitlines()
+        if line.strip()
+    )
+    key_source = "\x1f".join([
+        normalized_context,
+        tone.strip().lower(),
+        goal.strip().lower(),
+        plan_info["ai_model"],
+        str(plan_info["suggestions_count"]),
+        str(plan_info["prompt_token_budget"])
+    ])
+    return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+async def get_cached_suggestions(cache_key: str) -> Optional[dict]:
+    result = suggestion_cache.get(cache_key)
+    if result is not None:
+        cache_lookups.inc("suggestion", "memory_hit")
+        return result
     
-    suggestions_count = plan_info["suggestions_count"]
+    try:
+        cached = await suggestion_cache_collection.find_one({"_id": cache_key})
+    except Exception as e:
+        print(f"Suggestion cache read error: {e}")
+        return None
+    
+    if not cached:
+        cache_lookups.inc("suggestion", "miss")
+        return None
+    
+    cache_lookups.inc("suggestion", "mongo_hit")
     
+    result = {
+        "analysis": cached["analysis"],
+        "suggestions": cached["suggestions"],
+        "raw_response": cached["raw_response"],
+        "prompt_stats": cached.get("prompt_stats")
+    }
+    suggestion_cache.set(cache_key, result)
+    return result
+
+async def store_cached_suggestions(cache_key: str, result: dict):
+    suggestion_cache.set(cache_key, result)
+    try:
+        await suggestion_cache_collection.replace_one(
+            {"_id": cache_key},
+            {**result, "created_at": datetime.utcnow()},
+            upsert=True
+        )
+    except Exception as e:
+        print(f"Suggestion cache write error: {e}")
+
+# Suggestions prompt and response format
+SUGGESTIONS_USER_PROMPT = "Please provide your analysis and suggestions."
+
+def build_suggestions_prompt(conversation_context: str, tone: str, goal: str, suggestions_count: int) -> str:
     # Create system message based on tone and goal
-    system_message = f"""You are a professional social skills coach helping users improve their communication.
+    return f"""You are a professional social skills coach helping users improve their communication.
 
 Current Conversation Context: {conversation_context}
 
@@ -275,43 +1425,235 @@ SUGGESTION 2: [response] - [reason]
 {'SUGGESTION 5: [response] - [reason]' if suggestions_count >= 5 else ''}
 """
 
-    try:
-        # Create new chat instance for this request
-        chat = LlmChat(
-            api_key=EMERGENT_LLM_KEY,
-            session_id=generate_session_id("system"),
-            system_message=system_message
-        ).with_model("openai", plan_info["ai_model"])
+# Token-budgeted conversation context
+PROMPT_CHARS_PER_TOKEN = 4
+# Share of the budget kept for the newest turns verbatim; older turns get the rest, shortened
+PROMPT_VERBATIM_SHARE = float(os.getenv("PROMPT_VERBATIM_SHARE", "0.7"))
+PROMPT_COMPRESSED_TURN_CHARS = int(os.getenv("PROMPT_COMPRESSED_TURN_CHARS", "80"))
 
-        # Send message
-        response = await chat.send_message(UserMessage(text="Please provide your analysis and suggestions."))
-        
-        # Parse response
-        analysis_text = ""
-        suggestions = []
-        
-        lines = response.split('\n')
+def estimate_tokens(text: str) -> int:
+    """Rough token count; about 4 characters per token for English chat text"""
+    return math.ceil(len(text) / PROMPT_CHARS_PER_TOKEN)
+
+def compress_turn(turn: str) -> str:
+    turn = re.sub(r"\s+", " ", turn)
+    if len(turn) <= PROMPT_COMPRESSED_TURN_CHARS:
+        return turn
+    return turn[:PROMPT_COMPRESSED_TURN_CHARS].rsplit(" ", 1)[0] + "…"
+
+def budget_conversation(conversation_context: str, budget_tokens: int) -> tuple:
+    """Fit the conversation into budget_tokens; returns (context, stats).
+
+    Each line is a turn. The newest turns are kept verbatim up to
+    PROMPT_VERBATIM_SHARE of the budget, older turns are shortened to
+    PROMPT_COMPRESSED_TURN_CHARS, and the oldest ones that still do not fit
+    are replaced by a count of omitted messages. The newest turn is always
+    kept, cut to its end only if it alone exceeds the whole budget.
+    """
+    turns = [line.strip() for line in conversation_context.strip().splitlines() if line.strip()]
+    input_tokens = estimate_tokens(conversation_context)
+    stats = {
+        "budget_tokens": budget_tokens,
+        "input_tokens": input_tokens,
+        "context_tokens": input_tokens,
+        "turns": len(turns),
+        "verbatim_turns": len(turns),
+        "compressed_turns": 0,
+        "omitted_turns": 0
+    }
+    if input_tokens <= budget_tokens:
+        return conversation_context, stats
+    
+    verbatim_budget = budget_tokens * PROMPT_VERBATIM_SHARE
+    verbatim = []
+    compressed = []
+    used = 0
+    index = len(turns) - 1
+    
+    newest = turns[index]
+    if estimate_tokens(newest) + 1 > budget_tokens:
+        # A single oversized turn gets the whole budget: keep as much of its end as fits
+        keep = max((budget_tokens - 1) * PROMPT_CHARS_PER_TOKEN - 1, 0)
+        newest = "…" + newest[len(newest) - keep:]
+        compressed.append(newest)
+    else:
+        # Kept whole even past the verbatim share; older turns only get what is left
+        verbatim.append(newest)
+    used += estimate_tokens(newest) + 1
+    index -= 1
+    
+    while index >= 0 and not compressed:
+        cost = estimate_tokens(turns[index]) + 1
+        if used + cost > verbatim_budget:
+            break
+        verbatim.append(turns[index])
+        used += cost
+        index -= 1
+    
+    while index >= 0:
+        turn = compress_turn(turns[index])
+        cost = estimate_tokens(turn) + 1
+        if used + cost > budget_tokens:
+            break
+        compressed.append(turn)
+        used += cost
+        index -= 1
+    
+    omitted = index + 1
+    parts = [f"[{omitted} earlier messages omitted]"] if omitted else []
+    parts.extend(reversed(compressed))
+    parts.extend(reversed(verbatim))
+    context = "\n".join(parts)
+    stats.update({
+        "context_tokens": estimate_tokens(context),
+        "verbatim_turns": len(verbatim),
+        "compressed_turns": len(compressed),
+        "omitted_turns": omitted
+    })
+    return context, stats
+
+def build_budgeted_suggestions_prompt(conversation_context: str, tone: str, goal: str, plan_info: dict) -> tuple:
+    """Suggestions system prompt with the context cut to the plan's token budget; returns (prompt, stats)"""
+    context, prompt_stats = budget_conversation(conversation_context, plan_info["prompt_token_budget"])
+    return build_suggestions_prompt(context, tone, goal, plan_info["suggestions_count"]), prompt_stats
+
+def create_suggestions_chat(system_message: str, plan_info: dict) -> LlmChat:
+    return LlmChat(
+        api_key=EMERGENT_LLM_KEY,
+        session_id=generate_session_id("system"),
+        system_message=system_message
+    ).with_model("openai", plan_info["ai_model"])
+
+class SuggestionStreamParser:
+    """Line-based ANALYSIS:/SUGGESTION parser that accepts the response in arbitrary chunks"""
+
+    def __init__(self, suggestions_count: int):
+        self.suggestions_count = suggestions_count
+        self.analysis_text = ""
+        self.suggestions = []
+        self.image_context = None
+        self._in_image_context = False
+        self._buffer = ""
+
+    def feed(self, chunk: str) -> list:
+        """Consume a chunk and return the (event, data) pairs for every line it completed"""
+        self._buffer += chunk
+        *lines, self._buffer = self._buffer.split('\n')
+        events = []
         for line in lines:
-            if line.startswith("ANALYSIS:"):
-                analysis_text = line.replace("ANALYSIS:", "").strip()
-            elif line.startswith("SUGGESTION"):
-                suggestion = line.split(":", 1)[1].strip() if ":" in line else line
-                suggestions.append(suggestion)
-        
-        return {
-            "analysis": analysis_text or "Analysis completed successfully.",
-            "suggestions": suggestions[:suggestions_count],
-            "raw_response": response
+            events.extend(self._parse_line(line))
+        return events
+
+    def close(self) -> list:
+        """Parse whatever is left after the final newline"""
+        line, self._buffer = self._buffer, ""
+        return self._parse_line(line)
+
+    def result(self, raw_response: str) -> dict:
+        result = {
+            "analysis": self.analysis_text or "Analysis completed successfully.",
+            "suggestions": self.suggestions[:self.suggestions_count],
+            "raw_response": raw_response
         }
+        if self.image_context is not None:
+            result["image_context"] = self.image_context
+        return result
+
+    def _parse_line(self, line: str) -> list:
+        if line.startswith("IMAGE CONTEXT:"):
+            self.image_context = line.replace("IMAGE CONTEXT:", "").strip()
+            self._in_image_context = True
+            return [("status", {"stage": "image_analyzed"})]
+        if self._in_image_context:
+            # The description may run over several lines until ANALYSIS:
+            if not line.startswith(("ANALYSIS:", "SUGGESTION")):
+                self.image_context = f"{self.image_context}\n{line}".strip()
+                return []
+            self._in_image_context = False
+        if line.startswith("ANALYSIS:"):
+            self.analysis_text = line.replace("ANALYSIS:", "").strip()
+            return [("analysis", {"analysis_text": self.analysis_text})]
+        if line.startswith("SUGGESTION"):
+            suggestion = line.split(":", 1)[1].strip() if ":" in line else line
+            self.suggestions.append(suggestion)
+            if len(self.suggestions) <= self.suggestions_count:
+                return [("suggestion", {"index": len(self.suggestions) - 1, "text": suggestion})]
+        return []
+
+def parse_suggestions_response(response: str, suggestions_count: int) -> dict:
+    parser = SuggestionStreamParser(suggestions_count)
+    parser.feed(response)
+    parser.close()
+    return parser.result(response)
+
+# Helper function to create AI suggestions
+async def generate_suggestions(
+    conversation_context: str,
+    tone: str,
+    goal: str,
+    plan_info: dict,
+    is_image: bool = False,
+    use_cache: bool = True
+) -> dict:
+    """Generate AI-powered response suggestions based on plan"""
+    
+    cache_key = suggestion_cache_key(conversation_context, tone, goal, plan_info)
+    if use_cache:
+        cached_result = await get_cached_suggestions(cache_key)
+        if cached_result is not None:
+            return cached_result
+    
+    return await llm_flights.do(
+        ("suggestions", cache_key),
+        lambda: request_suggestions(conversation_context, tone, goal, plan_info, cache_key)
+    )
+
+async def request_suggestions(
+    conversation_context: str,
+    tone: str,
+    goal: str,
+    plan_info: dict,
+    cache_key: str
+) -> dict:
+    """Run the suggestions LLM call and store the parsed result in the cache"""
+    
+    suggestions_count = plan_info["suggestions_count"]
+    system_message, prompt_stats = build_budgeted_suggestions_prompt(conversation_context, tone, goal, plan_info)
+
+    try:
+        # New chat instance per attempt
+        response = await call_llm(
+            "suggestions_llm",
+            plan_info["ai_model"],
+            plan_info,
+            lambda: (create_suggestions_chat(system_message, plan_info), UserMessage(text=SUGGESTIONS_USER_PROMPT))
+        )
+        
+        with stage_timer("parse", plan_info["ai_model"]):
+            result = parse_suggestions_response(response, suggestions_count)
+        result["prompt_stats"] = prompt_stats
+        await store_cached_suggestions(cache_key, result)
+        return result
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error generating suggestions: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to generate suggestions: {str(e)}")
 
 # Helper function to analyze image
-async def analyze_image_content(image_base64: str, context: Optional[str] = None) -> str:
+async def analyze_image_content(image_base64: str, context: Optional[str] = None, plan_info: Optional[dict] = None) -> str:
     """Use AI vision to analyze image and extract conversation context"""
     
+    flight_key = hashlib.sha256(f"{image_base64}\x1f{context or ''}".encode("utf-8")).hexdigest()
+    return await llm_flights.do(
+        ("vision", flight_key),
+        lambda: request_image_analysis(image_base64, context, plan_info)
+    )
+
+async def request_image_analysis(image_base64: str, context: Optional[str] = None, plan_info: Optional[dict] = None) -> str:
+    """Run the vision LLM call for a single image"""
+    
     system_message = """You are analyzing an image to help understand social context.
 This could be:
 - A screenshot of a text conversation
@@ -322,155 +1664,2223 @@ This could be:
 Extract all visible text, describe the visual content, and identify any emotional tone or context.
 Be concise but thorough."""
 
-    try:
+    prompt = "Analyze this image and extract all text, describe the content, and identify any social context or emotional tone."
+    if context:
+        prompt += f"\n\nAdditional context provided by user: {context}"
+
+    def make_request():
         chat = LlmChat(
             api_key=EMERGENT_LLM_KEY,
             session_id=generate_session_id("vision"),
             system_message=system_message
-        ).with_model("openai", "gpt-5.2")
+        ).with_model("openai", VISION_MODEL)
+        message = UserMessage(
+            text=prompt,
+            file_contents=[ImageContent(image_base64=image_base64)]
+        )
+        return chat, message
+
+    try:
+        return await call_llm("vision_llm", VISION_MODEL, plan_info, make_request)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error analyzing image: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to analyze image: {str(e)}")
+
+# Single-call image pipeline
+IMAGE_SUGGESTIONS_USER_PROMPT = "Please analyze this image and provide your analysis and suggestions."
+
+def build_image_suggestions_prompt(context: Optional[str], tone: str, goal: str, suggestions_count: int) -> str:
+    user_context = f"Additional context provided by user: {context}\n\n" if context else ""
+    return f"""You are a professional social skills coach helping users improve their communication.
+
+The user has shared an image. This could be:
+- A screenshot of a text conversation
+- A social media post/story
+- A photo someone shared
+- A profile picture
+
+{user_context}User's Desired Tone: {tone}
+User's Goal: {goal}
+
+Provide:
+1. All visible text in the image, a description of the visual content, and any emotional tone or context
+2. A brief analysis of the current situation (2-3 sentences)
+3. {suggestions_count} different response suggestions that match the desired tone and achieve the goal
+4. Brief explanation for each suggestion (1 sentence)
+
+Format your response as:
+IMAGE CONTEXT: [extracted text and description]
+ANALYSIS: [your analysis]
+SUGGESTION 1: [response] - [reason]
+SUGGESTION 2: [response] - [reason]
+{'SUGGESTION 3: [response] - [reason]' if suggestions_count >= 3 else ''}
+{'SUGGESTION 4: [response] - [reason]' if suggestions_count >= 4 else ''}
+{'SUGGESTION 5: [response] - [reason]' if suggestions_count >= 5 else ''}
+"""
+
+def create_image_suggestions_request(image: dict, context: Optional[str], tone: str, goal: str, plan_info: dict) -> tuple:
+    system_message = build_image_suggestions_prompt(context, tone, goal, plan_info["suggestions_count"])
+    chat = create_suggestions_chat(system_message, plan_info)
+    message = UserMessage(
+        text=IMAGE_SUGGESTIONS_USER_PROMPT,
+        file_contents=[ImageContent(image_base64=image["image_base64"])]
+    )
+    return chat, message
+
+async def generate_image_suggestions(
+    image: dict,
+    context: Optional[str],
+    tone: str,
+    goal: str,
+    plan_info: dict,
+    user_id: str,
+    use_cache: bool = True
+) -> dict:
+    """Suggestions for an image in one LLM call; the result also carries image_context"""
+    
+    if use_cache:
+        # A known image only needs the text suggestions call, which may itself be cached
+        cached_context = await find_cached_image_context(image, context, user_id)
+        if cached_context is not None:
+            result = await generate_suggestions(cached_context, tone, goal, plan_info, is_image=True)
+            return {**result, "image_context": cached_context}
+    
+    flight_key = hashlib.sha256("\x1f".join([
+        image["image_base64"],
+        context or "",
+        tone,
+        goal,
+        plan_info["ai_model"],
+        str(plan_info["suggestions_count"])
+    ]).encode("utf-8")).hexdigest()
+    # Copied since coalesced callers share the flight's result
+    result = dict(await llm_flights.do(
+        ("image_suggestions", flight_key),
+        lambda: request_image_suggestions(image, context, tone, goal, plan_info)
+    ))
+    if "image_context" in result:
+        await store_cached_image_context(image, context, user_id, result["image_context"])
+    else:
+        result["image_context"] = result["analysis"]
+    return result
+
+async def request_image_suggestions(
+    image: dict,
+    context: Optional[str],
+    tone: str,
+    goal: str,
+    plan_info: dict
+) -> dict:
+    try:
+        response = await call_llm(
+            "image_suggestions_llm",
+            plan_info["ai_model"],
+            plan_info,
+            lambda: create_image_suggestions_request(image, context, tone, goal, plan_info)
+        )
+        
+        with stage_timer("parse", plan_info["ai_model"]):
+            return parse_suggestions_response(response, plan_info["suggestions_count"])
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error generating image suggestions: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to generate suggestions: {str(e)}")
+
+# Perceptual-hash image context cache
+def dhash_bands(dhash: int, max_distance: int) -> List[str]:
+    """Split the hash into max_distance + 1 bands.
+
+    Two hashes within max_distance bits of each other must agree exactly on
+    at least one band, so an indexed $in over the bands finds every
+    candidate neighbour without scanning the collection.
+    """
+    band_count = max_distance + 1
+    bands = []
+    for i in range(band_count):
+        start = i * 64 // band_count
+        end = (i + 1) * 64 // band_count
+        band_value = (dhash >> start) & ((1 << (end - start)) - 1)
+        bands.append(f"{band_count}:{i}:{band_value:x}")
+    return bands
+
+def image_context_key(context: Optional[str], user_id: str) -> str:
+    """Entries are per user, so one user's conversation is never served to another"""
+    normalized = re.sub(r"\s+", " ", context or "").strip().lower()
+    return hashlib.sha256(f"{user_id}\x1f{normalized}".encode("utf-8")).hexdigest()
+
+async def find_cached_image_context(image: dict, context: Optional[str], user_id: str) -> Optional[str]:
+    """Context of an earlier image from this user showing the same picture.
+
+    The dHash bands only narrow the search: screenshots sharing a bubble
+    layout hash alike whatever their text, so a hit also needs the aligned
+    thumbnails to agree block by block (see thumbnail_distance).
+    """
+    if not image.get("thumbnail"):
+        return None
+    try:
+        candidates = await image_context_cache_collection.find(
+            {
+                "context_key": image_context_key(context, user_id),
+                "bands": {"$in": dhash_bands(image["dhash"], IMAGE_CONTEXT_HASH_MAX_DISTANCE)}
+            },
+            {"dhash": 1, "thumbnail": 1, "image_context": 1}
+        ).to_list(length=50)
+    except Exception as e:
+        print(f"Image context cache read error: {e}")
+        return None
+    
+    # The bands also admit hashes further apart than the limit; drop those, then confirm
+    # only the nearest few, off the event loop, since each comparison is CPU work
+    nearby = []
+    for candidate in candidates:
+        distance = bin(int(candidate["dhash"], 16) ^ image["dhash"]).count("1")
+        if candidate.get("thumbnail") and distance <= IMAGE_CONTEXT_HASH_MAX_DISTANCE:
+            nearby.append((distance, candidate))
+    nearby.sort(key=lambda pair: pair[0])
+    candidates = [candidate for _, candidate in nearby[:IMAGE_CONTEXT_MAX_COMPARISONS]]
+    hit = await asyncio.to_thread(
+        lambda: next(
+            (c for c in candidates
+             if thumbnail_distance(image["thumbnail"], c["thumbnail"]) <= IMAGE_CONTEXT_THUMBNAIL_MAX_DISTANCE),
+            None
+        )
+    )
+    cache_lookups.inc("image_context", "hit" if hit else "miss")
+    return hit["image_context"] if hit else None
+
+async def store_cached_image_context(image: dict, context: Optional[str], user_id: str, image_context: str):
+    if not image.get("thumbnail"):
+        return
+    try:
+        await image_context_cache_collection.insert_one({
+            "dhash": f"{image['dhash']:016x}",
+            "bands": dhash_bands(image["dhash"], IMAGE_CONTEXT_HASH_MAX_DISTANCE),
+            "thumbnail": image["thumbnail"],
+            "context_key": image_context_key(context, user_id),
+            "image_context": image_context,
+            "created_at": datetime.utcnow()
+        })
+    except Exception as e:
+        print(f"Image context cache write error: {e}")
+
+async def extract_image_context(
+    image: dict,
+    context: Optional[str],
+    user_id: str,
+    use_cache: bool = True,
+    plan_info: Optional[dict] = None
+) -> str:
+    """Vision step, skipped when this user already sent the same picture"""
+    if use_cache:
+        cached_context = await find_cached_image_context(image, context, user_id)
+        if cached_context is not None:
+            return cached_context
+    
+    image_context = await analyze_image_content(image["image_base64"], context, plan_info)
+    await store_cached_image_context(image, context, user_id, image_context)
+    return image_context
+
+# Index management
+# (collection name, keys, options); the key pattern identifies an index when checking for missing ones
+INDEXES = [
+    ("user_sessions", [("session_token", 1)], {"unique": True}),
+    # Mongo deletes sessions once expires_at has passed
+    ("user_sessions", [("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ("users", [("user_id", 1)], {"unique": True}),
+    ("users", [("email", 1)], {"unique": True}),
+    ("analyses", [("user_id", 1), ("created_at", -1), ("_id", -1)], {}),
+    ("analyses", [("user_id", 1), ("image_ref", 1)], {}),
+    ("suggestion_cache", [("created_at", 1)], {"expireAfterSeconds": SUGGESTION_CACHE_TTL_SECONDS}),
+    ("image_context_cache", [("context_key", 1), ("bands", 1)], {}),
+    ("image_context_cache", [("created_at", 1)], {"expireAfterSeconds": IMAGE_CONTEXT_CACHE_TTL_SECONDS}),
+    ("rate_limits", [("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ("user_stats_daily", [("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ("analysis_jobs", [("status", 1), ("lease_expires_at", 1)], {}),
+    # Finished jobs only; queued and running jobs have no expires_at
+    ("analysis_jobs", [("expires_at", 1)], {"expireAfterSeconds": 0}),
+]
+
+def describe_index(collection_name: str, keys) -> str:
+    return f"{collection_name}({', '.join(f'{field}: {direction}' for field, direction in keys)})"
+
+async def find_missing_indexes() -> list:
+    existing = {}
+    missing = []
+    for collection_name, keys, options in INDEXES:
+        if collection_name not in existing:
+            index_info = await db[collection_name].index_information()
+            existing[collection_name] = {
+                tuple((field, int(direction)) for field, direction in index["key"])
+                for index in index_info.values()
+            }
+        if tuple(keys) not in existing[collection_name]:
+            missing.append((collection_name, keys, options))
+    return missing
+
+async def ensure_indexes():
+    """Create any missing indexes; safe to run repeatedly"""
+    missing = await find_missing_indexes()
+    if not missing:
+        print("All indexes present")
+        return
+    
+    print(f"Building {len(missing)} missing indexes")
+    for position, (collection_name, keys, options) in enumerate(missing, start=1):
+        description = describe_index(collection_name, keys)
+        print(f"[{position}/{len(missing)}] Building {description}...")
+        started = time.monotonic()
+        try:
+            await db[collection_name].create_index(keys, **options)
+        except Exception as e:
+            print(f"[{position}/{len(missing)}] Failed to build {description}: {e}")
+            continue
+        print(f"[{position}/{len(missing)}] Built {description} in {time.monotonic() - started:.1f}s")
+
+# Lifecycle
+@app.on_event("startup")
+async def check_indexes():
+    try:
+        missing = await find_missing_indexes()
+    except Exception as e:
+        print(f"Index check error: {e}")
+        return
+    
+    if missing:
+        print(f"Missing indexes: {', '.join(describe_index(c, k) for c, k, _ in missing)}")
+        if ENSURE_INDEXES_ON_STARTUP:
+            # Built in the background so a long index build does not hold up boot
+            asyncio.ensure_future(ensure_indexes())
+
+@app.on_event("startup")
+async def start_analysis_writer():
+    if not ANALYSIS_WRITE_BEHIND:
+        return
+    analysis_writer.start()
+    try:
+        replayed = await analysis_writer.replay_spool()
+        if replayed:
+            print(f"Replayed {replayed} spooled analyses")
+    except Exception as e:
+        print(f"Analysis spool replay error: {e}")
+
+@app.on_event("shutdown")
+async def stop_analysis_jobs():
+    # Registered before the writer's shutdown so the writer still flushes what jobs saved
+    await analysis_job_runner.stop()
+
+@app.on_event("shutdown")
+async def stop_analysis_writer():
+    await analysis_writer.stop()
+
+@app.on_event("startup")
+async def start_analysis_jobs():
+    # Registered after the analysis writer so spooled analyses are back first
+    analysis_job_runner.start()
+    try:
+        resumed = await analysis_job_runner.resume()
+        if resumed:
+            print(f"Resumed {resumed} analysis jobs")
+    except Exception as e:
+        print(f"Analysis job resume error: {e}")
+
+@app.on_event("startup")
+async def start_rate_limiter():
+    if RATE_LIMIT_ENABLED:
+        rate_limiter.start()
+
+@app.on_event("shutdown")
+async def stop_rate_limiter():
+    await rate_limiter.stop()
+
+@app.on_event("shutdown")
+async def close_mongo_client():
+    client.close()
+
+# Pooled HTTP client for the auth session exchange
+auth_http_client: Optional[httpx.AsyncClient] = None
+
+def get_auth_http_client() -> httpx.AsyncClient:
+    """The shared client; created on first use if startup has not run (e.g. scripts)"""
+    global auth_http_client
+    if auth_http_client is None or auth_http_client.is_closed:
+        auth_http_client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            timeout=httpx.Timeout(AUTH_HTTP_TIMEOUT_SECONDS, connect=AUTH_HTTP_CONNECT_TIMEOUT_SECONDS),
+            limits=httpx.Limits(
+                max_connections=AUTH_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=AUTH_HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=AUTH_HTTP_KEEPALIVE_EXPIRY_SECONDS
+            )
+        )
+    return auth_http_client
+
+@app.on_event("startup")
+async def open_auth_http_client():
+    get_auth_http_client()
+
+@app.on_event("shutdown")
+async def close_auth_http_client():
+    if auth_http_client is not None:
+        await auth_http_client.aclose()
+
+async def upsert_user(session_response: SessionDataResponse) -> str:
+    """Find or create the user by email in one round trip; returns user_id"""
+    new_user = {
+        "user_id": f"user_{uuid.uuid4().hex[:12]}",
+        "name": session_response.name,
+        "picture": session_response.picture,
+        "created_at": datetime.now(timezone.utc),
+        "subscription_plan": None,
+        "subscription_expires": None
+    }
+    for attempt in range(2):
+        try:
+            user = await users_collection.find_one_and_update(
+                {"email": session_response.email},
+                {"$setOnInsert": new_user},
+                projection={"_id": 0, "user_id": 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            return user["user_id"]
+        except DuplicateKeyError:
+            # A concurrent login inserted the same email first; the retry matches it
+            if attempt:
+                raise
+
+# API Routes
+@app.get("/")
+def read_root():
+    return {"message": "TalkTutor API is running", "version": "2.0.0"}
+
+# Auth endpoints
+@app.post("/api/auth/session")
+async def exchange_session_id(x_session_id: str = Header(...)):
+    """Exchange session_id for user data and session_token"""
+    try:
+        with stage_timer("auth_exchange"):
+            response = await get_auth_http_client().get(
+                AUTH_SESSION_API,
+                headers={"X-Session-ID": x_session_id}
+            )
+        
+        if response.status_code != 200:
+            raise HTTPException(status_code=401, detail="Invalid session ID")
+        
+        user_data = response.json()
+        session_response = SessionDataResponse(**user_data)
+        
+        user_id = await upsert_user(session_response)
+        
+        # Create session
+        session_doc = {
+            "user_id": user_id,
+            "session_token": session_response.session_token,
+            "expires_at": datetime.now(timezone.utc) + timedelta(days=7),
+            "created_at": datetime.now(timezone.utc)
+        }
+        await user_sessions_collection.insert_one(session_doc)
+        
+        return {
+            "user_id": user_id,
+            "email": session_response.email,
+            "name": session_response.name,
+            "picture": session_response.picture,
+            "session_token": session_response.session_token
+        }
+    
+    except HTTPException:
+        raise
+    except httpx.TransportError as e:
+        # Timeouts and connection failures reaching the auth service
+        print(f"Session exchange error: {e!r}")
+        raise HTTPException(status_code=503, detail="Authentication service unavailable")
+    except Exception as e:
+        print(f"Session exchange error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to exchange session")
+
+@app.get("/api/auth/me")
+async def get_me(current_user: User = Depends(get_current_user)):
+    """Get current user info"""
+    return current_user
+
+@app.post("/api/auth/logout")
+async def logout(current_user: User = Depends(get_current_user), authorization: str = Header(...)):
+    """Logout user"""
+    try:
+        session_token = extract_session_token(authorization)
+        user_cache.pop(session_token)
+        await user_sessions_collection.delete_one({"session_token": session_token})
+        return {"message": "Logged out successfully"}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail="Logout failed")
+
+# Content-addressed image store, keyed by SHA-256 of the image bytes
+class GridFSImageStore:
+    def __init__(self, database):
+        self.bucket = AsyncIOMotorGridFSBucket(database, bucket_name="images")
+        self.files = database["images.files"]
+
+    async def put(self, digest: str, data: bytes, content_type: str):
+        if await self.files.find_one({"_id": digest}, {"_id": 1}):
+            # Same bytes already stored
+            return
+        try:
+            await self.bucket.upload_from_stream_with_id(
+                digest,
+                digest,
+                data,
+                metadata={"content_type": content_type}
+            )
+        except FileExists:
+            # Stored concurrently by another request
+            pass
+
+    async def get(self, digest: str) -> Optional[bytes]:
+        try:
+            grid_out = await self.bucket.open_download_stream(digest)
+        except NoFile:
+            return None
+        return await grid_out.read()
+
+class FilesystemImageStore:
+    def __init__(self, root: str):
+        self.root = root
+
+    def path_for(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def write_file(self, digest: str, data: bytes):
+        path = self.path_for(digest)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def read_file(self, digest: str) -> Optional[bytes]:
+        try:
+            with open(self.path_for(digest), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    async def put(self, digest: str, data: bytes, content_type: str):
+        await asyncio.to_thread(self.write_file, digest, data)
+
+    async def get(self, digest: str) -> Optional[bytes]:
+        return await asyncio.to_thread(self.read_file, digest)
+
+def create_image_store():
+    if IMAGE_STORE_BACKEND == "filesystem":
+        return FilesystemImageStore(IMAGE_STORE_DIR)
+    if IMAGE_STORE_BACKEND == "gridfs":
+        return GridFSImageStore(db)
+    raise ValueError(f"Unknown IMAGE_STORE_BACKEND: {IMAGE_STORE_BACKEND}")
+
+image_store = create_image_store()
+
+def detect_image_content_type(image_bytes: bytes) -> str:
+    try:
+        with Image.open(BytesIO(image_bytes)) as img:
+            return Image.MIME.get(img.format, "application/octet-stream")
+    except Exception:
+        return "application/octet-stream"
+
+async def store_image(image_bytes: bytes, content_type: Optional[str] = None) -> dict:
+    """Store image bytes once and return the reference fields for an analyses document"""
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    content_type = content_type or detect_image_content_type(image_bytes)
+    await image_store.put(digest, image_bytes, content_type)
+    return {"image_ref": digest, "image_content_type": content_type}
+
+def image_url(image_ref: str) -> str:
+    return f"/api/images/{image_ref}"
+
+# Image preprocessing
+def compute_dhash(img: Image.Image) -> int:
+    """64-bit difference hash; stable across re-compression and resizing"""
+    pixels = list(img.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+def compute_context_thumbnail(img: Image.Image) -> bytes:
+    """Grayscale PNG thumbnail, aspect ratio kept, detailed enough to tell apart text in the same layout"""
+    width, height = img.size
+    thumbnail_height = min(4 * IMAGE_CONTEXT_THUMBNAIL_WIDTH, max(1, round(IMAGE_CONTEXT_THUMBNAIL_WIDTH * height / width)))
+    output = BytesIO()
+    img.convert("L").resize(
+        (IMAGE_CONTEXT_THUMBNAIL_WIDTH, thumbnail_height), Image.LANCZOS, reducing_gap=2.0
+    ).save(output, format="PNG")
+    return output.getvalue()
+
+def warped_difference(a: Image.Image, b: Image.Image, scale: float, shift_x: float, shift_y: float) -> Optional[Image.Image]:
+    """|a - b| over their overlap, with b scaled about its centre onto a's and then shifted.
+
+    None when less than 85% of a is covered in either direction, which bounds
+    how much cropping still counts as the same picture.
+    """
+    left = a.width / 2 + shift_x - b.width * scale / 2
+    top = a.height / 2 + shift_y - b.height * scale / 2
+    box = (
+        math.ceil(max(0, left)), math.ceil(max(0, top)),
+        math.floor(min(a.width, left + b.width * scale)), math.floor(min(a.height, top + b.height * scale))
+    )
+    if box[2] - box[0] < 0.85 * a.width or box[3] - box[1] < 0.85 * a.height:
+        return None
+    warped = b.transform(a.size, Image.AFFINE, (1 / scale, 0, -left / scale, 0, 1 / scale, -top / scale), Image.BILINEAR)
+    return ImageChops.difference(a.crop(box), warped.crop(box))
+
+def mean_warped_difference(a: Image.Image, b: Image.Image, params: tuple) -> float:
+    difference = warped_difference(a, b, *params)
+    return math.inf if difference is None else ImageStat.Stat(difference).mean[0]
+
+def align_thumbnails(a: Image.Image, b: Image.Image, params: list, steps: list) -> list:
+    """Pattern search over (scale, shift_x, shift_y) for the least mean difference"""
+    best = mean_warped_difference(a, b, params)
+    while steps[1] >= 0.25:
+        improved = False
+        for index in range(3):
+            for direction in (-1, 1):
+                trial = list(params)
+                trial[index] += direction * steps[index]
+                score = mean_warped_difference(a, b, trial)
+                if score < best:
+                    best, params, improved = score, trial, True
+        if not improved:
+            steps = [step / 2 for step in steps]
+    return params
+
+def thumbnail_distance(first: bytes, second: bytes) -> float:
+    """Largest mean 8x8-block grey-level difference between two context thumbnails once aligned.
+
+    Re-encoding, resizing and cropping shift and rescale a screenshot, so the
+    alignment is searched first: on quarter-size copies, where text lines blur
+    out and only the bubbles count, then refined at full size. Per-block
+    rather than overall difference, so one bubble of different text is not
+    averaged away.
+    """
+    a = Image.open(BytesIO(first)).filter(ImageFilter.GaussianBlur(1.2))
+    b = Image.open(BytesIO(second)).filter(ImageFilter.GaussianBlur(1.2))
+    small_a = a.resize((max(1, a.width // 4), max(1, a.height // 4)), Image.BOX)
+    small_b = b.resize((max(1, b.width // 4), max(1, b.height // 4)), Image.BOX)
+    scale, shift_x, shift_y = align_thumbnails(small_a, small_b, [1.0, 0.0, 0.0], [0.02, 1.0, 1.0])
+    params = align_thumbnails(a, b, [scale, shift_x * 4, shift_y * 4], [0.005, 1.0, 1.0])
+    
+    difference = warped_difference(a, b, *params)
+    if difference is None:
+        return math.inf
+    blocks = difference.resize((max(1, difference.width // 8), max(1, difference.height // 8)), Image.BOX)
+    return blocks.getextrema()[1]
+
+def preprocess_image(source) -> dict:
+    """Validate, strip metadata from, downsize and re-encode an uploaded image (bytes or a binary file)"""
+    if isinstance(source, (bytes, bytearray)):
+        source = BytesIO(source)
+    source_size = source.seek(0, os.SEEK_END)
+    source.seek(0)
+    try:
+        with Image.open(source) as img:
+            source_format = img.format
+            if source_format not in ALLOWED_IMAGE_FORMATS:
+                raise ValueError(f"Unsupported image format: {source_format}")
+            img.load()
+            # Apply EXIF orientation before the metadata is dropped
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.LANCZOS)
+            image_dhash = compute_dhash(img)
+            context_thumbnail = compute_context_thumbnail(img)
+            if IMAGE_OUTPUT_FORMAT == "JPEG" and img.mode != "RGB":
+                img = img.convert("RGB")
+            output = BytesIO()
+            img.save(output, format=IMAGE_OUTPUT_FORMAT, quality=IMAGE_OUTPUT_QUALITY)
+            width, height = img.size
+    except ValueError:
+        raise
+    except Exception:
+        raise ValueError("Invalid image format")
+    
+    processed_bytes = output.getvalue()
+    return {
+        "image_bytes": processed_bytes,
+        "image_base64": base64.b64encode(processed_bytes).decode("ascii"),
+        "content_type": Image.MIME[IMAGE_OUTPUT_FORMAT],
+        "source_format": source_format,
+        "source_size": source_size,
+        "width": width,
+        "height": height,
+        "dhash": image_dhash,
+        "thumbnail": context_thumbnail
+    }
+
+async def prepare_image(image_base64: str) -> dict:
+    """Decode an uploaded base64 image once and preprocess it off the event loop"""
+    try:
+        image_bytes = base64.b64decode(image_base64)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid image format")
+    return await prepare_image_bytes(image_bytes)
+
+async def prepare_image_bytes(image_bytes: bytes) -> dict:
+    if len(image_bytes) > IMAGE_UPLOAD_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="Image is too large")
+    return await run_preprocess_image(image_bytes)
+
+async def prepare_image_upload(upload: UploadFile) -> dict:
+    """Preprocess a multipart upload straight from its spooled file, without copying it into memory.
+
+    UploadSizeLimitMiddleware has already bounded the request body.
+    """
+    if upload.content_type and not upload.content_type.startswith("image/"):
+        raise HTTPException(status_code=415, detail="Upload must be an image")
+    if upload.size is not None and upload.size > IMAGE_UPLOAD_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="Image is too large")
+    return await run_preprocess_image(upload.file)
+
+async def run_preprocess_image(source) -> dict:
+    try:
+        return await asyncio.to_thread(preprocess_image, source)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Per-user analysis stats, maintained as analyses are written. Totals live in one
+# user_stats document per user; daily counts live in user_stats_daily, one
+# document per user and day that Mongo expires once it leaves the rolling window.
+USER_STATS_ROLLING_DAYS = 30
+# The tones, goals and types the app offers; anything else a client sends is
+# counted as "other", so the stats document cannot grow without bound
+STATS_TONES = {"professional", "friendly", "confident", "empathetic", "flirty", "witty"}
+STATS_GOALS = {"date", "resolve", "network", "friend", "negotiate", "casual"}
+STATS_TYPES = {"text", "image"}
+
+def stats_key(value: Optional[str], known: set) -> str:
+    key = (value or "").strip().lower()
+    return key if key in known else "other"
+
+def analysis_stats_update(analysis_doc: dict) -> dict:
+    """The $inc/$min/$max that adds one analysis to its user's stats document"""
+    created_at = analysis_doc.get("created_at") or datetime.utcnow()
+    suggestion_lengths = [len(suggestion) for suggestion in analysis_doc.get("suggestions") or []]
+    return {
+        "$inc": {
+            "total": 1,
+            f"by_type.{stats_key(analysis_doc.get('type'), STATS_TYPES)}": 1,
+            f"by_tone.{stats_key(analysis_doc.get('tone'), STATS_TONES)}": 1,
+            f"by_goal.{stats_key(analysis_doc.get('goal'), STATS_GOALS)}": 1,
+            "suggestions.count": len(suggestion_lengths),
+            "suggestions.chars": sum(suggestion_lengths),
+            "suggestions.chars_squared": sum(length * length for length in suggestion_lengths)
+        },
+        "$min": {"first_analysis_at": created_at},
+        "$max": {"last_analysis_at": created_at}
+    }
+
+def daily_stats_id(user_id: str, day: str) -> str:
+    return f"{user_id}:{day}"
+
+def daily_stats_update(analysis_doc: dict) -> tuple:
+    """(user_stats_daily _id, upsert update) that adds one analysis to its user's day"""
+    created_at = analysis_doc.get("created_at") or datetime.utcnow()
+    day = created_at.strftime("%Y-%m-%d")
+    suggestion_lengths = [len(suggestion) for suggestion in analysis_doc.get("suggestions") or []]
+    day_start = datetime.combine(created_at.date(), datetime.min.time())
+    return daily_stats_id(analysis_doc["user_id"], day), {
+        "$inc": {
+            "analyses": 1,
+            "suggestions": len(suggestion_lengths),
+            "suggestion_chars": sum(suggestion_lengths)
+        },
+        "$setOnInsert": {
+            "user_id": analysis_doc["user_id"],
+            "day": day,
+            "expires_at": day_start + timedelta(days=USER_STATS_ROLLING_DAYS + 1)
+        }
+    }
+
+def merge_stats_updates(updates: List[dict]) -> dict:
+    merged = {}
+    for update in updates:
+        for operator, fields in update.items():
+            target = merged.setdefault(operator, {})
+            for field, value in fields.items():
+                if field not in target:
+                    target[field] = value
+                elif operator == "$inc":
+                    target[field] += value
+                elif operator == "$min":
+                    target[field] = min(target[field], value)
+                elif operator == "$max":
+                    target[field] = max(target[field], value)
+    return merged
+
+def stats_upserts(updates_by_id: dict) -> list:
+    return [
+        UpdateOne({"_id": doc_id}, merge_stats_updates(updates), upsert=True)
+        for doc_id, updates in updates_by_id.items()
+    ]
+
+async def record_analysis_stats(analysis_docs: List[dict]):
+    """Add newly inserted analyses to their users' stats, one upsert per user and per day.
+
+    Only call this with documents that were actually inserted, so replays and
+    re-saved jobs are not counted twice. A failure here is logged, not raised;
+    `python server.py rebuild-stats` recomputes everything from analyses.
+    """
+    updates_by_user = {}
+    updates_by_day = {}
+    for analysis_doc in analysis_docs:
+        updates_by_user.setdefault(analysis_doc["user_id"], []).append(analysis_stats_update(analysis_doc))
+        daily_id, daily_update = daily_stats_update(analysis_doc)
+        updates_by_day.setdefault(daily_id, []).append(daily_update)
+    if not updates_by_user:
+        return
+    try:
+        await user_stats_collection.bulk_write(stats_upserts(updates_by_user), ordered=False)
+        await user_stats_daily_collection.bulk_write(stats_upserts(updates_by_day), ordered=False)
+    except Exception as e:
+        print(f"User stats update error: {e}")
+
+def inserted_documents(docs: List[dict], error: BulkWriteError) -> List[dict]:
+    failed_indexes = {write_error["index"] for write_error in error.details.get("writeErrors", [])}
+    return [doc for index, doc in enumerate(docs) if index not in failed_indexes]
+
+def user_stats_view(stats: Optional[dict], daily: List[dict]) -> dict:
+    """Shape the stats and daily documents for the API; cost is bounded by USER_STATS_ROLLING_DAYS, not history size"""
+    stats = stats or {}
+    suggestions = stats.get("suggestions", {})
+    count = suggestions.get("count", 0)
+    mean = suggestions.get("chars", 0) / count if count else 0
+    variance = suggestions.get("chars_squared", 0) / count - mean * mean if count else 0
+    
+    today = datetime.utcnow().date()
+    by_day = {day_doc["day"]: day_doc for day_doc in daily}
+    recent_days = []
+    for offset in range(USER_STATS_ROLLING_DAYS - 1, -1, -1):
+        day = (today - timedelta(days=offset)).strftime("%Y-%m-%d")
+        recent_days.append({"day": day, **by_day.get(day, {"analyses": 0, "suggestions": 0, "suggestion_chars": 0})})
+    recent_suggestions = sum(day["suggestions"] for day in recent_days)
+    recent_chars = sum(day["suggestion_chars"] for day in recent_days)
+    
+    return {
+        "total_analyses": stats.get("total", 0),
+        "by_type": stats.get("by_type", {}),
+        "by_tone": stats.get("by_tone", {}),
+        "by_goal": stats.get("by_goal", {}),
+        "first_analysis_at": stats["first_analysis_at"].isoformat() if stats.get("first_analysis_at") else None,
+        "last_analysis_at": stats["last_analysis_at"].isoformat() if stats.get("last_analysis_at") else None,
+        "suggestion_length": {
+            "count": count,
+            "mean": round(mean, 1),
+            "stddev": round(math.sqrt(max(variance, 0)), 1),
+            f"mean_last_{USER_STATS_ROLLING_DAYS}_days": round(recent_chars / recent_suggestions, 1) if recent_suggestions else 0
+        },
+        "daily": [
+            {"day": day["day"], "analyses": day["analyses"]}
+            for day in recent_days
+        ]
+    }
+
+# Persistence
+class AnalysisWriteQueue:
+    """Batches analyses inserts off the response path.
+
+    Documents get their ObjectId up front so the id can be returned before
+    the write lands. put() blocks once the queue is full, which is the
+    backpressure. Batches that Mongo rejects go to a local JSON-lines spool
+    file, replayed on the next startup.
+    """
+
+    def __init__(self, max_size: int, batch_size: int, flush_interval_ms: int, spool_path: str):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.spool_path = spool_path
+        self.max_size = max_size
+        self.written = 0
+        self.spooled = 0
+        # Queued but not yet written, so readers can see their own writes
+        self.pending = {}
+        self._queue = None
+        self._worker = None
+
+    @property
+    def running(self) -> bool:
+        return self._worker is not None and not self._worker.done()
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_size)
+        self._worker = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        """Flush everything still queued, then stop the worker"""
+        if not self.running:
+            return
+        await self._queue.join()
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+
+    async def put(self, analysis_doc: dict):
+        self.pending[analysis_doc["_id"]] = analysis_doc
+        await self._queue.put(analysis_doc)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self.write_batch(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def write_batch(self, batch: list):
+        failed = []
+        inserted = batch
+        try:
+            with stage_timer("mongo_write"):
+                await analyses_collection.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # Duplicate keys mean the document already landed (e.g. a replay)
+            failed = [
+                batch[error["index"]]
+                for error in e.details.get("writeErrors", [])
+                if error.get("code") != 11000
+            ]
+            inserted = inserted_documents(batch, e)
+        except Exception as e:
+            print(f"Analysis write error, spooling {len(batch)} documents: {e}")
+            failed = batch
+            inserted = []
+        
+        await record_analysis_stats(inserted)
+        if failed:
+            await asyncio.to_thread(self.append_to_spool, failed)
+            self.spooled += len(failed)
+        self.written += len(batch) - len(failed)
+        for analysis_doc in batch:
+            self.pending.pop(analysis_doc["_id"], None)
+
+    @property
+    def replay_path(self) -> str:
+        return f"{self.spool_path}.replay"
+
+    def append_to_spool(self, docs: list, path: str = None):
+        # On disk before the documents leave memory: the spool is their only copy
+        with open(path or self.spool_path, "a", encoding="utf-8") as f:
+            for analysis_doc in docs:
+                f.write(json_util.dumps(analysis_doc) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def take_spool(self) -> list:
+        """Move the spool aside for replay and read it back.
+
+        The .replay file stays until replay_spool has written every document,
+        so one left by a crash mid-replay is read again (duplicates are skipped).
+        """
+        if os.path.exists(self.spool_path):
+            if os.path.exists(self.replay_path):
+                with open(self.spool_path, encoding="utf-8") as f:
+                    self.append_to_spool([json_util.loads(line) for line in f if line.strip()], self.replay_path)
+                os.remove(self.spool_path)
+            else:
+                os.replace(self.spool_path, self.replay_path)
+        if not os.path.exists(self.replay_path):
+            return []
+        with open(self.replay_path, encoding="utf-8") as f:
+            return [json_util.loads(line) for line in f if line.strip()]
+
+    async def replay_spool(self) -> int:
+        """Re-insert spooled documents; anything that fails again is re-spooled"""
+        docs = await asyncio.to_thread(self.take_spool)
+        for start in range(0, len(docs), self.batch_size):
+            await self.write_batch(docs[start:start + self.batch_size])
+        if os.path.exists(self.replay_path):
+            await asyncio.to_thread(os.remove, self.replay_path)
+        return len(docs)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "max_size": self.max_size,
+            "written": self.written,
+            "spooled": self.spooled
+        }
+
+analysis_writer = AnalysisWriteQueue(
+    ANALYSIS_WRITE_QUEUE_SIZE,
+    ANALYSIS_WRITE_BATCH_SIZE,
+    ANALYSIS_WRITE_FLUSH_INTERVAL_MS,
+    ANALYSIS_SPOOL_PATH
+)
+
+async def save_analysis(analysis_doc: dict, write_through: bool = False) -> ObjectId:
+    """Queue analysis_doc for the write-behind writer, or insert it now with write_through"""
+    analysis_doc.setdefault("_id", ObjectId())
+    if analysis_writer.running and not write_through:
+        await analysis_writer.put(analysis_doc)
+    else:
+        try:
+            with stage_timer("mongo_write"):
+                await analyses_collection.insert_one(analysis_doc)
+            await record_analysis_stats([analysis_doc])
+        except DuplicateKeyError:
+            # Already written under this id, e.g. by an earlier run of the same job
+            pass
+    return analysis_doc["_id"]
+
+async def find_analysis(analysis_id: ObjectId) -> Optional[dict]:
+    pending = analysis_writer.pending.get(analysis_id)
+    if pending is not None:
+        return dict(pending)
+    return await analyses_collection.find_one({"_id": analysis_id})
+
+# Conversation threads for follow-up analysis
+def conversation_turns(conversation_text: str) -> List[str]:
+    return [
+        re.sub(r"\s+", " ", line).strip()
+        for line in conversation_text.strip().splitlines()
+        if line.strip()
+    ]
+
+def turns_hash(turns: List[str]) -> str:
+    return hashlib.sha256("\n".join(turns).encode("utf-8")).hexdigest()
+
+async def prepare_thread(conversation_id: Optional[str], user_id: str, conversation_text: str) -> dict:
+    """Resolve the thread for a text analysis and the context to send to the LLM.
+
+    When the earlier turns match what the thread last analyzed, only the new
+    turns are sent, after the previous analysis as a summary of the rest.
+    A new thread, or one whose history was edited, is analyzed in full.
+    """
+    turns = conversation_turns(conversation_text)
+    thread = {
+        "conversation_id": conversation_id or str(ObjectId()),
+        "turns": turns,
+        "context": conversation_text,
+        "mode": "full",
+        "prior_turns": 0,
+        "new_turns": len(turns)
+    }
+    if not conversation_id:
+        return thread
+    
+    if not ObjectId.is_valid(conversation_id):
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    conversation = await conversations_collection.find_one(
+        {"_id": ObjectId(conversation_id), "user_id": user_id},
+        {"turn_count": 1, "prefix_hash": 1, "summary": 1}
+    )
+    if not conversation:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    
+    prior_turns = conversation["turn_count"]
+    if 0 < prior_turns < len(turns) and turns_hash(turns[:prior_turns]) == conversation["prefix_hash"]:
+        thread.update({
+            "context": "\n".join([f"Summary of the earlier conversation: {conversation['summary']}"] + turns[prior_turns:]),
+            "mode": "follow_up",
+            "prior_turns": prior_turns,
+            "new_turns": len(turns) - prior_turns
+        })
+    return thread
+
+async def save_thread(thread: dict, user_id: str, result: dict, analysis_id: ObjectId):
+    """Advance the thread to the analyzed turns, keeping this analysis as its summary"""
+    now = datetime.utcnow()
+    await conversations_collection.update_one(
+        {"_id": ObjectId(thread["conversation_id"]), "user_id": user_id},
+        {
+            "$set": {
+                "turn_count": len(thread["turns"]),
+                "prefix_hash": turns_hash(thread["turns"]),
+                "summary": result["analysis"],
+                "last_analysis_id": str(analysis_id),
+                "updated_at": now
+            },
+            "$inc": {"analysis_count": 1},
+            "$setOnInsert": {"created_at": now}
+        },
+        upsert=True
+    )
+
+def thread_fields(thread: dict) -> dict:
+    """What an analysis document records about its thread"""
+    return {
+        "conversation_id": thread["conversation_id"],
+        "thread": {
+            "mode": thread["mode"],
+            "prior_turns": thread["prior_turns"],
+            "new_turns": thread["new_turns"]
+        }
+    }
+
+async def resolve_text_thread(request: TextAnalysisRequest, current_user: User, plan_info: dict) -> Optional[dict]:
+    if not plan_info["conversation_threads"]:
+        if request.conversation_id:
+            raise HTTPException(
+                status_code=403,
+                detail=f"Follow-up suggestions require {PLANS['premium']['name']} plan or higher"
+            )
+        return None
+    return await prepare_thread(request.conversation_id, current_user.user_id, request.conversation_text)
+
+# Image analysis pipeline shared by the JSON and multipart endpoints
+async def analyze_prepared_image(
+    image: dict,
+    tone: str,
+    goal: str,
+    context: Optional[str],
+    use_cache: bool,
+    current_user: User,
+    plan_info: dict,
+    analysis_id: Optional[ObjectId] = None,
+    image_fields: Optional[dict] = None
+) -> AnalysisResponse:
+    """image_fields, from store_image, are passed when the image is already stored"""
+    if plan_info["image_pipeline"] == "single_call":
+        # One LLM call reads the image and writes the suggestions
+        result = await generate_image_suggestions(image, context, tone, goal, plan_info, current_user.user_id, use_cache)
+        image_context = result["image_context"]
+    else:
+        # First, analyze the image to extract context
+        image_context = await extract_image_context(image, context, current_user.user_id, use_cache, plan_info)
+        
+        # Then generate suggestions based on the extracted context
+        result = await generate_suggestions(
+            conversation_context=image_context,
+            tone=tone,
+            goal=goal,
+            plan_info=plan_info,
+            is_image=True,
+            use_cache=use_cache
+        )
+    
+    # Save to database
+    if image_fields is None:
+        image_fields = await store_image(image["image_bytes"], image["content_type"])
+    analysis_doc = {
+        "user_id": current_user.user_id,
+        **image_fields,
+        "image_context": image_context,
+        "tone": tone,
+        "goal": goal,
+        "analysis": result["analysis"],
+        "suggestions": result["suggestions"],
+        "raw_response": result["raw_response"],
+        "prompt_stats": result.get("prompt_stats"),
+        "created_at": datetime.utcnow(),
+        "type": "image",
+        "plan": current_user.subscription_plan
+    }
+    # Jobs write through, so a succeeded job's analysis is already in analyses
+    write_through = analysis_id is not None
+    if write_through:
+        analysis_doc["_id"] = analysis_id
+    
+    analysis_id = await save_analysis(analysis_doc, write_through)
+    
+    return AnalysisResponse(
+        analysis_id=str(analysis_id),
+        suggestions=result["suggestions"],
+        analysis_text=result["analysis"],
+        tone_used=tone,
+        goal_used=goal
+    )
+
+# Text analysis pipeline shared by the endpoint and background jobs
+def text_analysis_doc(request: TextAnalysisItem, current_user: User, result: dict) -> dict:
+    return {
+        "user_id": current_user.user_id,
+        "conversation_text": request.conversation_text,
+        "tone": request.tone,
+        "goal": request.goal,
+        "analysis": result["analysis"],
+        "suggestions": result["suggestions"],
+        "raw_response": result["raw_response"],
+        "prompt_stats": result.get("prompt_stats"),
+        "created_at": datetime.utcnow(),
+        "type": "text",
+        "plan": current_user.subscription_plan
+    }
+
+async def analyze_text(
+    request: TextAnalysisRequest,
+    current_user: User,
+    plan_info: dict,
+    analysis_id: Optional[ObjectId] = None
+) -> AnalysisResponse:
+    thread = await resolve_text_thread(request, current_user, plan_info)
+    
+    # Generate suggestions
+    result = await generate_suggestions(
+        conversation_context=thread["context"] if thread else request.conversation_text,
+        tone=request.tone,
+        goal=request.goal,
+        plan_info=plan_info,
+        is_image=False,
+        use_cache=not request.bypass_cache
+    )
+    
+    # Save to database
+    analysis_doc = text_analysis_doc(request, current_user, result)
+    if thread:
+        analysis_doc.update(thread_fields(thread))
+    # Jobs write through, so a succeeded job's analysis is already in analyses
+    write_through = analysis_id is not None
+    if write_through:
+        analysis_doc["_id"] = analysis_id
+    
+    analysis_id = await save_analysis(analysis_doc, write_through)
+    if thread:
+        await save_thread(thread, current_user.user_id, result, analysis_id)
+    
+    return AnalysisResponse(
+        analysis_id=str(analysis_id),
+        suggestions=result["suggestions"],
+        analysis_text=result["analysis"],
+        tone_used=request.tone,
+        goal_used=request.goal,
+        conversation_id=thread["conversation_id"] if thread else None
+    )
+
+# Batch text analysis
+async def save_analyses(analysis_docs: List[dict]):
+    """Write a batch of analyses with one bulk insert; documents already carry their _id"""
+    if not analysis_docs:
+        return
+    try:
+        with stage_timer("mongo_write"):
+            await analyses_collection.insert_many(analysis_docs, ordered=False)
+        inserted = analysis_docs
+    except BulkWriteError as e:
+        # Duplicate keys mean the document already landed
+        if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+            raise
+        inserted = inserted_documents(analysis_docs, e)
+    await record_analysis_stats(inserted)
+
+async def run_text_batch(items: List[TextAnalysisItem], current_user: User, plan_info: dict):
+    """Yield (index, analysis_doc, error) as items finish, at most BATCH_CONCURRENCY at a time"""
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    
+    async def run_item(index: int, item: TextAnalysisItem) -> tuple:
+        async with semaphore:
+            try:
+                result = await generate_suggestions(
+                    conversation_context=item.conversation_text,
+                    tone=item.tone,
+                    goal=item.goal,
+                    plan_info=plan_info,
+                    is_image=False,
+                    use_cache=not item.bypass_cache
+                )
+            except HTTPException as e:
+                return index, None, {"status_code": e.status_code, "detail": e.detail}
+            except Exception as e:
+                return index, None, {"status_code": 500, "detail": str(e)}
+        analysis_doc = text_analysis_doc(item, current_user, result)
+        analysis_doc["_id"] = ObjectId()
+        return index, analysis_doc, None
+    
+    tasks = [asyncio.ensure_future(run_item(index, item)) for index, item in enumerate(items)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def batch_item_result(index: int, analysis_doc: Optional[dict], error: Optional[dict]) -> dict:
+    if analysis_doc is None:
+        return {"index": index, "status": "failed", "error": error}
+    return {"index": index, "status": "succeeded", **analysis_response(analysis_doc).dict()}
+
+async def stream_text_batch(items: List[TextAnalysisItem], current_user: User, plan_info: dict):
+    """NDJSON: one line per item as it finishes, then a summary line once everything is saved"""
+    analysis_docs = []
+    saved = False
+    try:
+        async for index, analysis_doc, error in run_text_batch(items, current_user, plan_info):
+            if analysis_doc is not None:
+                analysis_docs.append(analysis_doc)
+            yield json.dumps(batch_item_result(index, analysis_doc, error)) + "\n"
+        
+        await save_analyses(analysis_docs)
+        saved = True
+        yield json.dumps({"done": True, "succeeded": len(analysis_docs), "failed": len(items) - len(analysis_docs)}) + "\n"
+    except Exception as e:
+        print(f"Error streaming batch: {e}")
+        yield json.dumps({"done": False, "error": {"status_code": 500, "detail": "Failed to save analyses"}}) + "\n"
+    finally:
+        if not saved and analysis_docs:
+            # Client went away mid-batch: keep the analyses that finished
+            asyncio.ensure_future(save_analyses(analysis_docs))
+
+# Background analysis jobs
+JOB_TERMINAL_STATUSES = ("succeeded", "failed")
+
+class AnalysisJobRunner:
+    """Runs analyses submitted with ?async=true on a fixed pool of workers.
+
+    Every job is a record in analysis_jobs, so a restart can pick up where it
+    left off: queued jobs are enqueued again, and a periodic sweep retries
+    running jobs whose lease ran out (their process died), up to
+    JOB_MAX_ATTEMPTS, or fails them. A job claims its record atomically before
+    running, and its analysis _id is allocated at submit time, so the result
+    lands in analyses exactly once.
+    """
+
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.completed = 0
+        self.failed = 0
+        # job id -> Event set when this process changes the job's status, and
+        # how many polls are waiting on it
+        self.changed = {}
+        self._waiting = {}
+        self._queue = None
+        self._queued = set()
+        self._tasks = []
+        self._sweeper = None
+        self._running = set()
+        # Submits between their capacity check and put_nowait
+        self._reserved = 0
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._tasks = [asyncio.ensure_future(self.run_worker()) for _ in range(self.workers)]
+        self._sweeper = asyncio.ensure_future(self.run_sweeper())
+
+    async def stop(self):
+        """Stop the workers and hand jobs they were running back to the queue"""
+        tasks = self._tasks + ([self._sweeper] if self._sweeper else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+        self._sweeper = None
+        self._queued.clear()
+        if self._running:
+            await analysis_jobs_collection.update_many(
+                {"_id": {"$in": list(self._running)}, "status": "running"},
+                {"$set": {"status": "queued", "updated_at": datetime.utcnow()}, "$inc": {"attempts": -1}}
+            )
+            self._running.clear()
+
+    async def submit(self, kind: str, user: User, request: dict) -> dict:
+        if not self.running:
+            raise HTTPException(status_code=503, detail="Background analysis is not available")
+        if not self.has_room():
+            raise HTTPException(
+                status_code=503,
+                detail="Too many queued analyses, please retry shortly",
+                headers={"Retry-After": "5"}
+            )
+        # Hold a queue place while the record is inserted, so concurrent submits cannot overfill it
+        self._reserved += 1
+        now = datetime.utcnow()
+        job = {
+            "_id": ObjectId(),
+            "user_id": user.user_id,
+            "plan": user.subscription_plan,
+            "kind": kind,
+            "request": request,
+            "status": "queued",
+            "attempts": 0,
+            # Allocated up front so every run of this job saves the same analysis
+            "analysis_id": ObjectId(),
+            "created_at": now,
+            "updated_at": now
+        }
+        try:
+            await analysis_jobs_collection.insert_one(job)
+        finally:
+            self._reserved -= 1
+        self.enqueue(job["_id"])
+        return job
+
+    def has_room(self) -> bool:
+        return self._queue.qsize() + self._reserved < self.max_queue
+
+    def enqueue(self, job_id: ObjectId):
+        self._queued.add(job_id)
+        self._queue.put_nowait(job_id)
+
+    async def enqueue_queued(self, query: dict) -> int:
+        """Enqueue matching queued jobs, oldest first, that are not already in this process's queue"""
+        enqueued = 0
+        async for job in analysis_jobs_collection.find(query, {"_id": 1}).sort("created_at", 1):
+            if job["_id"] in self._queued:
+                continue
+            if not self.has_room():
+                break
+            self.enqueue(job["_id"])
+            enqueued += 1
+        return enqueued
+
+    async def resume(self) -> int:
+        """Recover running jobs abandoned by a dead process and re-enqueue queued jobs"""
+        await self.recover_expired_leases()
+        return await self.enqueue_queued({"status": "queued"})
+
+    async def sweep(self) -> int:
+        """Requeue running jobs whose lease ran out, and enqueue queued jobs no process picked up"""
+        enqueued = 0
+        for job_id in await self.recover_expired_leases():
+            if job_id not in self._queued and self.has_room():
+                self.enqueue(job_id)
+                enqueued += 1
+        # Left queued by a process that had no room for them, or that stopped
+        stale = datetime.utcnow() - timedelta(seconds=JOB_LEASE_SECONDS)
+        return enqueued + await self.enqueue_queued({"status": "queued", "updated_at": {"$lt": stale}})
+
+    async def run_sweeper(self):
+        while True:
+            await asyncio.sleep(JOB_LEASE_SWEEP_SECONDS)
+            try:
+                swept = await self.sweep()
+                if swept:
+                    print(f"Requeued {swept} analysis jobs")
+            except Exception as e:
+                print(f"Analysis job sweep error: {e}")
+
+    async def recover_expired_leases(self) -> List[ObjectId]:
+        """Fail running jobs out of attempts whose lease ran out, and requeue the rest.
+
+        Returns the jobs this call requeued. Each is requeued by a conditional
+        update, so when several processes sweep at once only one enqueues it.
+        """
+        now = datetime.utcnow()
+        expired = {"status": "running", "lease_expires_at": {"$lt": now}}
+        if self._running:
+            # Still running here, just slower than the lease
+            expired["_id"] = {"$nin": list(self._running)}
+        await analysis_jobs_collection.update_many(
+            {**expired, "attempts": {"$gte": JOB_MAX_ATTEMPTS}},
+            {"$set": {
+                "status": "failed",
+                "error": {"status_code": 500, "detail": "Analysis was interrupted too many times"},
+                "updated_at": now,
+                "expires_at": now + timedelta(seconds=JOB_RESULT_TTL_SECONDS)
+            }}
+        )
+        requeued = []
+        async for job in analysis_jobs_collection.find(expired, {"_id": 1}):
+            result = await analysis_jobs_collection.update_one(
+                {**expired, "_id": job["_id"]},
+                {"$set": {"status": "queued", "updated_at": now}}
+            )
+            if result.modified_count:
+                requeued.append(job["_id"])
+        return requeued
 
-        # Create image content
-        image_content = ImageContent(image_base64=image_base64)
+    async def run_worker(self):
+        while True:
+            job_id = await self._queue.get()
+            self._queued.discard(job_id)
+            try:
+                await self.run_job(job_id)
+            except Exception as e:
+                print(f"Analysis job {job_id} error: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def run_job(self, job_id: ObjectId):
+        now = datetime.utcnow()
+        job = await analysis_jobs_collection.find_one_and_update(
+            {"_id": job_id, "status": "queued"},
+            {
+                "$set": {
+                    "status": "running",
+                    "updated_at": now,
+                    "lease_expires_at": now + timedelta(seconds=JOB_LEASE_SECONDS)
+                },
+                "$inc": {"attempts": 1}
+            },
+            return_document=ReturnDocument.AFTER
+        )
+        if job is None:
+            # Claimed by another process, or already finished
+            return
+        self.notify(job_id)
         
-        prompt = "Analyze this image and extract all text, describe the content, and identify any social context or emotional tone."
-        if context:
-            prompt += f"\n\nAdditional context provided by user: {context}"
+        self._running.add(job_id)
+        try:
+            existing = await find_analysis(job["analysis_id"])
+            if existing is not None:
+                # An earlier run saved the analysis but not the job status
+                response = analysis_response(existing)
+            else:
+                response = await execute_analysis_job(job)
+            await self.finish(job_id, {"status": "succeeded", "result": response.dict()})
+            self.completed += 1
+        except HTTPException as e:
+            await self.finish(job_id, {"status": "failed", "error": {"status_code": e.status_code, "detail": e.detail}})
+            self.failed += 1
+        except Exception as e:
+            print(f"Analysis job {job_id} failed: {e}")
+            await self.finish(job_id, {"status": "failed", "error": {"status_code": 500, "detail": str(e)}})
+            self.failed += 1
+        finally:
+            self._running.discard(job_id)
 
-        message = UserMessage(
-            text=prompt,
-            file_contents=[image_content]
+    async def finish(self, job_id: ObjectId, fields: dict):
+        now = datetime.utcnow()
+        await analysis_jobs_collection.update_one(
+            {"_id": job_id, "status": "running"},
+            {
+                "$set": {
+                    **fields,
+                    "updated_at": now,
+                    "expires_at": now + timedelta(seconds=JOB_RESULT_TTL_SECONDS)
+                },
+                "$unset": {"lease_expires_at": "", "request": ""}
+            }
         )
+        self.notify(job_id)
 
-        response = await chat.send_message(message)
-        return response
+    def notify(self, job_id: ObjectId):
+        event = self.changed.pop(str(job_id), None)
+        if event is not None:
+            event.set()
+
+    async def wait_for_change(self, job_id: str, timeout: float):
+        event = self.changed.get(job_id)
+        if event is None:
+            event = self.changed[job_id] = asyncio.Event()
+        self._waiting[job_id] = self._waiting.get(job_id, 0) + 1
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            # notify() drops the event when it fires; the last poll to give up drops it otherwise
+            waiting = self._waiting.pop(job_id) - 1
+            if waiting:
+                self._waiting[job_id] = waiting
+            elif self.changed.get(job_id) is event:
+                del self.changed[job_id]
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "running": len(self._running),
+            "completed": self.completed,
+            "failed": self.failed
+        }
+
+analysis_job_runner = AnalysisJobRunner(JOB_WORKERS, JOB_MAX_QUEUE)
+
+def analysis_response(analysis: dict) -> AnalysisResponse:
+    return AnalysisResponse(
+        analysis_id=str(analysis["_id"]),
+        suggestions=analysis["suggestions"],
+        analysis_text=analysis["analysis"],
+        tone_used=analysis["tone"],
+        goal_used=analysis["goal"],
+        conversation_id=analysis.get("conversation_id")
+    )
+
+async def execute_analysis_job(job: dict) -> AnalysisResponse:
+    user_doc = await users_collection.find_one({"user_id": job["user_id"]}, {"_id": 0})
+    if not user_doc:
+        raise HTTPException(status_code=404, detail="User not found")
+    current_user = User(**user_doc)
+    plan_info = PLANS.get(job["plan"])
+    if not plan_info:
+        raise HTTPException(status_code=400, detail="Invalid subscription plan")
+    metrics_plan.set(job["plan"])
+    request = job["request"]
+    
+    if job["kind"] == "text":
+        return await analyze_text(TextAnalysisRequest(**request), current_user, plan_info, job["analysis_id"])
+    
+    # Images were preprocessed and stored at submit time
+    image_bytes = await image_store.get(request["image_ref"])
+    if image_bytes is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    image = {
+        "image_bytes": image_bytes,
+        "image_base64": base64.b64encode(image_bytes).decode("ascii"),
+        "content_type": request["image_content_type"],
+        "dhash": int(request["dhash"], 16),
+        "thumbnail": request.get("thumbnail")
+    }
+    return await analyze_prepared_image(
+        image,
+        tone=request["tone"],
+        goal=request["goal"],
+        context=request.get("context"),
+        use_cache=not request.get("bypass_cache", False),
+        current_user=current_user,
+        plan_info=plan_info,
+        analysis_id=job["analysis_id"],
+        image_fields={"image_ref": request["image_ref"], "image_content_type": request["image_content_type"]}
+    )
+
+async def submit_image_job(image: dict, tone: str, goal: str, context: Optional[str], bypass_cache: bool, current_user: User) -> JSONResponse:
+    image_fields = await store_image(image["image_bytes"], image["content_type"])
+    job = await analysis_job_runner.submit("image", current_user, {
+        **image_fields,
+        "dhash": f"{image['dhash']:016x}",
+        "thumbnail": image["thumbnail"],
+        "tone": tone,
+        "goal": goal,
+        "context": context,
+        "bypass_cache": bypass_cache
+    })
+    return job_accepted_response(job)
+
+def job_accepted_response(job: dict) -> JSONResponse:
+    status_url = f"/api/jobs/{job['_id']}"
+    return JSONResponse(
+        status_code=202,
+        content={"job_id": str(job["_id"]), "status": job["status"], "status_url": status_url},
+        headers={"Location": status_url}
+    )
+
+def job_etag(job: dict) -> str:
+    return f'"{job["status"]}-{job.get("attempts", 0)}"'
+
+def job_status_body(job: dict) -> dict:
+    body = {
+        "job_id": str(job["_id"]),
+        "status": job["status"],
+        "created_at": job["created_at"].isoformat(),
+        "updated_at": job["updated_at"].isoformat()
+    }
+    if job["status"] == "succeeded":
+        body["result"] = job["result"]
+    elif job["status"] == "failed":
+        body["error"] = job["error"]
+    return body
+
+# History export
+EXPORT_EXCLUDED_FIELDS = {"image_base64": 0, "raw_response": 0}
+
+def export_json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"Cannot export {type(value).__name__}")
+
+def export_cursor(user_id: str):
+    """The user's analyses, newest first, fetched EXPORT_BATCH_SIZE at a time"""
+    return analyses_collection.find(
+        {"user_id": user_id},
+        EXPORT_EXCLUDED_FIELDS
+    ).sort([("created_at", -1), ("_id", -1)]).batch_size(EXPORT_BATCH_SIZE)
+
+def export_record(analysis: dict) -> dict:
+    if analysis.get("image_ref"):
+        analysis["image_url"] = image_url(analysis["image_ref"])
+    return analysis
+
+async def export_ndjson(user_id: str):
+    buffer = []
+    size = 0
+    async for analysis in export_cursor(user_id):
+        line = json.dumps(export_record(analysis), default=export_json_default) + "\n"
+        buffer.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_BYTES:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer)
+
+class PdfFont:
+    """A TrueType font's metrics, loaded once per process; each export embeds a subset"""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as font_file:
+            self.data = font_file.read()
+        font = TTFont(BytesIO(self.data))
+        scale = 1000 / font["head"].unitsPerEm
+        self.cmap = font.getBestCmap()
+        self.advances = {name: round(advance * scale) for name, (advance, _) in font["hmtx"].metrics.items()}
+        self.name = re.sub(r"[^A-Za-z0-9-]", "", font["name"].getDebugName(6) or "") or "Font"
+        head = font["head"]
+        self.bbox = [round(value * scale) for value in (head.xMin, head.yMin, head.xMax, head.yMax)]
+        self.ascent = round(font["hhea"].ascent * scale)
+        self.descent = round(font["hhea"].descent * scale)
+        self.cap_height = round(getattr(font["OS/2"], "sCapHeight", 0) * scale) if "OS/2" in font else self.ascent
+
+    def has(self, char: str) -> bool:
+        return ord(char) in self.cmap
+
+    def width(self, char: str) -> int:
+        """Advance width in 1/1000 em; missing characters take .notdef's"""
+        return self.advances.get(self.cmap.get(ord(char), ".notdef"), 0)
+
+    def subset(self, chars: List[str]) -> tuple:
+        """(font program, glyph id per character) holding only these characters"""
+        font = TTFont(BytesIO(self.data))
+        options = SubsetOptions()
+        options.notdef_outline = True
+        options.layout_features = []
+        options.drop_tables += ["FFTM"]
+        subsetter = Subsetter(options)
+        subsetter.populate(unicodes=[ord(char) for char in chars if self.has(char)])
+        subsetter.subset(font)
+        glyph_ids = {char: font.getGlyphID(self.cmap[ord(char)]) for char in chars if self.has(char)}
+        program = BytesIO()
+        font.save(program)
+        return program.getvalue(), glyph_ids
+
+pdf_fonts: Optional[List[PdfFont]] = None
+
+def load_pdf_fonts() -> List[PdfFont]:
+    """The PDF_FONT_PATHS fonts that exist here; missing fallbacks are skipped"""
+    global pdf_fonts
+    if pdf_fonts is None:
+        fonts = []
+        for path in PDF_FONT_PATHS:
+            if not os.path.exists(path):
+                continue
+            try:
+                fonts.append(PdfFont(path))
+            except (OSError, TTLibError, KeyError) as e:
+                print(f"PDF font {path} not loaded: {e}")
+        pdf_fonts = fonts
+    return pdf_fonts
+
+def pdf_stream(data: bytes, entries: bytes = b"") -> bytes:
+    data = zlib.compress(data)
+    return b"<< /Length %d /Filter /FlateDecode%s >>\nstream\n" % (len(data), entries) + data + b"\nendstream"
+
+def pdf_to_unicode_cmap(chars: List[str]) -> bytes:
+    """ToUnicode CMap for CIDs 1..n in order, so text can be searched and copied"""
+    lines = [
+        b"/CIDInit /ProcSet findresource begin", b"12 dict begin", b"begincmap",
+        b"/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) /Supplement 0 >> def",
+        b"/CMapName /Adobe-Identity-UCS def", b"/CMapType 2 def",
+        b"1 begincodespacerange", b"<0000> <FFFF>", b"endcodespacerange"
+    ]
+    # A bfchar block holds at most 100 entries
+    for block_start in range(0, len(chars), 100):
+        block = chars[block_start:block_start + 100]
+        lines.append(b"%d beginbfchar" % len(block))
+        for cid, char in enumerate(block, start=block_start + 1):
+            lines.append(b"<%04X> <%s>" % (cid, char.encode("utf-16-be", "surrogatepass").hex().upper().encode()))
+        lines.append(b"endbfchar")
+    lines += [b"endcmap", b"CMapName currentdict /CMap defineresource pop", b"end", b"end"]
+    return b"\n".join(lines)
+
+class StreamingPdfWriter:
+    """Minimal text-only PDF, written out a page at a time.
+
+    Only the current page's lines are held; what grows with the document is
+    one byte offset per object for the xref table, one id per page and the
+    set of characters used. Text is shown in embedded TrueType fonts
+    (Type0, Identity-H), so any script the fonts cover prints as itself;
+    each font is subset to the characters used and written by finish().
+    """
+    PAGE_WIDTH = 612
+    PAGE_HEIGHT = 792
+    MARGIN = 54
+    FONT_SIZE = 10
+    LEADING = 13
+    # Bold lines are drawn with fill and stroke, so no bold font file is needed
+    BOLD_STROKE_WIDTH = 0.3
+
+    def __init__(self, fonts: List[PdfFont]):
+        self.fonts = fonts
+        self.position = 0
+        self.offsets = []
+        self.page_ids = []
+        self.lines = []
+        self.next_id = 3
+        self.lines_per_page = (self.PAGE_HEIGHT - 2 * self.MARGIN) // self.LEADING
+        self.line_width = (self.PAGE_WIDTH - 2 * self.MARGIN) * 1000 / self.FONT_SIZE
+        self.char_fonts = {}
+        # Per font: its Type0 object id, and the CID given to each character (in order)
+        self.font_ids = {}
+        self.font_cids = [{} for _ in fonts]
+
+    def emit(self, data: bytes) -> bytes:
+        self.position += len(data)
+        return data
+
+    def write_object(self, number: int, body: bytes) -> bytes:
+        while len(self.offsets) < number:
+            self.offsets.append(0)
+        self.offsets[number - 1] = self.position
+        return self.emit(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+
+    def begin(self) -> bytes:
+        # Object 2 (the page tree) and the fonts are written last, once every page is known
+        return (
+            self.emit(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+            + self.write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        )
+
+    def font_for(self, char: str) -> int:
+        index = self.char_fonts.get(char)
+        if index is None:
+            index = next((i for i, font in enumerate(self.fonts) if font.has(char)), 0)
+            self.char_fonts[char] = index
+        return index
+
+    def char_width(self, char: str) -> int:
+        return self.fonts[self.font_for(char)].width(char)
+
+    def wrap(self, paragraph: str) -> List[str]:
+        """Greedy wrap by rendered width; words wider than a line (or unspaced CJK) break anywhere"""
+        lines, line, width = [], "", 0
+        for token in re.findall(r"\s+|\S+", paragraph):
+            if token.isspace():
+                if line:
+                    line += " "
+                    width += self.char_width(" ")
+                continue
+            token_width = sum(self.char_width(char) for char in token)
+            if token_width <= self.line_width:
+                if line and width + token_width > self.line_width:
+                    lines.append(line.rstrip())
+                    line, width = "", 0
+                line += token
+                width += token_width
+                continue
+            for char in token:
+                char_width = self.char_width(char)
+                if line and width + char_width > self.line_width:
+                    lines.append(line.rstrip())
+                    line, width = "", 0
+                line += char
+                width += char_width
+        lines.append(line.rstrip())
+        return lines
+
+    def add_text(self, text: str, bold: bool = False) -> bytes:
+        """Queue wrapped lines; returns any pages they completed"""
+        output = b""
+        for paragraph in (text or "").replace("\t", " ").splitlines() or [""]:
+            for line in self.wrap(paragraph):
+                self.lines.append((line, bold))
+                if len(self.lines) >= self.lines_per_page:
+                    output += self.write_page()
+        return output
+
+    def encode_run(self, font_index: int, run: str) -> bytes:
+        cids = self.font_cids[font_index]
+        codes = []
+        for char in run:
+            cid = cids.get(char)
+            if cid is None:
+                # CID 0 is .notdef; past 65535 distinct characters the rest show as that
+                cid = len(cids) + 1 if len(cids) < 0xFFFE else 0
+                if cid:
+                    cids[char] = cid
+            codes.append(b"%04X" % cid)
+        return b"<" + b"".join(codes) + b">"
+
+    def write_page(self) -> bytes:
+        operations = [
+            b"%.1f w" % self.BOLD_STROKE_WIDTH, b"BT", b"%d TL" % self.LEADING,
+            b"%d %d Td" % (self.MARGIN, self.PAGE_HEIGHT - self.MARGIN)
+        ]
+        font = None
+        render_mode = b"0 Tr"
+        page_fonts = set()
+        for line, bold in self.lines:
+            operations.append(b"T*")
+            line_mode = b"2 Tr" if bold else b"0 Tr"
+            if line_mode != render_mode:
+                operations.append(line_mode)
+                render_mode = line_mode
+            for font_index, run in itertools.groupby(line, key=self.font_for):
+                if font_index not in self.font_ids:
+                    self.font_ids[font_index] = self.next_id
+                    self.next_id += 1
+                page_fonts.add(font_index)
+                if font_index != font:
+                    operations.append(b"/F%d %d Tf" % (font_index + 1, self.FONT_SIZE))
+                    font = font_index
+                operations.append(self.encode_run(font_index, "".join(run)) + b" Tj")
+        operations.append(b"ET")
+        stream = b"\n".join(operations)
+        self.lines = []
         
-    except Exception as e:
-        print(f"Error analyzing image: {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to analyze image: {str(e)}")
+        content_id, page_id = self.next_id, self.next_id + 1
+        self.next_id += 2
+        self.page_ids.append(page_id)
+        font_resources = b" ".join(b"/F%d %d 0 R" % (index + 1, self.font_ids[index]) for index in sorted(page_fonts))
+        return (
+            self.write_object(content_id, b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+            + self.write_object(page_id, (
+                b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d]" % (self.PAGE_WIDTH, self.PAGE_HEIGHT)
+                + b" /Resources << /Font << " + font_resources + b" >> >> /Contents %d 0 R >>" % content_id
+            ))
+        )
 
-# API Routes
-@app.get("/")
-def read_root():
-    return {"message": "TalkTutor API is running", "version": "2.0.0"}
+    def write_font(self, font_index: int) -> bytes:
+        """The Type0 font and its descendants, embedding a subset with just the characters used"""
+        font = self.fonts[font_index]
+        chars = list(self.font_cids[font_index])
+        program, glyph_ids = font.subset(chars)
+        # Subset fonts are named with a six-letter tag derived from their contents
+        digest = hashlib.sha256("".join(chars).encode("utf-8", "surrogatepass")).digest()
+        base_font = b"/%s+%s" % (bytes(65 + byte % 26 for byte in digest[:6]), font.name.encode())
+        descendant_id, descriptor_id, program_id, to_unicode_id, cid_map_id = range(self.next_id, self.next_id + 5)
+        self.next_id += 5
+        
+        widths = b" ".join(b"%d" % font.width(char) for char in chars)
+        cid_to_gid = b"\x00\x00" + b"".join(glyph_ids.get(char, 0).to_bytes(2, "big") for char in chars)
+        return (
+            self.write_object(self.font_ids[font_index], (
+                b"<< /Type /Font /Subtype /Type0 /BaseFont " + base_font + b" /Encoding /Identity-H"
+                + b" /DescendantFonts [%d 0 R] /ToUnicode %d 0 R >>" % (descendant_id, to_unicode_id)
+            ))
+            + self.write_object(descendant_id, (
+                b"<< /Type /Font /Subtype /CIDFontType2 /BaseFont " + base_font
+                + b" /CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) /Supplement 0 >>"
+                + b" /FontDescriptor %d 0 R /W [1 [" % descriptor_id + widths + b"]] /CIDToGIDMap %d 0 R >>" % cid_map_id
+            ))
+            + self.write_object(descriptor_id, (
+                b"<< /Type /FontDescriptor /FontName " + base_font + b" /Flags 32"
+                + b" /FontBBox [%d %d %d %d]" % tuple(font.bbox)
+                + b" /ItalicAngle 0 /Ascent %d /Descent %d /CapHeight %d" % (font.ascent, font.descent, font.cap_height)
+                + b" /StemV 80 /FontFile2 %d 0 R >>" % program_id
+            ))
+            + self.write_object(program_id, pdf_stream(program, b" /Length1 %d" % len(program)))
+            + self.write_object(to_unicode_id, pdf_stream(pdf_to_unicode_cmap(chars)))
+            + self.write_object(cid_map_id, pdf_stream(cid_to_gid))
+        )
 
-# Auth endpoints
-@app.post("/api/auth/session")
-async def exchange_session_id(x_session_id: str = Header(...)):
-    """Exchange session_id for user data and session_token"""
+    def finish(self) -> bytes:
+        output = b""
+        if self.lines or not self.page_ids:
+            output += self.write_page()
+        kids = b" ".join(b"%d 0 R" % page_id for page_id in self.page_ids)
+        output += self.write_object(2, b"<< /Type /Pages /Kids [" + kids + b"] /Count %d >>" % len(self.page_ids))
+        for font_index in sorted(self.font_ids):
+            output += self.write_font(font_index)
+        
+        xref_position = self.position
+        entries = [b"xref", b"0 %d" % (len(self.offsets) + 1), b"0000000000 65535 f "]
+        entries.extend(b"%010d 00000 n " % offset for offset in self.offsets)
+        trailer = b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(self.offsets) + 1, xref_position)
+        return output + self.emit(b"\n".join(entries) + b"\n" + trailer)
+
+async def export_pdf(user: User, fonts: List[PdfFont]):
+    pdf = StreamingPdfWriter(fonts)
+    yield pdf.begin() + pdf.add_text(f"TalkTutor history for {user.name} ({user.email})", bold=True) + pdf.add_text("")
+    
+    output = b""
+    async for analysis in export_cursor(user.user_id):
+        analysis = export_record(analysis)
+        created_at = analysis["created_at"].strftime("%Y-%m-%d %H:%M UTC")
+        output += pdf.add_text(
+            f"{created_at} - {analysis.get('type', 'text')} - tone: {analysis.get('tone')} - goal: {analysis.get('goal')}",
+            bold=True
+        )
+        if analysis.get("image_url"):
+            output += pdf.add_text(f"Image: {analysis['image_url']}")
+        context = analysis.get("conversation_text") or analysis.get("image_context")
+        if context:
+            output += pdf.add_text(f"Conversation: {context}")
+        output += pdf.add_text(f"Analysis: {analysis.get('analysis', '')}")
+        for number, suggestion in enumerate(analysis.get("suggestions") or [], start=1):
+            output += pdf.add_text(f"{number}. {suggestion}")
+        output += pdf.add_text("")
+        if len(output) >= EXPORT_CHUNK_BYTES:
+            yield output
+            output = b""
+    # Subsetting the fonts is CPU work, so keep it off the event loop
+    yield output + await asyncio.to_thread(pdf.finish)
+
+# History pagination
+def encode_history_cursor(created_at: datetime, analysis_id: ObjectId) -> str:
+    epoch_ms = (created_at.replace(tzinfo=None) - datetime(1970, 1, 1)) // timedelta(milliseconds=1)
+    raw = f"{epoch_ms}:{analysis_id}".encode("ascii")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_history_cursor(cursor: str) -> tuple:
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                AUTH_SESSION_API,
-                headers={"X-Session-ID": x_session_id}
-            )
-            
-            if response.status_code != 200:
-                raise HTTPException(status_code=401, detail="Invalid session ID")
-            
-            user_data = response.json()
-            session_response = SessionDataResponse(**user_data)
-            
-            # Check if user exists
-            existing_user = users_collection.find_one(
-                {"email": session_response.email},
-                {"_id": 0}
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("ascii")
+        epoch_ms, analysis_id = raw.split(":", 1)
+        return datetime(1970, 1, 1) + timedelta(milliseconds=int(epoch_ms)), ObjectId(analysis_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def history_projection(requested_fields: List[str]) -> dict:
+    """Server-side projection so list view never loads raw responses or images"""
+    projection = {"_id": 1, "created_at": 1}
+    for field in requested_fields:
+        if field == "preview":
+            projection["preview"] = {"$substrCP": [
+                {"$ifNull": ["$conversation_text", {"$ifNull": ["$image_context", {"$ifNull": ["$analysis", ""]}]}]},
+                0,
+                HISTORY_PREVIEW_CHARS
+            ]}
+        elif field == "has_image":
+            projection["has_image"] = {"$eq": ["$type", "image"]}
+        else:
+            projection[field] = 1
+    return projection
+
+# Server-Sent Events streaming
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def replay_response(response: str):
+    yield response
+
+def llm_stream_messages(system_message: str, text: str, image: Optional[dict] = None) -> list:
+    """Chat completion messages for stream_chat_response, with the image inline as a data URL"""
+    content = text
+    if image is not None:
+        content = [
+            {"type": "text", "text": text},
+            {"type": "image_url", "image_url": {"url": f"data:{image['content_type']};base64,{image['image_base64']}"}}
+        ]
+    return [{"role": "system", "content": system_message}, {"role": "user", "content": content}]
+
+async def stream_chat_response(messages: list, plan_info: dict):
+    """Yield response text chunks as the model produces them.
+
+    Shares the deadline and circuit breaker with call_llm; a stream is never
+    retried or hedged since its chunks have already been sent to the client.
+    """
+    breaker = llm_breaker(plan_info["ai_model"])
+    breaker.check()
+    try:
+        async with llm_scheduler.slot(plan_info):
+            deadline = time.monotonic() + LLM_TIMEOUT_SECONDS
+            response = await asyncio.wait_for(
+                litellm.acompletion(
+                    model=f"openai/{plan_info['ai_model']}",
+                    messages=messages,
+                    api_key=EMERGENT_LLM_KEY,
+                    api_base=LLM_API_BASE,
+                    stream=True
+                ),
+                max(0, deadline - time.monotonic())
             )
-            
-            if not existing_user:
-                # Create new user
-                user_id = f"user_{uuid.uuid4().hex[:12]}"
-                user_doc = {
-                    "user_id": user_id,
-                    "email": session_response.email,
-                    "name": session_response.name,
-                    "picture": session_response.picture,
-                    "created_at": datetime.now(timezone.utc),
-                    "subscription_plan": None,
-                    "subscription_expires": None
-                }
-                users_collection.insert_one(user_doc)
-            else:
-                user_id = existing_user["user_id"]
-            
-            # Create session
-            session_doc = {
-                "user_id": user_id,
-                "session_token": session_response.session_token,
-                "expires_at": datetime.now(timezone.utc) + timedelta(days=7),
-                "created_at": datetime.now(timezone.utc)
-            }
-            user_sessions_collection.insert_one(session_doc)
-            
-            return {
-                "user_id": user_id,
-                "email": session_response.email,
-                "name": session_response.name,
-                "picture": session_response.picture,
-                "session_token": session_response.session_token
-            }
-    
+            chunks = response.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), max(0, deadline - time.monotonic()))
+                except StopAsyncIteration:
+                    break
+                text = chunk.choices[0].delta.content if chunk.choices else None
+                if text:
+                    yield text
     except HTTPException:
+        breaker.abandon()
         raise
-    except Exception as e:
-        print(f"Session exchange error: {e}")
-        raise HTTPException(status_code=500, detail="Failed to exchange session")
+    except asyncio.TimeoutError:
+        breaker.record(False)
+        llm_errors.inc("stream_llm", plan_info["ai_model"])
+        raise HTTPException(status_code=504, detail="AI service timed out")
+    except Exception:
+        breaker.record(False)
+        llm_errors.inc("stream_llm", plan_info["ai_model"])
+        raise
+    except BaseException:
+        # Client disconnected or the generator was closed early
+        breaker.abandon()
+        raise
+    breaker.record(True)
 
-@app.get("/api/auth/me")
-async def get_me(current_user: User = Depends(get_current_user)):
-    """Get current user info"""
-    return current_user
+async def stream_suggestion_events(
+    analysis_doc: dict,
+    conversation_context: str,
+    tone: str,
+    goal: str,
+    plan_info: dict,
+    use_cache: bool = True,
+    llm_messages: Optional[list] = None,
+    thread: Optional[dict] = None,
+    image_cache_key: Optional[tuple] = None
+):
+    """Emit analysis/suggestion events as lines complete, then persist analysis_doc.
 
-@app.post("/api/auth/logout")
-async def logout(current_user: User = Depends(get_current_user), authorization: str = Header(...)):
-    """Logout user"""
+    llm_messages, from llm_stream_messages, are streamed instead of the text
+    suggestions prompt; used by the single-call image pipeline and never cached.
+    The IMAGE CONTEXT they return is cached under image_cache_key, an
+    (image, context, user_id) tuple for store_cached_image_context. thread, from prepare_thread, is advanced once the analysis
+    is saved.
+    """
+    
+    suggestions_count = plan_info["suggestions_count"]
+    parser = SuggestionStreamParser(suggestions_count)
+    raw_response = ""
+    completed = False
+    cached_result = None
+    prompt_stats = None
+    
     try:
-        session_token = authorization.replace("Bearer ", "") if authorization.startswith("Bearer ") else authorization
-        user_sessions_collection.delete_one({"session_token": session_token})
-        return {"message": "Logged out successfully"}
+        if llm_messages is None:
+            cache_key = suggestion_cache_key(conversation_context, tone, goal, plan_info)
+            if use_cache:
+                cached_result = await get_cached_suggestions(cache_key)
+        
+        if llm_messages is not None:
+            chunks = stream_chat_response(llm_messages, plan_info)
+        elif cached_result is not None:
+            chunks = replay_response(cached_result["raw_response"])
+            prompt_stats = cached_result.get("prompt_stats")
+        else:
+            system_message, prompt_stats = build_budgeted_suggestions_prompt(conversation_context, tone, goal, plan_info)
+            chunks = stream_chat_response(llm_stream_messages(system_message, SUGGESTIONS_USER_PROMPT), plan_info)
+        
+        async for chunk in chunks:
+            raw_response += chunk
+            for event, data in parser.feed(chunk):
+                yield sse_event(event, data)
+        for event, data in parser.close():
+            yield sse_event(event, data)
+        
+        result = parser.result(raw_response)
+        if prompt_stats is not None:
+            result["prompt_stats"] = prompt_stats
+        if llm_messages is not None:
+            if "image_context" in result and image_cache_key is not None:
+                await store_cached_image_context(*image_cache_key, result["image_context"])
+            result.setdefault("image_context", result["analysis"])
+        elif cached_result is None:
+            await store_cached_suggestions(cache_key, result)
+        
+        analysis_doc.update(result)
+        analysis_id = await save_analysis(analysis_doc)
+        completed = True
+        if thread is not None:
+            await save_thread(thread, analysis_doc["user_id"], result, analysis_id)
+        
+        yield sse_event("done", {
+            "analysis_id": str(analysis_id),
+            "analysis_text": result["analysis"],
+            "suggestions": result["suggestions"],
+            "tone_used": tone,
+            "goal_used": goal,
+            "conversation_id": analysis_doc.get("conversation_id")
+        })
     except Exception as e:
-        raise HTTPException(status_code=500, detail="Logout failed")
+        print(f"Error streaming suggestions: {e}")
+        yield sse_event("error", {"error": "Failed to generate suggestions", "message": str(e)})
+    finally:
+        if not completed and raw_response:
+            # Client went away (or the LLM failed) mid-stream: keep what was
+            # generated. Scheduled as a task since this generator may be closing.
+            analysis_doc.update(parser.result(raw_response))
+            analysis_doc["partial"] = True
+            asyncio.ensure_future(save_analysis(analysis_doc))
+
+async def stream_image_analysis_events(
+    analysis_doc: dict,
+    image: dict,
+    request: ImageAnalysisRequest,
+    plan_info: dict
+):
+    single_call = plan_info["image_pipeline"] == "single_call"
+    try:
+        if single_call:
+            image_context = None
+            if not request.bypass_cache:
+                image_context = await find_cached_image_context(image, request.context, analysis_doc["user_id"])
+        else:
+            image_context = await extract_image_context(
+                image, request.context, analysis_doc["user_id"], not request.bypass_cache, plan_info
+            )
+    except Exception as e:
+        print(f"Error streaming image analysis: {e}")
+        yield sse_event("error", {"error": "Failed to analyze image", "message": str(e)})
+        return
+    
+    if image_context is None:
+        # Single-call pipeline: the image goes out with the suggestions prompt
+        async for event in stream_suggestion_events(
+            analysis_doc,
+            conversation_context="",
+            tone=request.tone,
+            goal=request.goal,
+            plan_info=plan_info,
+            llm_messages=llm_stream_messages(
+                build_image_suggestions_prompt(request.context, request.tone, request.goal, plan_info["suggestions_count"]),
+                IMAGE_SUGGESTIONS_USER_PROMPT,
+                image
+            ),
+            image_cache_key=(image, request.context, analysis_doc["user_id"])
+        ):
+            yield event
+        return
+    
+    analysis_doc["image_context"] = image_context
+    yield sse_event("status", {"stage": "image_analyzed"})
+    
+    async for event in stream_suggestion_events(
+        analysis_doc,
+        conversation_context=image_context,
+        tone=request.tone,
+        goal=request.goal,
+        plan_info=plan_info,
+        use_cache=not request.bypass_cache
+    ):
+        yield event
+
+def sse_response(events) -> StreamingResponse:
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 # Analysis endpoints
 @app.post("/api/analyze-text", response_model=AnalysisResponse)
-async def analyze_text_conversation(request: TextAnalysisRequest, current_user: User = Depends(get_current_user)):
-    """Analyze a text conversation and provide suggestions"""
+async def analyze_text_conversation(
+    request: TextAnalysisRequest,
+    run_async: bool = Query(False, alias="async"),
+    current_user: User = Depends(get_current_user)
+):
+    """Analyze a text conversation and provide suggestions.
+
+    With ?async=true the analysis runs as a background job and the response
+    is 202 with a job_id to poll at /api/jobs/{job_id}.
+    """
     
     try:
         # Check subscription
         plan_info = check_subscription_and_limits(current_user)
         
-        # Generate suggestions
-        result = await generate_suggestions(
-            conversation_context=request.conversation_text,
-            tone=request.tone,
-            goal=request.goal,
-            plan_info=plan_info,
-            is_image=False
-        )
-        
-        # Save to database
-        analysis_doc = {
-            "user_id": current_user.user_id,
-            "conversation_text": request.conversation_text,
-            "tone": request.tone,
-            "goal": request.goal,
-            "analysis": result["analysis"],
-            "suggestions": result["suggestions"],
-            "raw_response": result["raw_response"],
-            "created_at": datetime.utcnow(),
-            "type": "text",
-            "plan": current_user.subscription_plan
-        }
-        
-        analysis_id = analyses_collection.insert_one(analysis_doc).inserted_id
+        if run_async:
+            job = await analysis_job_runner.submit("text", current_user, request.dict())
+            return job_accepted_response(job)
         
-        return AnalysisResponse(
-            analysis_id=str(analysis_id),
-            suggestions=result["suggestions"],
-            analysis_text=result["analysis"],
-            tone_used=request.tone,
-            goal_used=request.goal
-        )
+        return await analyze_text(request, current_user, plan_info)
         
     except HTTPException:
         raise
@@ -479,91 +3889,311 @@ async def analyze_text_conversation(request: TextAnalysisRequest, current_user:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/analyze-image", response_model=AnalysisResponse)
-async def analyze_image_conversation(request: ImageAnalysisRequest, current_user: User = Depends(get_current_user)):
-    """Analyze an image (screenshot or photo) and provide suggestions"""
+async def analyze_image_conversation(
+    request: ImageAnalysisRequest,
+    run_async: bool = Query(False, alias="async"),
+    current_user: User = Depends(get_current_user)
+):
+    """Analyze an image (screenshot or photo) and provide suggestions; ?async=true runs it as a job"""
     
     try:
         # Check subscription
         plan_info = check_subscription_and_limits(current_user)
         
-        # First, analyze the image to extract context
-        image_context = await analyze_image_content(
-            request.image_base64,
-            request.context
-        )
+        # Decode, validate and shrink the upload once
+        image = await prepare_image(request.image_base64)
         
-        # Then generate suggestions based on the extracted context
-        result = await generate_suggestions(
-            conversation_context=image_context,
+        if run_async:
+            return await submit_image_job(image, request.tone, request.goal, request.context, request.bypass_cache, current_user)
+        
+        return await analyze_prepared_image(
+            image,
             tone=request.tone,
             goal=request.goal,
-            plan_info=plan_info,
-            is_image=True
+            context=request.context,
+            use_cache=not request.bypass_cache,
+            current_user=current_user,
+            plan_info=plan_info
         )
         
-        # Save to database
-        analysis_doc = {
-            "user_id": current_user.user_id,
-            "image_base64": request.image_base64,
-            "image_context": image_context,
-            "tone": request.tone,
-            "goal": request.goal,
-            "analysis": result["analysis"],
-            "suggestions": result["suggestions"],
-            "raw_response": result["raw_response"],
-            "created_at": datetime.utcnow(),
-            "type": "image",
-            "plan": current_user.subscription_plan
-        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error in analyze_image_conversation: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/analyze-image/upload", response_model=AnalysisResponse)
+async def analyze_image_upload(
+    image: UploadFile = File(...),
+    tone: str = Form(...),
+    goal: str = Form(...),
+    context: Optional[str] = Form(None),
+    bypass_cache: bool = Form(False),
+    run_async: bool = Query(False, alias="async"),
+    current_user: User = Depends(get_current_user)
+):
+    """Analyze an image sent as a multipart file upload instead of base64 JSON; ?async=true runs it as a job"""
+    
+    try:
+        # Check subscription
+        plan_info = check_subscription_and_limits(current_user)
         
-        analysis_id = analyses_collection.insert_one(analysis_doc).inserted_id
+        prepared = await prepare_image_upload(image)
         
-        return AnalysisResponse(
-            analysis_id=str(analysis_id),
-            suggestions=result["suggestions"],
-            analysis_text=result["analysis"],
-            tone_used=request.tone,
-            goal_used=request.goal
+        if run_async:
+            return await submit_image_job(prepared, tone, goal, context, bypass_cache, current_user)
+        
+        return await analyze_prepared_image(
+            prepared,
+            tone=tone,
+            goal=goal,
+            context=context,
+            use_cache=not bypass_cache,
+            current_user=current_user,
+            plan_info=plan_info
         )
         
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error in analyze_image_conversation: {e}")
+        print(f"Error in analyze_image_upload: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        await image.close()
+
+@app.post("/api/analyze-text/batch")
+async def analyze_text_batch(
+    request: BatchTextAnalysisRequest,
+    stream: bool = False,
+    current_user: User = Depends(get_current_user)
+):
+    """Analyze up to BATCH_MAX_ITEMS conversations in one call (Pro plan).
+
+    Items run concurrently and every analysis is written with one bulk
+    insert. ?stream=true returns NDJSON lines as items finish instead.
+    """
+    
+    # Each item counts against the per-minute and per-day limits
+    plan_info = check_subscription_and_limits(current_user, required_plan="pro", cost=len(request.items))
+    
+    if stream:
+        return StreamingResponse(
+            stream_text_batch(request.items, current_user, plan_info),
+            media_type="application/x-ndjson",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+    
+    try:
+        results = [None] * len(request.items)
+        analysis_docs = []
+        async for index, analysis_doc, error in run_text_batch(request.items, current_user, plan_info):
+            results[index] = batch_item_result(index, analysis_doc, error)
+            if analysis_doc is not None:
+                analysis_docs.append(analysis_doc)
+        
+        await save_analyses(analysis_docs)
+        return {
+            "results": results,
+            "succeeded": len(analysis_docs),
+            "failed": len(results) - len(analysis_docs)
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error in analyze_text_batch: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/analyze-text/stream")
+async def analyze_text_conversation_stream(request: TextAnalysisRequest, current_user: User = Depends(get_current_user)):
+    """Stream analysis and suggestions for a text conversation as Server-Sent Events"""
+    
+    plan_info = check_subscription_and_limits(current_user)
+    thread = await resolve_text_thread(request, current_user, plan_info)
+    
+    analysis_doc = {
+        "user_id": current_user.user_id,
+        "conversation_text": request.conversation_text,
+        "tone": request.tone,
+        "goal": request.goal,
+        "created_at": datetime.utcnow(),
+        "type": "text",
+        "plan": current_user.subscription_plan
+    }
+    if thread:
+        analysis_doc.update(thread_fields(thread))
+    
+    return sse_response(stream_suggestion_events(
+        analysis_doc,
+        conversation_context=thread["context"] if thread else request.conversation_text,
+        tone=request.tone,
+        goal=request.goal,
+        plan_info=plan_info,
+        use_cache=not request.bypass_cache,
+        thread=thread
+    ))
+
+@app.post("/api/analyze-image/stream")
+async def analyze_image_conversation_stream(request: ImageAnalysisRequest, current_user: User = Depends(get_current_user)):
+    """Stream analysis and suggestions for an image as Server-Sent Events"""
+    
+    plan_info = check_subscription_and_limits(current_user)
+    image = await prepare_image(request.image_base64)
+    image_fields = await store_image(image["image_bytes"], image["content_type"])
+    
+    analysis_doc = {
+        "user_id": current_user.user_id,
+        **image_fields,
+        "tone": request.tone,
+        "goal": request.goal,
+        "created_at": datetime.utcnow(),
+        "type": "image",
+        "plan": current_user.subscription_plan
+    }
+    
+    return sse_response(stream_image_analysis_events(analysis_doc, image, request, plan_info))
+
+@app.get("/api/jobs/{job_id}")
+async def get_job_status(
+    job_id: str,
+    request: Request,
+    wait: float = 0,
+    current_user: User = Depends(get_current_user)
+):
+    """Status of a background analysis job, with the result once it succeeds.
+
+    Long poll: with ?wait=N and If-None-Match set to the last ETag, the
+    response is held for up to N seconds until the job changes, then 304 if
+    it still has not.
+    """
+    if not ObjectId.is_valid(job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+    query = {"_id": ObjectId(job_id), "user_id": current_user.user_id}
+    projection = {"request": 0}
+    job = await analysis_jobs_collection.find_one(query, projection)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    if_none_match = request.headers.get("if-none-match")
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + min(max(wait, 0), JOB_POLL_MAX_WAIT_SECONDS)
+    while job_etag(job) == if_none_match and job["status"] not in JOB_TERMINAL_STATUSES:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        # Woken early by this process's workers; re-read at least every second for other processes
+        await analysis_job_runner.wait_for_change(job_id, min(remaining, 1.0))
+        job = await analysis_jobs_collection.find_one(query, projection)
+    
+    etag = job_etag(job)
+    if etag == if_none_match:
+        return Response(status_code=304, headers={"ETag": etag})
+    return JSONResponse(content=job_status_body(job), headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+@app.get("/api/stats")
+async def get_user_stats(current_user: User = Depends(get_current_user)):
+    """Pattern analysis (Pro): tone/goal mix, activity and suggestion lengths from two indexed reads"""
+    
+    check_subscription_and_limits(current_user, required_plan="pro", cost=0)
+    today = datetime.utcnow().date()
+    first_day = today - timedelta(days=USER_STATS_ROLLING_DAYS - 1)
+    stats, daily = await asyncio.gather(
+        user_stats_collection.find_one({"_id": current_user.user_id}),
+        user_stats_daily_collection.find({"_id": {
+            "$gte": daily_stats_id(current_user.user_id, first_day.strftime("%Y-%m-%d")),
+            "$lte": daily_stats_id(current_user.user_id, today.strftime("%Y-%m-%d"))
+        }}).to_list(length=USER_STATS_ROLLING_DAYS)
+    )
+    return user_stats_view(stats, daily)
+
 @app.get("/api/history")
-async def get_user_history(current_user: User = Depends(get_current_user), limit: int = 20):
-    """Get user's analysis history"""
+async def get_user_history(
+    current_user: User = Depends(get_current_user),
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None
+):
+    """Get user's analysis history, newest first, one keyset page at a time"""
+    
+    limit = max(1, min(limit, HISTORY_PAGE_MAX))
+    requested_fields = HISTORY_DEFAULT_FIELDS
+    if fields:
+        requested_fields = [field.strip() for field in fields.split(",") if field.strip()]
+        unknown = set(requested_fields) - HISTORY_ALLOWED_FIELDS
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown history fields: {', '.join(sorted(unknown))}")
+    
+    match = {"user_id": current_user.user_id}
+    if cursor:
+        created_at, last_id = decode_history_cursor(cursor)
+        match["$or"] = [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "_id": {"$lt": last_id}}
+        ]
     
     try:
-        analyses = list(
-            analyses_collection.find({"user_id": current_user.user_id})
-            .sort("created_at", -1)
-            .limit(limit)
-        )
+        # Fetch one extra row to know whether another page exists
+        analyses = await analyses_collection.aggregate([
+            {"$match": match},
+            {"$sort": {"created_at": -1, "_id": -1}},
+            {"$limit": limit + 1},
+            {"$project": history_projection(requested_fields)}
+        ]).to_list(length=limit + 1)
+        
+        next_cursor = None
+        if len(analyses) > limit:
+            analyses = analyses[:limit]
+            next_cursor = encode_history_cursor(analyses[-1]["created_at"], analyses[-1]["_id"])
         
         # Convert ObjectId to string and format response
         for analysis in analyses:
             analysis["_id"] = str(analysis["_id"])
-            analysis["created_at"] = analysis["created_at"].isoformat()
-            # Don't send full image data in list view
-            if "image_base64" in analysis:
-                analysis["has_image"] = True
-                del analysis["image_base64"]
+            if "created_at" in requested_fields:
+                analysis["created_at"] = analysis["created_at"].isoformat()
+            else:
+                # Kept only to build the cursor
+                del analysis["created_at"]
         
-        return {"analyses": analyses}
+        return {"analyses": analyses, "next_cursor": next_cursor}
         
     except Exception as e:
         print(f"Error fetching history: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/export")
+async def export_history(export_format: str = Query("ndjson", alias="format"), current_user: User = Depends(get_current_user)):
+    """Stream every analysis the user has, newest first, as NDJSON or (Pro) PDF.
+
+    Documents come straight off a Mongo cursor in batches, so memory stays
+    flat however long the history is; images are exported as image_url
+    references, never inline.
+    """
+    
+    filename = f"talktutor-history-{datetime.utcnow().strftime('%Y%m%d')}"
+    if export_format == "ndjson":
+        return StreamingResponse(
+            export_ndjson(current_user.user_id),
+            media_type="application/x-ndjson",
+            headers={"Content-Disposition": f'attachment; filename="{filename}.ndjson"'}
+        )
+    if export_format == "pdf":
+        check_subscription_and_limits(current_user, required_plan="pro", cost=0)
+        fonts = await asyncio.to_thread(load_pdf_fonts)
+        if not fonts:
+            raise HTTPException(status_code=503, detail="PDF export is unavailable: no font found (set PDF_FONT_PATHS)")
+        return StreamingResponse(
+            export_pdf(current_user, fonts),
+            media_type="application/pdf",
+            headers={"Content-Disposition": f'attachment; filename="{filename}.pdf"'}
+        )
+    raise HTTPException(status_code=400, detail="Unsupported export format (use ndjson or pdf)")
+
 @app.get("/api/analysis/{analysis_id}")
 async def get_analysis_detail(analysis_id: str, current_user: User = Depends(get_current_user)):
-    """Get detailed analysis including image if available"""
+    """Get detailed analysis, with an image_url if it has an image"""
     
     try:
-        analysis = analyses_collection.find_one({"_id": ObjectId(analysis_id)})
+        analysis = await find_analysis(ObjectId(analysis_id))
         
         if not analysis:
             raise HTTPException(status_code=404, detail="Analysis not found")
@@ -574,6 +4204,8 @@ async def get_analysis_detail(analysis_id: str, current_user: User = Depends(get
         
         analysis["_id"] = str(analysis["_id"])
         analysis["created_at"] = analysis["created_at"].isoformat()
+        if analysis.get("image_ref"):
+            analysis["image_url"] = image_url(analysis["image_ref"])
         
         return analysis
         
@@ -583,6 +4215,35 @@ async def get_analysis_detail(analysis_id: str, current_user: User = Depends(get
         print(f"Error fetching analysis detail: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/images/{image_ref}")
+async def get_image(image_ref: str, request: Request, current_user: User = Depends(get_current_user)):
+    """Serve a stored image; content-addressed, so responses never change"""
+    
+    etag = f'"{image_ref}"'
+    analysis = await analyses_collection.find_one(
+        {"user_id": current_user.user_id, "image_ref": image_ref},
+        {"image_content_type": 1}
+    )
+    if not analysis:
+        raise HTTPException(status_code=404, detail="Image not found")
+    
+    cache_headers = {
+        "ETag": etag,
+        "Cache-Control": "private, max-age=31536000, immutable"
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=cache_headers)
+    
+    image_bytes = await image_store.get(image_ref)
+    if image_bytes is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    
+    return Response(
+        content=image_bytes,
+        media_type=analysis.get("image_content_type") or "application/octet-stream",
+        headers=cache_headers
+    )
+
 # Subscription endpoints
 @app.get("/api/subscription/plans")
 async def get_plans():
@@ -610,7 +4271,7 @@ async def activate_subscription(
         expires_at = datetime.now(timezone.utc) + timedelta(days=365)
     
     # Update user
-    users_collection.update_one(
+    await users_collection.update_one(
         {"user_id": current_user.user_id},
         {
             "$set": {
@@ -619,6 +4280,7 @@ async def activate_subscription(
             }
         }
     )
+    invalidate_user_cache(current_user.user_id)
     
     return {
         "success": True,
@@ -626,6 +4288,35 @@ async def activate_subscription(
         "expires_at": expires_at.isoformat()
     }
 
+async def require_metrics_token(authorization: Optional[str] = Header(None)):
+    """Operational endpoints are for the scraper only"""
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    token = extract_session_token(authorization) if authorization else ""
+    if not hmac.compare_digest(token.encode("utf-8"), METRICS_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+
+@app.get("/api/metrics", dependencies=[Depends(require_metrics_token)])
+async def get_metrics():
+    """Prometheus text exposition of request, stage, LLM and cache metrics"""
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/cache/stats", dependencies=[Depends(require_metrics_token)])
+async def get_cache_stats():
+    """In-process cache counters, used to size the caches"""
+    return {
+        "user_cache": user_cache.stats(),
+        "suggestion_cache": suggestion_cache.stats(),
+        "llm_single_flight": llm_flights.stats(),
+        "analysis_writer": analysis_writer.stats(),
+        "llm_scheduler": llm_scheduler.stats(),
+        "rate_limiter": rate_limiter.stats(),
+        "analysis_jobs": analysis_job_runner.stats(),
+        "llm_circuit_breakers": {model: breaker.stats() for model, breaker in llm_breakers.items()}
+    }
+
 @app.post("/api/dev/create-test-user")
 async def create_test_user():
     """DEVELOPMENT ONLY: Create a test user with premium access"""
@@ -644,7 +4335,7 @@ async def create_test_user():
         "subscription_plan": "pro",
         "subscription_expires": expires_at
     }
-    users_collection.insert_one(user_doc)
+    await users_collection.insert_one(user_doc)
     
     # Create session
     session_doc = {
@@ -653,7 +4344,7 @@ async def create_test_user():
         "expires_at": datetime.now(timezone.utc) + timedelta(days=7),
         "created_at": datetime.now(timezone.utc)
     }
-    user_sessions_collection.insert_one(session_doc)
+    await user_sessions_collection.insert_one(session_doc)
     
     return {
         "user_id": user_id,
@@ -665,6 +4356,82 @@ async def create_test_user():
         "instructions": "Save this session_token and use it in AsyncStorage with key 'session_token'"
     }
 
+# Maintenance commands
+async def migrate_inline_images():
+    """Move image_base64 out of existing analyses documents into the image store"""
+    migrated = 0
+    cursor = analyses_collection.find(
+        {"image_base64": {"$exists": True}},
+        {"image_base64": 1}
+    )
+    async for analysis in cursor:
+        try:
+            image_fields = await store_image(base64.b64decode(analysis["image_base64"]))
+        except Exception as e:
+            print(f"Skipping analysis {analysis['_id']}: {e}")
+            continue
+        await analyses_collection.update_one(
+            {"_id": analysis["_id"]},
+            {"$set": image_fields, "$unset": {"image_base64": ""}}
+        )
+        migrated += 1
+        if migrated % 100 == 0:
+            print(f"Migrated {migrated} images...")
+    print(f"Migrated {migrated} images to the {IMAGE_STORE_BACKEND} image store")
+
+async def rebuild_user_stats():
+    """Recompute every user_stats and user_stats_daily document from the analyses collection.
+
+    Analyses are read in user order (served by the user_id index), so only
+    one user's totals are held in memory at a time. Analyses written while
+    this runs may be missed or double counted; run it again if that matters.
+    """
+    projection = {"user_id": 1, "type": 1, "tone": 1, "goal": 1, "suggestions": 1, "created_at": 1}
+    current_user_id = None
+    updates = []
+    rebuilt = 0
+    
+    async def write_user(user_id: str, user_updates: List[dict], user_daily_updates: dict):
+        await user_stats_collection.delete_one({"_id": user_id})
+        await user_stats_collection.update_one({"_id": user_id}, merge_stats_updates(user_updates), upsert=True)
+        # ';' sorts right after ':', so this range is exactly the user's day documents
+        await user_stats_daily_collection.delete_many({"_id": {"$gte": f"{user_id}:", "$lt": f"{user_id};"}})
+        if user_daily_updates:
+            await user_stats_daily_collection.bulk_write(stats_upserts(user_daily_updates), ordered=False)
+    
+    window_start = datetime.combine(datetime.utcnow().date(), datetime.min.time()) - timedelta(days=USER_STATS_ROLLING_DAYS)
+    daily_updates = {}
+    
+    async for analysis in analyses_collection.find({}, projection).sort("user_id", 1):
+        if analysis.get("user_id") != current_user_id:
+            if updates:
+                await write_user(current_user_id, updates, daily_updates)
+                rebuilt += 1
+            current_user_id = analysis.get("user_id")
+            updates = []
+            daily_updates = {}
+        updates.append(analysis_stats_update(analysis))
+        if analysis.get("created_at") and analysis["created_at"] >= window_start:
+            daily_id, daily_update = daily_stats_update(analysis)
+            daily_updates.setdefault(daily_id, []).append(daily_update)
+    if updates:
+        await write_user(current_user_id, updates, daily_updates)
+        rebuilt += 1
+    print(f"Rebuilt stats for {rebuilt} users")
+
+COMMANDS = {
+    "ensure-indexes": ensure_indexes,
+    "migrate-images": migrate_inline_images,
+    "rebuild-stats": rebuild_user_stats,
+}
+
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
+    import sys
+    if len(sys.argv) > 1:
+        command = COMMANDS.get(sys.argv[1])
+        if command is None:
+            sys.exit(f"Unknown command: {sys.argv[1]} (available: {', '.join(COMMANDS)})")
+        asyncio.run(command())
+    else:
+        import uvicorn
+        uvicorn.run(app, host="0.0.0.0", port=8001)
@@ -1,17 +1,20 @@
-import React, { useEffect, useState } from 'react';
-import { View, Text, StyleSheet, TouchableOpacity, ScrollView, ActivityIndicator } from 'react-native';
+import React, { useCallback, useEffect, useRef, useState } from 'react';
+import { View, Text, StyleSheet, TouchableOpacity, FlatList, ActivityIndicator } from 'react-native';
 import { SafeAreaView } from 'react-native-safe-area-context';
 import { Ionicons } from '@expo/vector-icons';
 import { useRouter } from 'expo-router';
 import { useStore } from '../../store/useStore';
 import { getUserHistory } from '../../services/api';
 
+const PAGE_SIZE = 20;
+
 interface Analysis {
   _id: string;
   type: 'text' | 'image';
   tone: string;
   goal: string;
   created_at: string;
+  preview?: string;
   has_image?: boolean;
 }
 
@@ -20,22 +23,36 @@ export default function HistoryScreen() {
   const { user } = useStore();
   const [analyses, setAnalyses] = useState<Analysis[]>([]);
   const [loading, setLoading] = useState(true);
+  const [loadingMore, setLoadingMore] = useState(false);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const fetchingRef = useRef(false);
 
-  useEffect(() => {
-    loadHistory();
-  }, []);
-
-  const loadHistory = async () => {
-    if (!user) return;
+  const loadPage = useCallback(async (cursor: string | null) => {
+    if (!user || fetchingRef.current) return;
+    fetchingRef.current = true;
 
     try {
-      const response = await getUserHistory(user.id);
-      setAnalyses(response.analyses || []);
+      const response = await getUserHistory({ limit: PAGE_SIZE, cursor });
+      const page = (response.analyses || []) as Analysis[];
+      setAnalyses((previous) => (cursor ? [...previous, ...page] : page));
+      setNextCursor(response.next_cursor);
     } catch (error) {
       console.error('Error loading history:', error);
     } finally {
+      fetchingRef.current = false;
       setLoading(false);
+      setLoadingMore(false);
     }
+  }, [user]);
+
+  useEffect(() => {
+    loadPage(null);
+  }, [loadPage]);
+
+  const loadMore = () => {
+    if (!nextCursor || fetchingRef.current) return;
+    setLoadingMore(true);
+    loadPage(nextCursor);
   };
 
   const formatDate = (dateString: string) => {
@@ -69,8 +86,13 @@ export default function HistoryScreen() {
         <Text style={styles.headerSubtitle}>Your past analyses</Text>
       </View>
 
-      <ScrollView style={styles.content}>
-        {analyses.length === 0 ? (
+      <FlatList
+        style={styles.content}
+        data={analyses}
+        keyExtractor={(analysis) => analysis._id}
+        onEndReached={loadMore}
+        onEndReachedThreshold={0.5}
+        ListEmptyComponent={
           <View style={styles.emptyState}>
             <Ionicons name="time-outline" size={64} color="#d1d5db" />
             <Text style={styles.emptyText}>No analyses yet</Text>
@@ -78,32 +100,38 @@ export default function HistoryScreen() {
               Start by analyzing your first conversation!
             </Text>
           </View>
-        ) : (
-          analyses.map((analysis) => (
-            <TouchableOpacity
-              key={analysis._id}
-              style={styles.analysisCard}
-              onPress={() => router.push(`/results?analysisId=${analysis._id}`)}
-            >
-              <View style={styles.analysisIcon}>
-                <Ionicons
-                  name={analysis.type === 'image' ? 'image' : 'chatbubble-ellipses'}
-                  size={24}
-                  color="#6366f1"
-                />
-              </View>
-              <View style={styles.analysisContent}>
-                <Text style={styles.analysisTitle}>
-                  {analysis.tone.charAt(0).toUpperCase() + analysis.tone.slice(1)} •{' '}
-                  {analysis.goal.charAt(0).toUpperCase() + analysis.goal.slice(1)}
+        }
+        ListFooterComponent={
+          loadingMore ? <ActivityIndicator style={styles.footerLoader} color="#6366f1" /> : null
+        }
+        renderItem={({ item: analysis }) => (
+          <TouchableOpacity
+            style={styles.analysisCard}
+            onPress={() => router.push(`/results?analysisId=${analysis._id}`)}
+          >
+            <View style={styles.analysisIcon}>
+              <Ionicons
+                name={analysis.type === 'image' ? 'image' : 'chatbubble-ellipses'}
+                size={24}
+                color="#6366f1"
+              />
+            </View>
+            <View style={styles.analysisContent}>
+              <Text style={styles.analysisTitle}>
+                {analysis.tone.charAt(0).toUpperCase() + analysis.tone.slice(1)} •{' '}
+                {analysis.goal.charAt(0).toUpperCase() + analysis.goal.slice(1)}
+              </Text>
+              {analysis.preview ? (
+                <Text style={styles.analysisPreview} numberOfLines={1}>
+                  {analysis.preview}
                 </Text>
-                <Text style={styles.analysisDate}>{formatDate(analysis.created_at)}</Text>
-              </View>
-              <Ionicons name="chevron-forward" size={20} color="#9ca3af" />
-            </TouchableOpacity>
-          ))
+              ) : null}
+              <Text style={styles.analysisDate}>{formatDate(analysis.created_at)}</Text>
+            </View>
+            <Ionicons name="chevron-forward" size={20} color="#9ca3af" />
+          </TouchableOpacity>
         )}
-      </ScrollView>
+      />
     </SafeAreaView>
   );
 }
@@ -180,8 +208,16 @@ const styles = StyleSheet.create({
     color: '#1f2937',
     marginBottom: 4,
   },
+  analysisPreview: {
+    fontSize: 14,
+    color: '#4b5563',
+    marginBottom: 4,
+  },
   analysisDate: {
     fontSize: 14,
     color: '#6b7280',
   },
+  footerLoader: {
+    paddingVertical: 16,
+  },
 });
@@ -175,7 +175,7 @@ const translations = {
       standard: {
         name: 'Standard',
         features: [
-          'Unlimited conversation analysis',
+          'Up to 300 conversation analyses per day',
           'Standard AI model',
           '3 suggestions per analysis',
           'Complete history access'
@@ -399,7 +399,7 @@ const translations = {
       standard: {
         name: 'Estándar',
         features: [
-          'Análisis de conversación ilimitado',
+          'Hasta 300 análisis de conversación al día',
           'Modelo de IA estándar',
           '3 sugerencias por análisis',
           'Acceso completo al historial'
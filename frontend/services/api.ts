@@ -36,6 +36,7 @@ export interface AnalyzeTextRequest {
   conversation_text: string;
   tone: string;
   goal: string;
+  conversation_id?: string;
 }
 
 export interface AnalyzeImageRequest {
@@ -45,12 +46,21 @@ export interface AnalyzeImageRequest {
   context?: string;
 }
 
+export interface AnalyzeImageUploadRequest {
+  image_uri: string;
+  mime_type?: string;
+  tone: string;
+  goal: string;
+  context?: string;
+}
+
 export interface AnalysisResponse {
   analysis_id: string;
   suggestions: string[];
   analysis_text: string;
   tone_used: string;
   goal_used: string;
+  conversation_id?: string | null;
 }
 
 export const analyzeText = async (data: AnalyzeTextRequest): Promise<AnalysisResponse> => {
@@ -63,8 +73,89 @@ export const analyzeImage = async (data: AnalyzeImageRequest): Promise<AnalysisR
   return response.data;
 };
 
-export const getUserHistory = async (limit: number = 20) => {
-  const response = await api.get('/api/history', { params: { limit } });
+export const analyzeImageUpload = async (data: AnalyzeImageUploadRequest): Promise<AnalysisResponse> => {
+  const mimeType = data.mime_type || 'image/jpeg';
+  const formData = new FormData();
+  formData.append('image', {
+    uri: data.image_uri,
+    name: `upload.${mimeType.split('/')[1] || 'jpg'}`,
+    type: mimeType,
+  } as any);
+  formData.append('tone', data.tone);
+  formData.append('goal', data.goal);
+  if (data.context) {
+    formData.append('context', data.context);
+  }
+
+  const response = await api.post('/api/analyze-image/upload', formData, {
+    headers: { 'Content-Type': 'multipart/form-data' },
+  });
+  return response.data;
+};
+
+export interface AnalysisJob {
+  job_id: string;
+  status: 'queued' | 'running' | 'succeeded' | 'failed';
+  result?: AnalysisResponse;
+  error?: { status_code: number; detail: string };
+}
+
+// Runs the analysis as a background job, so it survives slow LLM calls and dropped connections
+export const analyzeImageAsync = async (data: AnalyzeImageRequest): Promise<AnalysisResponse> => {
+  const response = await api.post('/api/analyze-image', data, { params: { async: true } });
+  return waitForJob(response.data.job_id);
+};
+
+export const waitForJob = async (jobId: string): Promise<AnalysisResponse> => {
+  let etag: string | undefined;
+  let job: AnalysisJob | undefined;
+  while (!job || (job.status !== 'succeeded' && job.status !== 'failed')) {
+    const response = await api.get(`/api/jobs/${jobId}`, {
+      params: { wait: 25 },
+      headers: etag ? { 'If-None-Match': etag } : {},
+      validateStatus: (status) => status === 200 || status === 304,
+    });
+    if (response.status === 200) {
+      job = response.data;
+      etag = response.headers.etag;
+    }
+  }
+  if (job.status === 'failed') {
+    throw new Error(job.error?.detail || 'Analysis failed');
+  }
+  return job.result as AnalysisResponse;
+};
+
+export interface HistoryPageParams {
+  limit?: number;
+  cursor?: string | null;
+  fields?: string[];
+}
+
+export interface HistoryItem {
+  _id: string;
+  type?: 'text' | 'image';
+  tone?: string;
+  goal?: string;
+  created_at?: string;
+  preview?: string;
+  has_image?: boolean;
+}
+
+export interface HistoryPage {
+  analyses: HistoryItem[];
+  next_cursor: string | null;
+}
+
+export const getUserHistory = async ({ limit = 20, cursor, fields }: HistoryPageParams = {}): Promise<HistoryPage> => {
+  const params: Record<string, string | number> = { limit };
+  if (cursor) {
+    params.cursor = cursor;
+  }
+  if (fields && fields.length > 0) {
+    params.fields = fields.join(',');
+  }
+  const response = await api.get('/api/history', { params });
   return response.data;
 };
 
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# server.py lives in backend/ and reads its settings at import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+os.environ.setdefault("DB_NAME", "talktutor_tests")
+os.environ.setdefault("IMAGE_STORE_BACKEND", "filesystem")
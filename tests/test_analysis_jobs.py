@@ -0,0 +1,241 @@
+import asyncio
+import copy
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from bson import ObjectId
+
+import server
+from server import AnalysisJobRunner
+
+
+def matches(doc, query):
+    for field, condition in query.items():
+        value = doc.get(field)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+        elif "$lt" in condition and not (value is not None and value < condition["$lt"]):
+            return False
+        elif "$gte" in condition and not (value is not None and value >= condition["$gte"]):
+            return False
+        elif "$in" in condition and value not in condition["$in"]:
+            return False
+        elif "$nin" in condition and value in condition["$nin"]:
+            return False
+    return True
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, field, direction):
+        self.docs.sort(key=lambda doc: doc[field], reverse=direction < 0)
+        return self
+
+    async def __aiter__(self):
+        for doc in self.docs:
+            yield doc
+
+
+class FakeCollection:
+    """Stand-in for analysis_jobs and analyses: the queries and updates the job runner makes"""
+
+    def __init__(self):
+        self.docs = {}
+
+    async def insert_one(self, doc):
+        self.docs[doc["_id"]] = copy.deepcopy(doc)
+
+    async def find_one(self, query, projection=None):
+        return next((copy.deepcopy(doc) for doc in self.docs.values() if matches(doc, query)), None)
+
+    def find(self, query, projection=None):
+        return FakeCursor([copy.deepcopy(doc) for doc in self.docs.values() if matches(doc, query)])
+
+    def apply(self, doc, update):
+        doc.update(update.get("$set", {}))
+        for field, amount in update.get("$inc", {}).items():
+            doc[field] = doc.get(field, 0) + amount
+        for field in update.get("$unset", {}):
+            doc.pop(field, None)
+
+    async def find_one_and_update(self, query, update, return_document):
+        doc = next((doc for doc in self.docs.values() if matches(doc, query)), None)
+        if doc is None:
+            return None
+        self.apply(doc, update)
+        return copy.deepcopy(doc)
+
+    async def update_one(self, query, update):
+        doc = next((doc for doc in self.docs.values() if matches(doc, query)), None)
+        if doc is not None:
+            self.apply(doc, update)
+        return SimpleNamespace(modified_count=int(doc is not None))
+
+    async def update_many(self, query, update):
+        docs = [doc for doc in self.docs.values() if matches(doc, query)]
+        for doc in docs:
+            self.apply(doc, update)
+        return SimpleNamespace(modified_count=len(docs))
+
+
+@pytest.fixture
+def jobs(monkeypatch):
+    fake = FakeCollection()
+    monkeypatch.setattr(server, "analysis_jobs_collection", fake)
+    return fake
+
+
+@pytest.fixture
+def analyses(monkeypatch):
+    fake = FakeCollection()
+    monkeypatch.setattr(server, "analyses_collection", fake)
+    return fake
+
+
+def job(status="queued", attempts=0, lease_minutes=None, age_minutes=0):
+    created = datetime.utcnow() - timedelta(minutes=age_minutes)
+    doc = {
+        "_id": ObjectId(),
+        "user_id": "user-1",
+        "kind": "text",
+        "request": {},
+        "status": status,
+        "attempts": attempts,
+        "analysis_id": ObjectId(),
+        "created_at": created,
+        "updated_at": created
+    }
+    if lease_minutes is not None:
+        doc["lease_expires_at"] = datetime.utcnow() + timedelta(minutes=lease_minutes)
+    return doc
+
+
+def test_a_job_retried_after_its_analysis_landed_saves_it_once(monkeypatch, jobs, analyses):
+    executed = []
+
+    async def fake_execute_analysis_job(job):
+        executed.append(job["_id"])
+        analysis_doc = {
+            "_id": job["analysis_id"],
+            "suggestions": ["Saturday?"],
+            "analysis": "They seem keen.",
+            "tone": "friendly",
+            "goal": "plan",
+            "conversation_id": None
+        }
+        await analyses.insert_one(analysis_doc)
+        return server.analysis_response(analysis_doc)
+
+    monkeypatch.setattr(server, "execute_analysis_job", fake_execute_analysis_job)
+
+    async def scenario():
+        runner = AnalysisJobRunner(0, 10)
+        runner.start()
+        record = job()
+        await jobs.insert_one(record)
+
+        # The process dies after saving the analysis but before recording the result
+        finish = runner.finish
+
+        async def crash(job_id, fields):
+            raise ConnectionError("process died")
+        runner.finish = crash
+        with pytest.raises(ConnectionError):
+            await runner.run_job(record["_id"])
+        runner._running.clear()
+        runner.finish = finish
+        assert jobs.docs[record["_id"]]["status"] == "running"
+
+        jobs.docs[record["_id"]]["lease_expires_at"] = datetime.utcnow() - timedelta(seconds=1)
+        assert await runner.sweep() == 1
+        await runner.run_job(await runner._queue.get())
+        await runner.stop()
+        return record
+
+    record = asyncio.run(scenario())
+
+    assert executed == [record["_id"]]
+    assert list(analyses.docs) == [record["analysis_id"]]
+    done = jobs.docs[record["_id"]]
+    assert done["status"] == "succeeded"
+    assert done["attempts"] == 2
+    assert done["result"]["analysis_id"] == str(record["analysis_id"])
+
+
+def test_sweep_requeues_or_fails_expired_leases(jobs):
+    expired = job("running", attempts=1, lease_minutes=-1)
+    exhausted = job("running", attempts=server.JOB_MAX_ATTEMPTS, lease_minutes=-1)
+    leased = job("running", attempts=1, lease_minutes=5)
+    slow = job("running", attempts=1, lease_minutes=-1)
+    for record in (expired, exhausted, leased, slow):
+        asyncio.run(jobs.insert_one(record))
+
+    async def scenario():
+        runner = AnalysisJobRunner(0, 10)
+        other = AnalysisJobRunner(0, 10)
+        runner.start()
+        other.start()
+        # Past its lease but still running in this process
+        runner._running.add(slow["_id"])
+        swept = await runner.sweep(), await other.sweep()
+        queued = runner._queue.qsize(), other._queue.qsize()
+        runner._running.clear()
+        await runner.stop()
+        await other.stop()
+        return swept, queued
+
+    swept, queued = asyncio.run(scenario())
+
+    assert jobs.docs[expired["_id"]]["status"] == "queued"
+    assert jobs.docs[exhausted["_id"]]["status"] == "failed"
+    assert jobs.docs[exhausted["_id"]]["error"]["status_code"] == 500
+    assert jobs.docs[leased["_id"]]["status"] == "running"
+    # The other process found the slow job's lease expired too, so it requeued it
+    assert jobs.docs[slow["_id"]]["status"] == "queued"
+    assert swept == (1, 1) and queued == (1, 1)
+
+
+def test_resume_enqueues_every_queued_job_but_the_sweep_only_stale_ones(jobs):
+    fresh = job("queued")
+    stale = job("queued", age_minutes=server.JOB_LEASE_SECONDS / 60 + 1)
+    abandoned = job("running", attempts=1, lease_minutes=-1, age_minutes=1)
+    for record in (fresh, stale, abandoned):
+        asyncio.run(jobs.insert_one(record))
+
+    async def scenario():
+        sweeper = AnalysisJobRunner(0, 10)
+        sweeper.start()
+        swept = await sweeper.sweep()
+        # Already in this process's queue, so not enqueued twice
+        swept_again = await sweeper.sweep()
+        await sweeper.stop()
+
+        restarted = AnalysisJobRunner(0, 10)
+        restarted.start()
+        resumed = await restarted.resume()
+        await restarted.stop()
+        return swept, swept_again, resumed
+
+    assert asyncio.run(scenario()) == (2, 0, 3)
+
+
+def test_wait_for_change_forgets_events_nobody_waits_on():
+    async def scenario():
+        runner = AnalysisJobRunner(0, 10)
+        first = asyncio.ensure_future(runner.wait_for_change("job-1", 0.05))
+        second = asyncio.ensure_future(runner.wait_for_change("job-1", 1))
+        await first
+        # The second poll is still waiting, so the first must not drop its event
+        assert "job-1" in runner.changed
+        runner.notify("job-1")
+        await asyncio.wait_for(second, 0.5)
+        assert runner.changed == {} and runner._waiting == {}
+
+        await runner.wait_for_change("job-2", 0.01)
+        assert runner.changed == {} and runner._waiting == {}
+
+    asyncio.run(scenario())
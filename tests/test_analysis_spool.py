@@ -0,0 +1,111 @@
+import asyncio
+import os
+
+import pytest
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+import server
+from server import AnalysisWriteQueue
+
+
+class FakeAnalyses:
+    """Stand-in for analyses.insert_many: unordered, with duplicate keys reported as code 11000"""
+
+    def __init__(self):
+        self.docs = {}
+        self.fail = None
+
+    async def insert_many(self, docs, ordered):
+        if self.fail is not None:
+            raise self.fail
+        errors = []
+        for index, doc in enumerate(docs):
+            if doc["_id"] in self.docs:
+                errors.append({"index": index, "code": 11000})
+            else:
+                self.docs[doc["_id"]] = dict(doc)
+        if errors:
+            raise BulkWriteError({"writeErrors": errors})
+
+
+@pytest.fixture
+def analyses(monkeypatch):
+    fake = FakeAnalyses()
+    monkeypatch.setattr(server, "analyses_collection", fake)
+    recorded = []
+
+    async def fake_record_analysis_stats(docs):
+        recorded.extend(doc["_id"] for doc in docs)
+
+    monkeypatch.setattr(server, "record_analysis_stats", fake_record_analysis_stats)
+    fake.recorded = recorded
+    return fake
+
+
+@pytest.fixture
+def writer(tmp_path):
+    return AnalysisWriteQueue(10, 3, 10, str(tmp_path / "spool.jsonl"))
+
+
+def analysis(number):
+    return {"_id": ObjectId(), "user_id": "user-1", "analysis": f"analysis {number}", "suggestions": ["hi"]}
+
+
+def test_rejected_batches_are_spooled_and_replayed(analyses, writer):
+    docs = [analysis(number) for number in range(5)]
+    analyses.fail = ConnectionError("mongo unavailable")
+    asyncio.run(writer.write_batch(docs[:3]))
+    asyncio.run(writer.write_batch(docs[3:]))
+
+    assert writer.spooled == 5
+    assert writer.take_spool() == docs
+    assert not os.path.exists(writer.spool_path)
+
+    analyses.fail = None
+    assert asyncio.run(writer.replay_spool()) == 5
+    assert list(analyses.docs) == [doc["_id"] for doc in docs]
+    assert analyses.recorded == [doc["_id"] for doc in docs]
+    assert not os.path.exists(writer.replay_path)
+    assert asyncio.run(writer.replay_spool()) == 0
+
+
+def test_a_replay_cut_short_is_picked_up_again(analyses, writer):
+    docs = [analysis(number) for number in range(5)]
+    analyses.fail = ConnectionError("mongo unavailable")
+    asyncio.run(writer.write_batch(docs[:4]))
+
+    # The process stops after the first replay batch lands
+    analyses.fail = None
+    write_batch = writer.write_batch
+
+    async def stop_after_first_batch(batch):
+        await write_batch(batch)
+        raise asyncio.CancelledError()
+
+    writer.write_batch = stop_after_first_batch
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(writer.replay_spool())
+    writer.write_batch = write_batch
+    assert os.path.exists(writer.replay_path)
+
+    # More documents are spooled before the next startup
+    analyses.fail = ConnectionError("mongo unavailable")
+    asyncio.run(writer.write_batch(docs[4:]))
+    analyses.fail = None
+
+    assert asyncio.run(writer.replay_spool()) == 5
+    assert sorted(analyses.docs) == sorted(doc["_id"] for doc in docs)
+    # The batch that landed before the stop is skipped, not counted twice
+    assert sorted(analyses.recorded) == sorted(doc["_id"] for doc in docs)
+    assert not os.path.exists(writer.spool_path) and not os.path.exists(writer.replay_path)
+
+
+def test_documents_failing_again_on_replay_stay_spooled(analyses, writer):
+    docs = [analysis(number) for number in range(2)]
+    analyses.fail = ConnectionError("mongo unavailable")
+    asyncio.run(writer.write_batch(docs))
+
+    assert asyncio.run(writer.replay_spool()) == 2
+    assert not os.path.exists(writer.replay_path)
+    assert writer.take_spool() == docs
@@ -0,0 +1,125 @@
+import asyncio
+import random
+from io import BytesIO
+
+import pytest
+from PIL import Image, ImageDraw, ImageFont
+
+import server
+
+WORDS = "hey how are you doing tonight want to grab dinner sure what time works maybe seven sounds great see you there".split()
+
+
+def screenshot(seed):
+    """A chat screenshot: the same bubble layout every time, with text chosen by seed"""
+    words = random.Random(seed)
+    font = ImageFont.load_default(size=30)
+    image = Image.new("RGB", (1170, 2532), "white")
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([0, 0, 1170, 200], fill=(245, 245, 245))
+    draw.text((450, 90), "Alex", font=font, fill="black")
+    for bubble in range(10):
+        mine = bubble % 2
+        left = 560 if mine else 40
+        top = 260 + bubble * 220
+        draw.rounded_rectangle([left, top, left + 570, top + 180], 30, fill=(0, 122, 255) if mine else (229, 229, 234))
+        for line in range(3):
+            text = " ".join(words.choice(WORDS) for _ in range(4))
+            draw.text((left + 30, top + 25 + line * 45), text, font=font, fill="white" if mine else "black")
+    return image
+
+
+def encoded(image, format="PNG", **options):
+    output = BytesIO()
+    image.save(output, format=format, **options)
+    return output.getvalue()
+
+
+def prepared(image, format="PNG", **options):
+    return server.preprocess_image(encoded(image, format, **options))
+
+
+class FakeImageContextCache:
+    """Stand-in for image_context_cache: insert_one, and find() on context_key and a $in over bands"""
+
+    def __init__(self):
+        self.docs = []
+
+    async def insert_one(self, doc):
+        self.docs.append(dict(doc))
+
+    def find(self, query, projection):
+        bands = set(query["bands"]["$in"])
+        matches = [
+            doc for doc in self.docs
+            if doc["context_key"] == query["context_key"] and bands & set(doc["bands"])
+        ]
+
+        class Cursor:
+            async def to_list(self, length):
+                return matches[:length]
+
+        return Cursor()
+
+
+@pytest.fixture(scope="module")
+def original():
+    return screenshot(1)
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    fake = FakeImageContextCache()
+    monkeypatch.setattr(server, "image_context_cache_collection", fake)
+    return fake
+
+
+def lookup(image, context=None, user_id="user-1"):
+    return asyncio.run(server.find_cached_image_context(image, context, user_id))
+
+
+@pytest.mark.parametrize("variant", ["jpeg95", "jpeg60", "crop", "resize"])
+def test_recompressed_cropped_or_resized_copy_hits(original, cache, variant):
+    asyncio.run(server.store_cached_image_context(prepared(original), None, "user-1", "Alex: dinner at seven?"))
+    width, height = original.size
+    copy = {
+        "jpeg95": lambda: prepared(original, "JPEG", quality=95),
+        "jpeg60": lambda: prepared(original, "JPEG", quality=60),
+        "crop": lambda: prepared(original.crop((0, 0, width, height - 20))),
+        "resize": lambda: prepared(original.resize((width * 3 // 4, height * 3 // 4), Image.LANCZOS), "JPEG", quality=80)
+    }[variant]()
+
+    assert lookup(copy) == "Alex: dinner at seven?"
+
+
+def test_different_conversation_with_the_same_layout_misses(original, cache):
+    asyncio.run(server.store_cached_image_context(prepared(original), None, "user-1", "Alex: dinner at seven?"))
+    for seed in range(2, 6):
+        other = prepared(screenshot(seed))
+        # Same bubbles, so the coarse dHash lands the stored entry among the candidates...
+        candidates = asyncio.run(cache.find({
+            "context_key": server.image_context_key(None, "user-1"),
+            "bands": {"$in": server.dhash_bands(other["dhash"], server.IMAGE_CONTEXT_HASH_MAX_DISTANCE)}
+        }, {}).to_list(length=50))
+        assert len(candidates) == 1
+        # ...but the text differs, so the thumbnails do not confirm it
+        assert lookup(other) is None
+
+
+def test_entries_are_per_user_and_context(original, cache):
+    image = prepared(original)
+    asyncio.run(server.store_cached_image_context(image, None, "user-1", "Alex: dinner at seven?"))
+
+    assert lookup(image, user_id="user-2") is None
+    assert lookup(image, context="we met at work") is None
+
+
+def test_thumbnail_distance_separates_copies_from_other_text(original):
+    thumbnail = prepared(original)["thumbnail"]
+    width, height = original.size
+
+    assert server.thumbnail_distance(thumbnail, thumbnail) == 0
+    cropped = prepared(original.crop((20, 0, width, height)), "JPEG", quality=80)["thumbnail"]
+    assert server.thumbnail_distance(thumbnail, cropped) <= server.IMAGE_CONTEXT_THUMBNAIL_MAX_DISTANCE
+    other = prepared(screenshot(7))["thumbnail"]
+    assert server.thumbnail_distance(thumbnail, other) > 2 * server.IMAGE_CONTEXT_THUMBNAIL_MAX_DISTANCE
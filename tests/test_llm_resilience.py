@@ -0,0 +1,246 @@
+import asyncio
+import time
+
+import pytest
+from fastapi import HTTPException
+
+import server
+from server import CircuitBreaker
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(time, "monotonic", fake)
+    return fake
+
+
+def test_breaker_opens_once_the_error_rate_crosses_the_threshold(clock):
+    breaker = CircuitBreaker(error_rate=0.5, min_calls=4, window_seconds=60, open_seconds=30)
+    for ok in (True, False, True):
+        breaker.record(ok)
+    # Below min_calls nothing trips, whatever the rate
+    assert breaker.state == "closed"
+
+    breaker.record(False)
+    assert breaker.state == "open"
+    assert breaker.trips == 1
+
+    clock.now += 10
+    with pytest.raises(HTTPException) as excinfo:
+        breaker.check()
+    assert excinfo.value.status_code == 503
+    assert excinfo.value.headers["Retry-After"] == "20"
+    assert breaker.rejected == 1
+
+
+def test_breaker_forgets_outcomes_outside_the_window(clock):
+    breaker = CircuitBreaker(error_rate=0.5, min_calls=4, window_seconds=60, open_seconds=30)
+    for _ in range(3):
+        breaker.record(False)
+    clock.now += 61
+    for ok in (True, True, True, False):
+        breaker.record(ok)
+    assert breaker.state == "closed"
+
+
+def test_half_open_breaker_lets_one_probe_through_and_closes_on_success(clock):
+    breaker = CircuitBreaker(error_rate=0.5, min_calls=2, window_seconds=60, open_seconds=30)
+    breaker.record(False)
+    breaker.record(False)
+    clock.now += 31
+    assert breaker.state == "half_open"
+
+    breaker.check()
+    with pytest.raises(HTTPException):
+        breaker.check()
+
+    breaker.record(True)
+    assert breaker.state == "closed"
+    breaker.check()
+
+
+def test_failed_probe_opens_the_breaker_again(clock):
+    breaker = CircuitBreaker(error_rate=0.5, min_calls=2, window_seconds=60, open_seconds=30)
+    breaker.record(False)
+    breaker.record(False)
+    clock.now += 31
+    breaker.check()
+    breaker.record(False)
+    assert breaker.state == "open"
+
+    clock.now += 31
+    breaker.check()
+    # A probe that goes away without an outcome lets the next one through
+    breaker.abandon()
+    breaker.check()
+
+
+class FakeChat:
+    def __init__(self, behaviour):
+        self.behaviour = behaviour
+        self.cancelled = False
+
+    async def send_message(self, message):
+        try:
+            return await self.behaviour()
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+
+
+def test_hedge_wins_and_the_slow_request_is_cancelled(monkeypatch):
+    monkeypatch.setattr(server, "LLM_HEDGE_PERCENTILE", 50)
+    monkeypatch.setattr(server, "LLM_HEDGE_MIN_SAMPLES", 1)
+    stage, model = "test_hedge_llm", "test-hedge-model"
+    server.llm_latency.samples.pop(stage, None)
+    server.llm_latency.add(stage, 0.01)
+    chats = []
+
+    async def slow():
+        await asyncio.sleep(10)
+        return "primary"
+
+    async def fast():
+        return "hedge"
+
+    def make_request():
+        chats.append(FakeChat(slow if not chats else fast))
+        return chats[-1], "message"
+
+    async def scenario():
+        response = await server.send_hedged_llm_request(stage, model, server.PLANS["pro"], make_request, server.LlmDeadline(5))
+        await asyncio.sleep(0)
+        return response
+
+    assert asyncio.run(scenario()) == "hedge"
+    assert len(chats) == 2
+    assert chats[0].cancelled
+    assert server.llm_hedges.values[(stage, model, "hedge")] >= 1
+    assert server.llm_scheduler.active == 0
+
+
+def test_no_hedge_without_enough_latency_samples(monkeypatch):
+    monkeypatch.setattr(server, "LLM_HEDGE_PERCENTILE", 50)
+    monkeypatch.setattr(server, "LLM_HEDGE_MIN_SAMPLES", 5)
+    stage = "test_unsampled_llm"
+    server.llm_latency.samples.pop(stage, None)
+    chats = []
+
+    async def answer():
+        await asyncio.sleep(0.02)
+        return "primary"
+
+    def make_request():
+        chats.append(FakeChat(answer))
+        return chats[-1], "message"
+
+    async def scenario():
+        return await server.send_hedged_llm_request(stage, "test-model", server.PLANS["pro"], make_request, server.LlmDeadline(5))
+
+    assert asyncio.run(scenario()) == "primary"
+    assert len(chats) == 1
+
+
+def test_retries_stop_at_the_deadline(monkeypatch):
+    monkeypatch.setattr(server, "LLM_TIMEOUT_SECONDS", 0.3)
+    monkeypatch.setattr(server, "LLM_MAX_RETRIES", 50)
+    monkeypatch.setattr(server, "LLM_RETRY_BACKOFF_SECONDS", 0.02)
+    attempts = []
+
+    async def rate_limited():
+        raise RuntimeError("429 rate limit exceeded")
+
+    def make_request():
+        attempts.append(time.monotonic())
+        return FakeChat(rate_limited), "message"
+
+    async def scenario():
+        started = time.monotonic()
+        with pytest.raises(RuntimeError):
+            await server.call_llm("test_retry_llm", "test-retry-model", server.PLANS["pro"], make_request)
+        return time.monotonic() - started
+
+    elapsed = asyncio.run(scenario())
+    assert 1 < len(attempts) < 51
+    # No retry is started once its backoff would run past the deadline
+    assert elapsed < 0.3
+
+
+def test_slow_upstream_times_out_at_the_deadline(monkeypatch):
+    monkeypatch.setattr(server, "LLM_TIMEOUT_SECONDS", 0.1)
+    chats = []
+
+    async def hang():
+        await asyncio.sleep(10)
+
+    def make_request():
+        chats.append(FakeChat(hang))
+        return chats[-1], "message"
+
+    async def scenario():
+        with pytest.raises(HTTPException) as excinfo:
+            await server.call_llm("test_timeout_llm", "test-timeout-model", server.PLANS["pro"], make_request)
+        await asyncio.sleep(0)
+        return excinfo.value
+
+    error = asyncio.run(scenario())
+    assert error.status_code == 504
+    assert len(chats) == 1
+    assert chats[0].cancelled
+
+
+def test_non_transient_errors_are_not_retried():
+    attempts = []
+
+    async def bad_request():
+        raise ValueError("invalid prompt")
+
+    def make_request():
+        attempts.append(1)
+        return FakeChat(bad_request), "message"
+
+    with pytest.raises(ValueError):
+        asyncio.run(server.call_llm("test_fatal_llm", "test-fatal-model", server.PLANS["pro"], make_request))
+    assert len(attempts) == 1
+
+
+def test_waiting_in_our_own_queue_does_not_trip_the_breaker(monkeypatch):
+    monkeypatch.setattr(server, "LLM_TIMEOUT_SECONDS", 0.3)
+    monkeypatch.setattr(server, "llm_scheduler", server.LlmScheduler(max_concurrent=1, max_queue=10, max_wait=0.5))
+    model = "test-queued-model"
+    server.llm_breakers.pop(model, None)
+
+    async def healthy():
+        await asyncio.sleep(0.2)
+        return "x"
+
+    def make_request():
+        return FakeChat(healthy), "message"
+
+    async def caller():
+        try:
+            return await server.call_llm("test_queued_llm", model, server.PLANS["pro"], make_request)
+        except HTTPException as e:
+            return e.status_code
+
+    async def scenario():
+        return await asyncio.gather(*(caller() for _ in range(6)))
+
+    results = asyncio.run(scenario())
+    # Each call gets its full deadline once it has a slot; the ones that cannot
+    # get one in time are turned away as overload, not timed out upstream
+    assert results.count("x") >= 2
+    assert 504 not in results
+    assert set(results) <= {"x", 503}
+    breaker = server.llm_breakers[model]
+    assert breaker.state == "closed"
+    assert all(ok for _, ok in breaker.outcomes)
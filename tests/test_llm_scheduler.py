@@ -0,0 +1,138 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import server
+from server import LlmScheduler
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_queued_work_is_served_by_plan_weight():
+    async def scenario():
+        scheduler = LlmScheduler(max_concurrent=1, max_queue=50, max_wait=5)
+        await scheduler.acquire("holder", 1)
+        order = []
+
+        async def waiter(plan, weight):
+            await scheduler.acquire(plan, weight)
+            order.append(plan)
+            scheduler.release()
+
+        tasks = [asyncio.ensure_future(waiter("standard", 1)) for _ in range(5)]
+        tasks += [asyncio.ensure_future(waiter("pro", 4)) for _ in range(5)]
+        await settle()
+        assert scheduler.queued == 10
+
+        scheduler.release()
+        await asyncio.gather(*tasks)
+        return order, scheduler
+
+    order, scheduler = asyncio.run(scenario())
+    # Smooth weighted round robin: four pro calls for every standard one while both queue
+    assert order[:5].count("pro") == 4
+    assert order[:5].count("standard") == 1
+    assert sorted(order) == ["pro"] * 5 + ["standard"] * 5
+    assert scheduler.active == 0
+
+
+def test_full_queue_is_rejected_with_retry_after():
+    async def scenario():
+        scheduler = LlmScheduler(max_concurrent=1, max_queue=2, max_wait=5)
+        await scheduler.acquire("standard", 1)
+        waiters = [asyncio.ensure_future(scheduler.acquire("standard", 1)) for _ in range(2)]
+        await settle()
+
+        with pytest.raises(HTTPException) as excinfo:
+            await scheduler.acquire("standard", 1)
+
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        return excinfo.value, scheduler
+
+    error, scheduler = asyncio.run(scenario())
+    assert error.status_code == 503
+    # Two queued plus this caller, one slot, one second average hold
+    assert error.headers["Retry-After"] == "3"
+    assert scheduler.rejected == 1
+    assert scheduler.queued == 0
+
+
+def test_retry_after_follows_average_hold_time():
+    scheduler = LlmScheduler(max_concurrent=4, max_queue=10, max_wait=5)
+    scheduler.active = 1
+    scheduler.release(held_seconds=11.0)
+    # Rolling average: 0.9 * 1.0 + 0.1 * 11.0
+    assert scheduler.avg_hold_seconds == pytest.approx(2.0)
+    assert scheduler.retry_after() == 1
+    scheduler._queues["standard"] = [object()] * 7
+    assert scheduler.retry_after() == 4
+
+
+def test_wait_timeout_leaves_the_queue():
+    async def scenario():
+        scheduler = LlmScheduler(max_concurrent=1, max_queue=10, max_wait=0.01)
+        await scheduler.acquire("standard", 1)
+        with pytest.raises(HTTPException) as excinfo:
+            await scheduler.acquire("standard", 1)
+        queued_after_timeout = scheduler.queued
+        scheduler.release()
+        return excinfo.value, queued_after_timeout, scheduler
+
+    error, queued_after_timeout, scheduler = asyncio.run(scenario())
+    assert error.status_code == 503
+    assert scheduler.timed_out == 1
+    assert queued_after_timeout == 0
+    assert scheduler.active == 0
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def scenario():
+        scheduler = LlmScheduler(max_concurrent=1, max_queue=10, max_wait=5)
+        await scheduler.acquire("standard", 1)
+        waiter = asyncio.ensure_future(scheduler.acquire("standard", 1))
+        await settle()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        queued_after_cancel = scheduler.queued
+        scheduler.release()
+        return queued_after_cancel, scheduler
+
+    queued_after_cancel, scheduler = asyncio.run(scenario())
+    assert queued_after_cancel == 0
+    assert scheduler.active == 0
+
+
+def test_slot_granted_to_a_cancelled_waiter_is_released():
+    async def scenario():
+        scheduler = LlmScheduler(max_concurrent=1, max_queue=10, max_wait=5)
+        await scheduler.acquire("standard", 1)
+        waiter = asyncio.ensure_future(scheduler.acquire("standard", 1))
+        await settle()
+        # Hand the slot over, then cancel before the waiter gets to run
+        scheduler.release()
+        assert scheduler.active == 1
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert scheduler.active == 0
+
+
+def test_slot_is_released_when_the_call_fails():
+    async def scenario():
+        scheduler = LlmScheduler(max_concurrent=2, max_queue=10, max_wait=5)
+        with pytest.raises(RuntimeError):
+            async with scheduler.slot(server.PLANS["pro"]):
+                assert scheduler.active == 1
+                raise RuntimeError("upstream failed")
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert scheduler.active == 0
@@ -0,0 +1,82 @@
+import re
+import zlib
+
+import pytest
+
+import server
+from server import PdfFont, StreamingPdfWriter
+
+SANS = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+MONO = "/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf"
+
+
+@pytest.fixture(scope="module")
+def sans():
+    try:
+        return PdfFont(SANS)
+    except OSError:
+        pytest.skip("DejaVu Sans is not installed")
+
+
+def flate_streams(pdf):
+    return [zlib.decompress(data) for data in re.findall(rb"/FlateDecode[^>]*>>\nstream\n(.*?)\nendstream", pdf, re.S)]
+
+
+def test_non_latin_text_is_embedded_and_mapped_back_to_unicode(sans):
+    writer = StreamingPdfWriter([sans])
+    pdf = writer.begin() + writer.add_text("Привет 😀 naïve", bold=True) + writer.finish()
+
+    assert b"/Subtype /Type0" in pdf and b"/FontFile2" in pdf
+    to_unicode = next(stream for stream in flate_streams(pdf) if b"beginbfchar" in stream)
+    # Each character gets its own CID, mapped back to the text it came from
+    for char in "Привет😀ï":
+        assert char.encode("utf-16-be").hex().upper().encode() in to_unicode
+    content = re.search(rb"BT.*?ET", pdf, re.S).group()
+    assert b"2 Tr" in content
+    assert b"?" not in content
+
+
+def test_characters_missing_from_a_font_fall_back_to_the_next(sans):
+    try:
+        mono = PdfFont(MONO)
+    except OSError:
+        pytest.skip("DejaVu Sans Mono is not installed")
+    writer = StreamingPdfWriter([mono, sans])
+    pdf = writer.begin() + writer.add_text("abc Ǆ") + writer.finish()
+
+    assert writer.font_for("a") == 0
+    assert writer.font_for("Ǆ") == 1
+    assert b"/F1 3 0 R /F2 4 0 R" in pdf
+    assert pdf.count(b"/Subtype /CIDFontType2") == 2
+
+
+def test_unspaced_text_wraps_within_the_margins(sans):
+    writer = StreamingPdfWriter([sans])
+    lines = writer.wrap("你好" * 300 + " short words " * 40)
+
+    assert len(lines) > 5
+    assert all(sum(writer.char_width(char) for char in line) <= writer.line_width for line in lines)
+    assert "".join(lines).replace(" ", "").startswith("你好" * 300)
+
+
+def test_pages_and_fonts_are_streamed_in_order(sans):
+    writer = StreamingPdfWriter([sans])
+    chunks = [writer.begin()]
+    for number in range(200):
+        chunks.append(writer.add_text(f"{number}. Сообщение"))
+    chunks.append(writer.finish())
+    pdf = b"".join(chunks)
+
+    # Full pages went out before finish(); only the fonts wait for the end
+    assert sum(1 for chunk in chunks[1:-1] if chunk) == 200 // writer.lines_per_page
+    assert pdf.count(b"/Type /Page ") == len(writer.page_ids) == 4
+    xref = int(re.search(rb"startxref\n(\d+)", pdf).group(1))
+    assert pdf[xref:xref + 4] == b"xref"
+    for number, offset in enumerate(writer.offsets, start=1):
+        assert pdf[offset:].startswith(b"%d 0 obj" % number)
+
+
+def test_pdf_export_needs_a_font(monkeypatch):
+    monkeypatch.setattr(server, "pdf_fonts", None)
+    monkeypatch.setattr(server, "PDF_FONT_PATHS", ["/nonexistent/font.ttf"])
+    assert server.load_pdf_fonts() == []
@@ -0,0 +1,39 @@
+from server import budget_conversation, estimate_tokens
+
+
+def test_conversation_within_budget_is_unchanged():
+    conversation = "Alex: hey\nMe: hi there"
+    context, stats = budget_conversation(conversation, 100)
+
+    assert context == conversation
+    assert stats["omitted_turns"] == 0
+
+
+def test_older_turns_are_compressed_then_omitted():
+    turns = [f"Alex: message number {number}" + " padding words" * 10 for number in range(40)]
+    context, stats = budget_conversation("\n".join(turns), 300)
+
+    assert context.endswith(turns[-1])
+    assert stats["verbatim_turns"] + stats["compressed_turns"] + stats["omitted_turns"] == 40
+    assert stats["compressed_turns"] and stats["omitted_turns"]
+    assert context.startswith(f"[{stats['omitted_turns']} earlier messages omitted]")
+
+
+def test_newest_turn_past_the_verbatim_share_is_kept_whole():
+    newest = "Me: " + "word " * 300
+    context, stats = budget_conversation("Alex: hi\n" * 20 + newest, 400)
+
+    assert estimate_tokens(newest) > 400 * 0.7
+    assert context.endswith(newest.strip())
+    assert stats["verbatim_turns"] == 1
+
+
+def test_single_oversized_turn_uses_the_whole_budget():
+    newest = "Me: " + " ".join(f"word{number}" for number in range(2000))
+    context, stats = budget_conversation("Alex: hi\nMe: hello\n" + newest, 500)
+
+    kept = context.splitlines()[-1]
+    assert kept.startswith("…") and newest.endswith(kept[1:])
+    # All of the budget, not just the verbatim share, less the line break
+    assert estimate_tokens(kept) == 499
+    assert stats["omitted_turns"] == 2
@@ -0,0 +1,224 @@
+import asyncio
+import copy
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+
+import server
+from server import RateLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FrozenDatetime(datetime):
+    current = datetime(2026, 10, 17, 12, 0, 30, tzinfo=timezone.utc)
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.current
+
+
+class FakeRateLimits:
+    """Stand-in for the rate_limits collection's $inc upsert"""
+
+    def __init__(self):
+        self.docs = {}
+        self.fail = False
+
+    async def find_one_and_update(self, query, update, upsert, return_document):
+        if self.fail:
+            raise ConnectionError("mongo unavailable")
+        doc = self.docs.setdefault(query["_id"], {"_id": query["_id"], "count": 0, "minutes": {}})
+        for key, amount in update["$inc"].items():
+            if key == "count":
+                doc["count"] += amount
+            else:
+                minute = key.split(".", 1)[1]
+                doc["minutes"][minute] = doc["minutes"].get(minute, 0) + amount
+        return copy.deepcopy(doc)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(time, "monotonic", fake)
+    monkeypatch.setattr(server, "datetime", FrozenDatetime)
+    FrozenDatetime.current = datetime(2026, 10, 17, 12, 0, 30, tzinfo=timezone.utc)
+    return fake
+
+
+@pytest.fixture
+def collection(monkeypatch):
+    fake = FakeRateLimits()
+    monkeypatch.setattr(server, "rate_limits_collection", fake)
+    return fake
+
+
+def limits(per_minute=60, burst=5, per_day=1000):
+    return {"requests_per_minute": per_minute, "burst": burst, "requests_per_day": per_day}
+
+
+def rejection(limiter, user_id, user_limits, cost=1):
+    with pytest.raises(HTTPException) as excinfo:
+        limiter.check(user_id, user_limits, cost)
+    assert excinfo.value.status_code == 429
+    return excinfo.value.headers
+
+
+def test_token_bucket_allows_a_burst_then_refills(clock):
+    limiter = RateLimiter(1)
+    user_limits = limits(per_minute=60, burst=2)
+    limiter.check("user-1", user_limits)
+    limiter.check("user-1", user_limits)
+
+    headers = rejection(limiter, "user-1", user_limits)
+    assert headers["Retry-After"] == "1"
+    assert limiter.limited == 1
+
+    # 60 per minute refills one token a second
+    clock.now += 1
+    limiter.check("user-1", user_limits)
+    rejection(limiter, "user-1", user_limits)
+
+
+def test_bucket_never_refills_past_the_burst(clock):
+    limiter = RateLimiter(1)
+    user_limits = limits(per_minute=60, burst=2)
+    limiter.check("user-1", user_limits)
+    clock.now += 3600
+    limiter.check("user-1", user_limits)
+    limiter.check("user-1", user_limits)
+    rejection(limiter, "user-1", user_limits)
+
+
+def test_minute_limit_resets_with_the_minute(clock):
+    limiter = RateLimiter(1)
+    user_limits = limits(per_minute=3, burst=10)
+    for _ in range(3):
+        limiter.check("user-1", user_limits)
+
+    headers = rejection(limiter, "user-1", user_limits)
+    assert headers["Retry-After"] == "30"
+    assert headers["X-RateLimit-Limit"] == "3"
+
+    FrozenDatetime.current += timedelta(seconds=30)
+    limiter.check("user-1", user_limits)
+
+
+def test_daily_quota_holds_until_midnight(clock):
+    limiter = RateLimiter(1)
+    user_limits = limits(per_minute=60, burst=10, per_day=2)
+    limiter.check("user-1", user_limits)
+    limiter.check("user-1", user_limits)
+
+    headers = rejection(limiter, "user-1", user_limits)
+    assert headers["X-RateLimit-Limit"] == "2"
+    assert int(headers["Retry-After"]) == 12 * 3600 - 30 + 1
+
+    FrozenDatetime.current += timedelta(hours=12)
+    clock.now += 60
+    limiter.check("user-1", user_limits)
+
+
+def test_headers_describe_the_tightest_quota(clock):
+    limiter = RateLimiter(1)
+    user_limits = limits(per_minute=60, burst=10, per_day=3)
+    headers = limiter.check("user-1", user_limits)
+    assert headers == {"X-RateLimit-Limit": "3", "X-RateLimit-Remaining": "2", "X-RateLimit-Reset": str(12 * 3600 - 30 + 1)}
+
+    user_limits = limits(per_minute=60, burst=2)
+    headers = limiter.check("user-2", user_limits)
+    # One token of two left, refilled in a second
+    assert headers == {"X-RateLimit-Limit": "2", "X-RateLimit-Remaining": "1", "X-RateLimit-Reset": "1"}
+    limiter.check("user-2", user_limits)
+    headers = rejection(limiter, "user-2", user_limits)
+    assert headers["X-RateLimit-Limit"] == "2"
+    assert headers["X-RateLimit-Remaining"] == "0"
+
+
+def test_users_are_limited_independently(clock):
+    limiter = RateLimiter(1)
+    user_limits = limits(per_minute=60, burst=1)
+    limiter.check("user-1", user_limits)
+    rejection(limiter, "user-1", user_limits)
+    limiter.check("user-2", user_limits)
+
+
+def test_batch_takes_one_token_but_counts_every_item(clock):
+    limiter = RateLimiter(1)
+    user_limits = limits(per_minute=10, burst=5)
+    headers = limiter.check("user-1", user_limits, cost=4)
+    # 4 tokens left in the bucket of 5 is tighter than 6 of 10 left this minute
+    assert headers["X-RateLimit-Limit"] == "5"
+    assert headers["X-RateLimit-Remaining"] == "4"
+
+    # 4 + 7 items would pass the per-minute limit even with tokens left
+    rejection(limiter, "user-1", user_limits, cost=7)
+    headers = limiter.check("user-1", user_limits, cost=6)
+    assert headers["X-RateLimit-Limit"] == "10"
+    assert headers["X-RateLimit-Remaining"] == "0"
+    assert headers["X-RateLimit-Reset"] == "30"
+    assert limiter.users["user-1"].minute_count == 10
+
+
+def test_sync_folds_in_usage_from_other_workers(clock, collection):
+    collection.docs["user-1:2026-10-17"] = {"_id": "user-1:2026-10-17", "count": 50, "minutes": {"1200": 5}}
+    limiter = RateLimiter(1)
+    user_limits = limits(per_minute=8, burst=10)
+    limiter.check("user-1", user_limits)
+
+    asyncio.run(limiter.sync())
+    usage = limiter.users["user-1"]
+    assert usage.day_count == 51
+    assert usage.minute_count == 6
+    assert usage.unsynced == {}
+    assert collection.docs["user-1:2026-10-17"]["count"] == 51
+
+    limiter.check("user-1", user_limits)
+    limiter.check("user-1", user_limits)
+    # The other workers' requests count against the shared limits
+    headers = rejection(limiter, "user-1", user_limits)
+    assert headers["X-RateLimit-Limit"] == "8"
+
+
+def test_usage_is_synced_under_the_minute_it_happened_in(clock, collection):
+    limiter = RateLimiter(1)
+    user_limits = limits(per_minute=60, burst=10)
+    limiter.check("user-1", user_limits)
+    limiter.check("user-1", user_limits)
+    FrozenDatetime.current += timedelta(seconds=40)
+    limiter.check("user-1", user_limits)
+
+    # The new minute starts from zero rather than inheriting unsynced usage
+    assert limiter.users["user-1"].minute_count == 1
+
+    asyncio.run(limiter.sync())
+    doc = collection.docs["user-1:2026-10-17"]
+    assert doc["count"] == 3
+    assert doc["minutes"] == {"1200": 2, "1201": 1}
+    assert limiter.users["user-1"].minute_count == 1
+    assert limiter.users["user-1"].day_count == 3
+
+
+def test_failed_sync_keeps_the_usage_for_the_next_one(clock, collection):
+    limiter = RateLimiter(1)
+    user_limits = limits()
+    limiter.check("user-1", user_limits, cost=3)
+
+    collection.fail = True
+    with pytest.raises(ConnectionError):
+        asyncio.run(limiter.sync())
+    assert limiter.stats()["unsynced"] == 3
+
+    collection.fail = False
+    asyncio.run(limiter.sync())
+    assert limiter.stats()["unsynced"] == 0
+    assert collection.docs["user-1:2026-10-17"]["count"] == 3
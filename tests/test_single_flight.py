@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+from server import SingleFlight
+
+
+def test_concurrent_callers_share_one_call():
+    async def scenario():
+        flights = SingleFlight()
+        calls = []
+        release = asyncio.Event()
+
+        async def work():
+            calls.append(1)
+            await release.wait()
+            return "result"
+
+        waiters = [asyncio.ensure_future(flights.do("key", work)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*waiters)
+        return calls, results, flights.stats()
+
+    calls, results, stats = asyncio.run(scenario())
+
+    assert calls == [1]
+    assert results == ["result"] * 3
+    assert stats == {"in_flight": 0, "coalesced": 2}
+
+
+def test_an_error_reaches_every_waiter():
+    async def scenario():
+        flights = SingleFlight()
+        calls = []
+        release = asyncio.Event()
+
+        async def work():
+            calls.append(1)
+            await release.wait()
+            raise ValueError("upstream failed")
+
+        waiters = [asyncio.ensure_future(flights.do("key", work)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+        # The next call starts afresh rather than getting the old error
+        release.clear()
+        retry = asyncio.ensure_future(flights.do("key", work))
+        await asyncio.sleep(0)
+        release.set()
+        with pytest.raises(ValueError):
+            await retry
+        return calls, results
+
+    calls, results = asyncio.run(scenario())
+
+    assert len(calls) == 2
+    assert all(isinstance(result, ValueError) for result in results)
+    assert len({id(result) for result in results}) == 1
+
+
+def test_the_shared_call_outlives_the_caller_that_started_it():
+    async def scenario():
+        flights = SingleFlight()
+        calls = []
+        finished = []
+        release = asyncio.Event()
+
+        async def work():
+            calls.append(1)
+            await release.wait()
+            finished.append(1)
+            return "result"
+
+        first = asyncio.ensure_future(flights.do("key", work))
+        second = asyncio.ensure_future(flights.do("key", work))
+        await asyncio.sleep(0)
+        # The first caller's client disconnects
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        result = await second
+
+        # With every caller gone, the call still runs to completion
+        release.clear()
+        only = asyncio.ensure_future(flights.do("other", work))
+        await asyncio.sleep(0)
+        only.cancel()
+        release.set()
+        await asyncio.sleep(0.01)
+        return first.cancelled(), result, calls, finished, flights.stats()
+
+    first_cancelled, result, calls, finished, stats = asyncio.run(scenario())
+
+    assert first_cancelled
+    assert result == "result"
+    assert calls == [1, 1] and finished == [1, 1]
+    assert stats["in_flight"] == 0
@@ -0,0 +1,86 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import server
+
+
+def completion_chunk(text):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+
+class FakeStream:
+    """Yields the first chunks, then holds the completion open until released"""
+
+    def __init__(self, head, tail, release):
+        self.head = head
+        self.tail = tail
+        self.release = release
+
+    async def __aiter__(self):
+        for text in self.head:
+            yield completion_chunk(text)
+        await self.release.wait()
+        for text in self.tail:
+            yield completion_chunk(text)
+
+
+def parse_event(raw):
+    lines = raw.strip().split("\n")
+    return lines[0][len("event: "):], json.loads(lines[1][len("data: "):])
+
+
+def test_suggestion_events_arrive_before_completion_ends(monkeypatch):
+    saved = []
+
+    async def fake_save_analysis(doc):
+        saved.append(doc)
+        return "analysis-1"
+
+    async def fake_store_cached_suggestions(key, result):
+        pass
+
+    async def scenario():
+        release = asyncio.Event()
+        calls = []
+
+        async def fake_acompletion(**kwargs):
+            calls.append(kwargs)
+            return FakeStream(
+                ["ANALYSIS: They seem keen.\nSUGG", "ESTION 1: Saturday? - Specific\n"],
+                ["SUGGESTION 2: Sunday? - Flexible\n", "SUGGESTION 3: Dinner? - Warm"],
+                release
+            )
+
+        monkeypatch.setattr(server.litellm, "acompletion", fake_acompletion)
+        monkeypatch.setattr(server, "save_analysis", fake_save_analysis)
+        monkeypatch.setattr(server, "store_cached_suggestions", fake_store_cached_suggestions)
+
+        events = server.stream_suggestion_events(
+            {"user_id": "user-1"},
+            "Them: Free this weekend?",
+            "friendly",
+            "date",
+            server.PLANS["standard"],
+            use_cache=False
+        )
+        received = []
+        while len(received) < 2:
+            received.append(parse_event(await asyncio.wait_for(events.__anext__(), 1)))
+        # The completion is still open, yet the first lines have been sent
+        assert not release.is_set()
+        assert received == [
+            ("analysis", {"analysis_text": "They seem keen."}),
+            ("suggestion", {"index": 0, "text": "Saturday? - Specific"})
+        ]
+        assert calls[0]["stream"] is True
+
+        release.set()
+        async for raw in events:
+            received.append(parse_event(raw))
+        return received
+
+    received = asyncio.run(scenario())
+    assert [event for event, _ in received] == ["analysis", "suggestion", "suggestion", "suggestion", "done"]
+    assert received[-1][1]["suggestions"] == ["Saturday? - Specific", "Sunday? - Flexible", "Dinner? - Warm"]
+    assert saved[0]["suggestions"] == received[-1][1]["suggestions"]